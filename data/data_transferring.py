@@ -1,11 +1,13 @@
 import os
 import traceback
+from itertools import chain
 from typing import Set
 
 from data.transferring import DataParser
+from data.transferring.settings import Settings
 from data.transferring.uploading import DataUploader
 from models import BaseEntity, Bot, UserInBot, Chat, User, Message, BusClick, PlacedAd, FoodOrder
-from models import ChatsEntities
+from models import ChatsEntitiesFile
 from models import UserInChat
 
 
@@ -13,12 +15,17 @@ class TransferringActions:
     actions_description = '''
     Choose what and from what u want to transfer to SQL DB:
     1 - Chats and Users' data (chats, users, messages, users_in_chats): from config files and Telegram
+        (only messages, which are newer than the ones of the previous run, are downloaded)
     2 - Bots and users in bots (bots, users_in_bots): from config file and MongoDB
 
     3 - Buses clicks data (bus_clicks): from file raw_data
     4 - Placed ads data (placed_ads): from MongoDB
     5 - Food orders data (food_orders): from MongoDB
 
+    6 - Chats and Users' data (chats, users, messages, users_in_chats): from the local cache of Telegram messages
+    7 - Chats and Users' data (chats, users, messages, users_in_chats): from Telegram in real time
+        (new messages are uploaded as they come, until interrupted)
+
     0 - Exit
 
     > '''
@@ -31,8 +38,7 @@ class TransferringActions:
 
     @classmethod
     def insert_entities(cls, entities: Set[BaseEntity]):
-        for e in entities:
-            cls.uploader.insert_entity(e)
+        cls.uploader.upload_entities(entities)
 
     @classmethod
     def perform(cls, action_number: str):
@@ -43,24 +49,41 @@ class TransferringActions:
         action_number = int(action_number)
 
         # upload chats entities (chats, users, messages, users_in_chats)
-        if action_number == 1:
+        if action_number == 1 and Settings.tg_pipeline and not Settings.tg_extra_config_files_paths:
+            # interrupted downloads are resumed by the next run, and uploaded entities are updated
+            try:
+                cls.parser.pipe_chat_entities(cls.uploader)
+
+            except Exception as e:
+                print(traceback.format_tb(e.__traceback__))
+                result_str = 'Error uploading chat entities: %s. Run again to resume' % str(e)
+
+            else:
+                result_str = 'Chat entities were uploaded'
+
+        elif action_number == 1:
             # TODO: move serializing to TG client
             _serialized_filename = 'serialized_chat_entities'
 
-            # try to load serialized entities (if exists)
+            entities_file = ChatsEntitiesFile(_serialized_filename)
+
+            # try to stream serialized entities from the disk (if exists)
             if os.path.exists(_serialized_filename):
-                chat_entities = ChatsEntities()
-                chat_entities.from_file(_serialized_filename)
+                chat_entities = entities_file.stream()
 
             # or load from Telegram and save to temp file
             else:
                 chat_entities = cls.parser.get_chat_entities()
-                chat_entities.to_file(_serialized_filename)
+                entities_file.write(chat_entities)
 
-            # clear old and upload new chat entities to DB
+            # sync the tables with the new chat entities (if whole histories were downloaded) or upload them
             try:
-                cls.uploader.clear_tables(Chat, User, Message, UserInChat)
-                cls.uploader.upload_chats_entities(chat_entities)
+                if not chat_entities.incremental:
+                    cls.uploader.sync_chats_entities(chat_entities)
+
+                # existing entities are updated, so only the new ones are added in the incremental mode
+                else:
+                    cls.uploader.upload_chats_entities(chat_entities)
 
             except Exception as e:
                 print(traceback.format_tb(e.__traceback__))
@@ -77,9 +100,7 @@ class TransferringActions:
         elif action_number == 2:
             bots, users_in_bots = cls.parser.get_bots(), cls.parser.get_users_in_bots()
 
-            cls.uploader.clear_tables(Bot, UserInBot)
-            cls.insert_entities(bots)
-            cls.insert_entities(users_in_bots)
+            cls.uploader.sync_entities(chain(bots, users_in_bots), Bot, UserInBot)
 
             result_str = 'Bots and users were uploaded'
 
@@ -87,8 +108,7 @@ class TransferringActions:
         elif action_number == 3:
             clicks = cls.parser.get_bus_clicks()
 
-            cls.uploader.clear_tables(BusClick)
-            cls.insert_entities(clicks)
+            cls.uploader.sync_entities(clicks, BusClick)
 
             result_str = 'Buses clicks users were uploaded'
 
@@ -96,8 +116,7 @@ class TransferringActions:
         elif action_number == 4:
             placed_ads = cls.parser.get_placed_ads()
 
-            cls.uploader.clear_tables(PlacedAd)
-            cls.insert_entities(placed_ads)
+            cls.uploader.sync_entities(placed_ads, PlacedAd)
 
             result_str = 'Placed ads users were uploaded'
 
@@ -105,11 +124,24 @@ class TransferringActions:
         elif action_number == 5:
             food_orders = cls.parser.get_food_orders()
 
-            cls.uploader.clear_tables(FoodOrder)
-            cls.insert_entities(food_orders)
+            cls.uploader.sync_entities(food_orders, FoodOrder)
 
             result_str = 'Food orders were uploaded'
 
+        # upload chats entities parsed from the cache of Telegram messages
+        elif action_number == 6:
+            chat_entities = cls.parser.get_cached_chat_entities()
+
+            cls.uploader.sync_chats_entities(chat_entities)
+
+            result_str = 'Chat entities were uploaded from the cache'
+
+        # upload chats entities as new messages come (existing entities are updated)
+        elif action_number == 7:
+            cls.parser.listen_chat_entities(cls.uploader.upload_chats_entities)
+
+            result_str = 'Listening to the chats is stopped'
+
         return result_str
 
 
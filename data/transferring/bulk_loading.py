@@ -0,0 +1,626 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice, chain
+from operator import attrgetter
+from typing import Iterable, Any, Generator, List, Dict, Tuple, Set
+
+from postgresql.api import Connection
+
+from models import User, Chat, Message, Bot, UserInBot, FoodOrder, BusClick, PlacedAd, BaseEntity
+from models import UserInChat
+from .connections import ConnectionsPool
+from .users_ids import UsersIdsCache
+
+
+class BulkTable:
+    """
+    Description of the bulk loading of the entities of a type into a table: columns of the table
+    (in the order of the rows of the entities, see row_getter), types of the columns of the staging table,
+    set-based SQL function, which takes the rows as arrays of their fields (see functions.sql), and the unique key.
+    Users are given by the Telegram ids in the rows, they are resolved to the local ids by the loader
+    before the rows are staged (see BulkLoader).
+    """
+
+    def __init__(self, title: str, columns: Tuple[str, ...], staging_types: Tuple[str, ...], array_function: str,
+                 row_getter, key_columns: Tuple[str, ...] = None, condition: str = None, keep_missing: bool = False,
+                 serial_column: str = None):
+        """
+        :param key_columns: if None - the rows are only inserted (and compared by all the columns on sync)
+        :param condition: condition of the staged rows (s), which are stored
+        :param keep_missing: if True - rows, which are missing from the staged ones, are not deleted on sync
+        :param serial_column: column of the table, which values are generated by a sequence
+        """
+        self.title = title
+        self.columns = columns
+        self.array_function = array_function
+        self.row_getter = row_getter
+        self.key_columns = key_columns
+        self.condition = condition
+        self.keep_missing = keep_missing
+        self.serial_column = serial_column
+
+        self.staging_title = 'staging_' + title
+        self.shadow_title = title + '_new'
+        self.staging_columns = ', '.join(['%s %s' % (c, t) for c, t in zip(columns, staging_types)])
+
+        self.merge_statements = self._get_statements(sync=False)
+        self.sync_statements = self._get_statements(sync=True)
+        self.shadow_statements = self._get_shadow_statements()
+
+    @staticmethod
+    def _row(values: List[str]) -> str:
+        return values[0] if len(values) == 1 else '(%s)' % ', '.join(values)
+
+    def _select_staged(self) -> str:
+        """
+        :return: query of the staged rows in the order of the columns of the table
+        """
+        q_text = 'SELECT '
+
+        # a row can be merged only once
+        if self.key_columns:
+            q_text += 'DISTINCT ON (%s) ' % ', '.join(['s.' + c for c in self.key_columns])
+
+        q_text += ', '.join(['s.' + c for c in self.columns])
+        q_text += ' FROM %s s' % self.staging_title
+
+        conditions = [self.condition] if self.condition else []
+
+        # rows without a user are stored, unless the user is a part of the key
+        if 'user_id' in (self.key_columns or ()):
+            conditions.append('s.user_id IS NOT NULL')
+
+        if conditions:
+            q_text += ' WHERE ' + ' AND '.join(conditions)
+
+        return q_text
+
+    def _matches(self, columns: Iterable[str], row: str = 's', table_row: str = None) -> str:
+        """
+        :return: condition of a :row matching the row of the table (or the :table_row) by the given columns
+        """
+        # columns of the keys are never NULL, so hash joins can be used
+        return ' AND '.join(['{r}.{c} = {t}.{c}'.format(r=row, c=c, t=table_row or self.title) for c in columns])
+
+    def _numbered(self, source: str, columns: Iterable[str] = ()) -> str:
+        """
+        :return: query of the rows of the :source (with the given :columns) with their texts and their numbers
+            among the equal rows, so the rows without the key can be matched by (row_text, row_number):
+            by equality, which treats NULLs as equal values (hash joins can still be used), and with their duplicates
+        """
+        row_text = 'ROW(%s)::text' % ', '.join(self.columns)
+
+        return ('SELECT {columns}{row_text} AS row_text, row_number() OVER (PARTITION BY {row_text}) AS row_number '
+                'FROM {source}'.format(columns=''.join([c + ', ' for c in columns]), row_text=row_text, source=source))
+
+    def get_deduplication(self) -> str:
+        """
+        :return: statement, which removes the rows of the shadow table with the same keys (the last loaded one is kept),
+            None for the tables without the key (their equal rows are different entities)
+        """
+        if not self.key_columns:
+            return None
+
+        return 'DELETE FROM {shadow} a USING {shadow} b WHERE {matches} AND a.ctid < b.ctid'.format(
+            shadow=self.shadow_title, matches=self._matches(self.key_columns, 'a', 'b'))
+
+    def _get_statements(self, sync: bool) -> Tuple[str, ...]:
+        """
+        :param sync: if True - table rows, which are missing from the staged ones, are deleted,
+            and only the new rows are inserted into the tables without the key
+        :return: statements, which merge the staging table into the table
+        """
+        statements = []
+        columns = ', '.join(self.columns)
+
+        if sync and not self.keep_missing and self.key_columns:
+            statements.append('DELETE FROM {t} WHERE NOT EXISTS (SELECT 1 FROM ({staged}) s WHERE {matches})'
+                              .format(t=self.title, staged=self._select_staged(),
+                                      matches=self._matches(self.key_columns)))
+
+        # rows are deleted only as many times as they are missing from the staged ones
+        elif sync and not self.keep_missing:
+            statements.append('DELETE FROM {t} WHERE ctid IN (SELECT t.ctid FROM ({table_rows}) t '
+                              'WHERE NOT EXISTS (SELECT 1 FROM ({staged_rows}) s '
+                              'WHERE s.row_text = t.row_text AND s.row_number = t.row_number))'
+                              .format(t=self.title, table_rows=self._numbered(self.title, ('ctid',)),
+                                      staged_rows=self._numbered('(%s) s' % self._select_staged())))
+
+        # existing rows are updated only if they are changed (unchanged ones are not rewritten)
+        if self.key_columns:
+            value_columns = [c for c in self.columns if c not in self.key_columns]
+            excluded = self._row(['EXCLUDED.' + c for c in value_columns])
+
+            statements.append('INSERT INTO {t} ({columns}) {staged} ON CONFLICT ({keys}) DO UPDATE SET '
+                              '{values} = {excluded} WHERE {current} IS DISTINCT FROM {excluded}'
+                              .format(t=self.title, columns=columns, staged=self._select_staged(),
+                                      keys=', '.join(self.key_columns), values=self._row(value_columns),
+                                      excluded=excluded,
+                                      current=self._row(['%s.%s' % (self.title, c) for c in value_columns])))
+
+        # rows are inserted only as many times as they are missing from the table
+        elif sync:
+            statements.append('INSERT INTO {t} ({columns}) SELECT {columns} FROM ({staged_rows}) s '
+                              'WHERE NOT EXISTS (SELECT 1 FROM ({table_rows}) t '
+                              'WHERE t.row_text = s.row_text AND t.row_number = s.row_number)'
+                              .format(t=self.title, columns=columns,
+                                      staged_rows=self._numbered('(%s) s' % self._select_staged(), self.columns),
+                                      table_rows=self._numbered(self.title)))
+
+        else:
+            statements.append('INSERT INTO {t} ({columns}) {staged}'
+                              .format(t=self.title, columns=columns, staged=self._select_staged()))
+
+        return tuple(statements)
+
+    def _get_shadow_statements(self) -> Tuple[str, ...]:
+        """
+        :return: statements, which insert the staged rows into the shadow table (it has no keys, so there are no merges)
+        """
+        return ('INSERT INTO {shadow} ({columns}) {staged}'.format(
+            shadow=self.shadow_title, columns=', '.join(self.columns), staged=self._select_staged()),)
+
+
+class BulkLoader:
+    """
+    Bulk loading of the entities: rows of each type are streamed into a temporary staging table by COPY
+    with the Telegram ids of the users resolved to the local ones by the cache (see UsersIdsCache),
+    then they are merged into the target table by set-based SQL (existing rows are updated, as the stored functions do),
+    all in one transaction.
+    Less than :_copy_min_rows rows (e.g. micro-batches of the live listener) are passed as arrays
+    to one call of the set-based function instead, as the staging table costs more than they do.
+
+    On sync the table is made equal to the loaded rows: the rows are compared with the table contents
+    by the keys (by hash joins of the database), and only the inserted, changed and deleted rows are written.
+
+    Tables, which aren't referenced by the others, can be fully reloaded through shadow tables:
+    rows are loaded into an empty copy of the table without its keys and indexes, which are built afterwards,
+    and then the copy replaces the table by renaming in one transaction.
+    """
+    _tables = {
+        User: BulkTable('users',
+                        ('tg_id', 'first_name', 'last_name', 'username'),
+                        ('INTEGER', 'VARCHAR(250)', 'VARCHAR(250)', 'VARCHAR(250)'),
+                        'insert_users',
+                        attrgetter('uid', 'first_name', 'last_name', 'username'),
+                        key_columns=('tg_id',),
+                        # users are referenced by the tables of all the sources
+                        keep_missing=True),
+
+        Chat: BulkTable('chats',
+                        ('chat_id', 'title', 'members_count', 'messages_count', 'creation_date'),
+                        ('INTEGER', 'VARCHAR(100)', 'INTEGER', 'INTEGER', 'TIMESTAMP'),
+                        'insert_chats',
+                        attrgetter('cid', 'title', 'members_count', 'messages_count', 'creation_date'),
+                        key_columns=('chat_id',)),
+
+        Message: BulkTable('messages',
+                           ('msg_id', 'text', 'date', 'chat_id', 'user_id'),
+                           ('INTEGER', 'VARCHAR(4000)', 'TIMESTAMP', 'INTEGER', 'INTEGER'),
+                           'insert_messages',
+                           attrgetter('msg_id', 'text', 'date', 'chat_id', 'author_id'),
+                           key_columns=('msg_id', 'user_id', 'chat_id'),
+                           # only messages shorter than 500 symbols are stored
+                           condition='char_length(s.text) <= 500'),
+
+        UserInChat: BulkTable('users_in_chats',
+                              ('chat_id', 'user_id', 'entering_diff', 'avg_msg_frequency', 'avg_msg_length'),
+                              ('INTEGER', 'INTEGER', 'FLOAT', 'FLOAT', 'FLOAT'),
+                              'insert_users_in_chats',
+                              attrgetter('chat_id', 'user_id', 'entering_difference', 'avg_msg_frequency',
+                                         'avg_msg_length'),
+                              key_columns=('chat_id', 'user_id')),
+
+        Bot: BulkTable('bots',
+                       ('title', 'members_count'),
+                       ('VARCHAR(50)', 'INTEGER'),
+                       'insert_bots',
+                       attrgetter('title', 'members_count'),
+                       key_columns=('title',)),
+
+        UserInBot: BulkTable('users_in_bots',
+                             ('bot_title', 'user_id', 'lang'),
+                             ('VARCHAR(50)', 'INTEGER', 'VARCHAR(10)'),
+                             'insert_users_in_bots',
+                             attrgetter('bot_title', 'user_id', 'lang'),
+                             key_columns=('bot_title', 'user_id')),
+
+        # orders, clicks and ads don't have natural keys, so they are only inserted
+        FoodOrder: BulkTable('food_orders',
+                             ('user_id', 'food_category', 'food_item', 'quantity', 'order_timestamp'),
+                             ('INTEGER', 'VARCHAR(100)', 'VARCHAR(500)', 'INTEGER', 'TIMESTAMP'),
+                             'insert_food_orders',
+                             attrgetter('user_id', 'food_category', 'food_item', 'quantity', 'timestamp'),
+                             serial_column='order_id'),
+
+        BusClick: BulkTable('buses_clicks',
+                            ('user_id', 'click_timestamp', 'route_id', 'route_start_time', 'shuttle_id'),
+                            ('INTEGER', 'TIMESTAMP', 'VARCHAR(50)', 'TIMESTAMP', 'INTEGER'),
+                            'insert_bus_clicks',
+                            attrgetter('user_id', 'click_timestamp', 'route_id', 'route_start_time', 'shuttle_id'),
+                            serial_column='click_id'),
+
+        PlacedAd: BulkTable('placed_ads',
+                            ('user_id', 'placed_timestamp', 'category_title', 'ad_type', 'views_count',
+                             'likes_count'),
+                            ('INTEGER', 'TIMESTAMP', 'VARCHAR(15)', 'VARCHAR(15)', 'INTEGER', 'INTEGER'),
+                            'insert_placed_ads',
+                            attrgetter('user_id', 'placed_timestamp', 'category_title', 'ad_type', 'views_count',
+                                       'likes_count'),
+                            serial_column='ad_id'),
+    }
+
+    # types of the tables, which aren't referenced by the others (so they can be replaced by the shadow ones)
+    swappable_types = (Message, UserInChat, UserInBot, FoodOrder, BusClick, PlacedAd)
+
+    _copy_min_rows = 1000
+
+    def __init__(self, db: Connection, users_ids: UsersIdsCache):
+        self.db = db
+        self._users_ids = users_ids
+
+        # prepared calls of the set-based functions by their titles
+        self._array_statements = {}
+
+    @classmethod
+    def get_row_getter(cls, entity_type: type):
+        """
+        :return: function, which returns the row of an entity of the type
+        """
+        if entity_type not in cls._tables:
+            raise TypeError('Unknown entity type %s' % str(entity_type))
+
+        return cls._tables[entity_type].row_getter
+
+    @classmethod
+    def references_users(cls, entity_type: type) -> bool:
+        return 'user_id' in cls._tables[entity_type].columns
+
+    @classmethod
+    def get_users_tg_ids(cls, entity_type: type, rows: List[tuple]) -> Set[int]:
+        """
+        :return: Telegram ids of the users referenced by the rows (none, if the table doesn't reference the users)
+        """
+        if not cls.references_users(entity_type):
+            return set()
+
+        user_index = cls._tables[entity_type].columns.index('user_id')
+
+        return {row[user_index] for row in rows if row[user_index] is not None}
+
+    def insert_missing_users(self, tg_ids: Iterable[int]):
+        """
+        Inserts the users, which don't exist yet, by one statement in a transaction of its own and caches their ids,
+        so the loads of the rows, which reference them, don't insert the users (and don't hold their locks)
+        """
+        tg_ids = set(tg_ids)
+        missing_tg_ids = tg_ids.difference(self._users_ids.get(self.db, tg_ids))
+
+        if not missing_tg_ids:
+            return
+
+        with self.db.xact():
+            local_ids = UsersIdsCache.insert_users(self.db, missing_tg_ids)
+
+        self._users_ids.update(local_ids)
+
+    @staticmethod
+    def _copy_value(value: Any) -> str:
+        """
+        Value in the text format of COPY
+        """
+        if value is None:
+            return '\\N'
+
+        if isinstance(value, datetime):
+            return value.isoformat(' ')
+
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    @classmethod
+    def _copy_lines(cls, rows: Iterable[tuple]) -> Generator[bytes, None, None]:
+        for row in rows:
+            yield ('\t'.join([cls._copy_value(value) for value in row]) + '\n').encode('utf-8')
+
+    def _load_arrays(self, table: BulkTable, rows: List[tuple]):
+        if not rows:
+            return
+
+        if table.array_function not in self._array_statements:
+            arguments = ', '.join(['$%d' % (i + 1) for i in range(len(rows[0]))])
+            self._array_statements[table.array_function] = self.db.prepare('SELECT %s(%s)'
+                                                                           % (table.array_function, arguments))
+
+        self._array_statements[table.array_function](*[list(column) for column in zip(*rows)])
+
+    def _resolve_users(self, table: BulkTable, rows: List[tuple]) -> Iterable[tuple]:
+        """
+        Replaces the Telegram ids of the users in the rows by the local ids (see insert_missing_users)
+        :return: resolved rows
+        """
+        if 'user_id' not in table.columns:
+            return rows
+
+        user_index = table.columns.index('user_id')
+        local_ids = self._users_ids.get(self.db, {row[user_index] for row in rows})
+
+        return (row[:user_index] + (local_ids.get(row[user_index]),) + row[user_index + 1:] for row in rows)
+
+    def load_rows(self, entity_type: type, rows: Iterable[tuple], sync: bool = False, shadow: bool = False):
+        """
+        Loads the rows of the entities of the type (in the order of the columns of the table)
+        :param sync: if True - the table is made equal to the rows (see the class description)
+        :param shadow: if True - the rows are loaded into the shadow table (see create_shadow_table)
+        """
+        table = self._tables[entity_type]
+
+        if sync and shadow:
+            raise ValueError('Shadow table of %s can not be synced' % table.title)
+
+        rows = iter(rows)
+
+        # the whole table is compared with the staging one on sync, and the shadow table has no keys for the merges
+        if not sync and not shadow:
+            first_rows = list(islice(rows, self._copy_min_rows))
+
+            if len(first_rows) < self._copy_min_rows:
+                self._load_arrays(table, first_rows)
+                return
+
+            rows = chain(first_rows, rows)
+
+        # the missing users are inserted before the load (they aren't inserted by its long transaction)
+        if self.references_users(entity_type):
+            rows = list(rows)
+            self.insert_missing_users(self.get_users_tg_ids(entity_type, rows))
+
+        with self.db.xact():
+            self.db.execute('CREATE TEMP TABLE %s (%s) ON COMMIT DROP' % (table.staging_title, table.staging_columns))
+
+            self.db.prepare('COPY %s FROM STDIN' % table.staging_title).load_rows(
+                self._copy_lines(self._resolve_users(table, rows)))
+
+            if shadow:
+                statements = table.shadow_statements
+            else:
+                statements = table.sync_statements if sync else table.merge_statements
+
+            for statement in statements:
+                self.db.execute(statement)
+
+    def _get_swappable_table(self, entity_type: type) -> BulkTable:
+        if entity_type not in self.swappable_types:
+            raise ValueError('Table of %s is referenced by the other tables and can not be replaced' % entity_type)
+
+        return self._tables[entity_type]
+
+    def _get_constraints(self, table_title: str) -> List[Tuple[str, str]]:
+        """
+        :return: List[Tuple(name, definition)] of the keys and checks of the table
+        """
+        query = self.db.prepare('SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint '
+                                'WHERE conrelid = $1::text::regclass AND contype IN (\'p\', \'u\', \'f\', \'c\')')
+
+        return query(table_title)
+
+    def _get_indexes(self, table_title: str) -> List[Tuple[str, str]]:
+        """
+        :return: List[Tuple(name, definition)] of the indexes of the table, which don't belong to its constraints
+        """
+        query = self.db.prepare('SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i '
+                                'JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = $1::text::regclass '
+                                'AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)')
+
+        return query(table_title)
+
+    def create_shadow_table(self, entity_type: type):
+        """
+        Creates an empty copy of the table of the type (the shadow table) without its keys and indexes
+        """
+        table = self._get_swappable_table(entity_type)
+
+        with self.db.xact():
+            self.db.execute('DROP TABLE IF EXISTS %s' % table.shadow_title)
+            self.db.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (table.shadow_title, table.title))
+
+    def drop_shadow_table(self, entity_type: type):
+        self.db.execute('DROP TABLE IF EXISTS %s' % self._get_swappable_table(entity_type).shadow_title)
+
+    def build_shadow_indexes(self, entity_type: type):
+        """
+        Builds the keys and indexes of the table on its loaded shadow table (they are named with the '_new' suffix)
+        """
+        table = self._get_swappable_table(entity_type)
+
+        with self.db.xact():
+            # the same rows could be loaded several times (e.g. by different batches)
+            deduplication = table.get_deduplication()
+            if deduplication:
+                self.db.execute(deduplication)
+
+            for name, definition in self._get_constraints(table.title):
+                self.db.execute('ALTER TABLE %s ADD CONSTRAINT %s_new %s' % (table.shadow_title, name, definition))
+
+            for name, definition in self._get_indexes(table.title):
+                self.db.execute(re.sub(r' INDEX \S+ ON (ONLY )?\S+ ',
+                                       ' INDEX %s_new ON %s ' % (name, table.shadow_title), definition, count=1))
+
+            self.db.execute('ANALYZE %s' % table.shadow_title)
+
+    def swap_shadow_tables(self, entity_types: Iterable[type]):
+        """
+        Replaces the tables of the types by their shadow tables in one transaction
+        (readers see either the old tables or the new ones)
+        """
+        with self.db.xact():
+            for entity_type in entity_types:
+                table = self._get_swappable_table(entity_type)
+
+                constraints_names = [name for name, _ in self._get_constraints(table.title)]
+                indexes_names = [name for name, _ in self._get_indexes(table.title)]
+
+                # the sequence of the ids is kept, otherwise it's dropped with the old table
+                if table.serial_column:
+                    sequence = self.db.prepare('SELECT pg_get_serial_sequence($1, $2)').first(table.title,
+                                                                                              table.serial_column)
+                    self.db.execute('ALTER SEQUENCE %s OWNED BY %s.%s'
+                                    % (sequence, table.shadow_title, table.serial_column))
+
+                self.db.execute('DROP TABLE %s' % table.title)
+                self.db.execute('ALTER TABLE %s RENAME TO %s' % (table.shadow_title, table.title))
+
+                for name in constraints_names:
+                    self.db.execute('ALTER TABLE %s RENAME CONSTRAINT %s_new TO %s' % (table.title, name, name))
+
+                for name in indexes_names:
+                    self.db.execute('ALTER INDEX %s_new RENAME TO %s' % (name, name))
+
+
+class ParallelLoader:
+    """
+    Bulk loading of the entities of different types at the same time, each type by its own connection of the pool.
+    Types are loaded by stages in the order of the foreign keys: users, chats and bots go first,
+    then all the types, which reference them.
+    """
+    _stages = ((User, Chat, Bot), (Message, UserInChat, UserInBot, FoodOrder, BusClick, PlacedAd))
+
+    def __init__(self, pool: ConnectionsPool, users_ids: UsersIdsCache):
+        self._pool = pool
+        self._users_ids = users_ids
+
+        # loaders by the connections of the pool
+        self._loaders = {}
+
+        # types, which tables are being reloaded (their entities are loaded into the shadow tables)
+        self._reloaded_types = set()
+
+    def _get_loader(self, db: Connection) -> BulkLoader:
+        if db not in self._loaders:
+            self._loaders[db] = BulkLoader(db, self._users_ids)
+
+        return self._loaders[db]
+
+    def _load(self, entity_type: type, rows: Iterable[tuple], sync: bool):
+        with self._pool.connection() as db:
+            self._get_loader(db).load_rows(entity_type, rows, sync, shadow=entity_type in self._reloaded_types)
+
+    def _insert_missing_users(self, tables_types: Iterable[type], rows_by_types: Dict[type, Iterable[tuple]]):
+        tg_ids = set()
+        for entity_type in tables_types:
+            if entity_type in rows_by_types:
+                tg_ids.update(BulkLoader.get_users_tg_ids(entity_type, rows_by_types[entity_type]))
+
+        if tg_ids:
+            with self._pool.connection() as db:
+                self._get_loader(db).insert_missing_users(tg_ids)
+
+    def _build_shadow_indexes(self, entity_type: type):
+        with self._pool.connection() as db:
+            self._get_loader(db).build_shadow_indexes(entity_type)
+
+    def _drop_shadow_tables(self, tables_types: Iterable[type]):
+        with self._pool.connection() as db:
+            for entity_type in tables_types:
+                self._get_loader(db).drop_shadow_table(entity_type)
+
+    @contextmanager
+    def reloading(self, *tables_types: type):
+        """
+        Full reload of the tables of the given types (only the ones, which aren't referenced by the other tables):
+        entities of these types, which are loaded inside the context, are loaded into the shadow tables,
+        which replace the tables at once on exit (the tables are kept, if an error is raised)
+        """
+        with self._pool.connection() as db:
+            for entity_type in tables_types:
+                self._get_loader(db).create_shadow_table(entity_type)
+
+        self._reloaded_types.update(tables_types)
+
+        try:
+            yield
+
+        except BaseException:
+            self._reloaded_types.difference_update(tables_types)
+            self._drop_shadow_tables(tables_types)
+            raise
+
+        self._reloaded_types.difference_update(tables_types)
+
+        try:
+            # keys and indexes of the tables are built at the same time
+            with ThreadPoolExecutor(max_workers=self._pool.max_connections) as executor:
+                for build in [executor.submit(self._build_shadow_indexes, t) for t in tables_types]:
+                    build.result()
+
+            with self._pool.connection() as db:
+                self._get_loader(db).swap_shadow_tables(tables_types)
+
+        except BaseException:
+            self._drop_shadow_tables(tables_types)
+            raise
+
+    def load_rows(self, rows_by_types: Dict[type, Iterable[tuple]], sync: bool = False):
+        """
+        :param rows_by_types: rows of the entities (see BulkLoader.load_rows) by their types
+        :param sync: if True - the tables of the given types are made equal to the rows
+        """
+        unknown_types = set(rows_by_types.keys()).difference(chain(*self._stages))
+        if unknown_types:
+            raise TypeError('Unknown entities types %s' % str(list(unknown_types)))
+
+        # rows, which reference the users, are read twice: for the missing users and by the load
+        rows_by_types = {entity_type: list(rows) if BulkLoader.references_users(entity_type) else rows
+                         for entity_type, rows in rows_by_types.items()}
+
+        with ThreadPoolExecutor(max_workers=self._pool.max_connections) as executor:
+            for stage in self._stages:
+                # users referenced by the stage are inserted at once (after the ones of the previous stage are loaded),
+                # so the loads running at the same time don't insert them and don't deadlock on them
+                self._insert_missing_users(stage, rows_by_types)
+
+                loads = [executor.submit(self._load, entity_type, rows_by_types[entity_type], sync)
+                         for entity_type in stage if entity_type in rows_by_types]
+
+                # the next stage starts only once the whole stage is loaded
+                for load in loads:
+                    load.result()
+
+    @staticmethod
+    def _get_rows_by_types(entities: Iterable[BaseEntity], types: Iterable[type] = ()) -> Dict[type, Iterable[tuple]]:
+        """
+        :param types: types, which rows are returned even if there are no such entities
+        """
+        entities_by_types = {entity_type: [] for entity_type in types}
+
+        for e in entities:
+            entities_by_types.setdefault(type(e), []).append(e)
+
+        return {entity_type: map(BulkLoader.get_row_getter(entity_type), entities_of_type)
+                for entity_type, entities_of_type in entities_by_types.items()}
+
+    def load_entities(self, entities: Iterable[BaseEntity]):
+        """
+        Loads the entities of any types
+        """
+        self.load_rows(self._get_rows_by_types(entities))
+
+    def sync_entities(self, entities: Iterable[BaseEntity], *tables_types: type):
+        """
+        Makes the tables of the given types equal to the entities
+        """
+        rows_by_types = self._get_rows_by_types(entities, tables_types)
+
+        unexpected_types = set(rows_by_types.keys()).difference(tables_types)
+        if unexpected_types:
+            raise TypeError('Entities of types %s are not synced' % str(list(unexpected_types)))
+
+        self.load_rows(rows_by_types, sync=True)
+
+    def load_chats_rows(self, users: Iterable[tuple], chats: Iterable[tuple], messages: Iterable[tuple],
+                        users_in_chats: Iterable[tuple], sync: bool = False):
+        """
+        Loads the rows of the chats entities (see DataUploader.upload_chats_rows)
+        """
+        self.load_rows({User: users, Chat: chats, Message: messages, UserInChat: users_in_chats}, sync)
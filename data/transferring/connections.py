@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+import postgresql
+from postgresql.api import Connection
+
+
+class ConnectionsPool:
+    """
+    Pool of the connections to a database: connections are opened on demand (at most :max_connections at once)
+    and reused once they are released. Pools are shared by all the uploaders of the same database (see shared).
+    """
+    _shared_pools = {}
+    _shared_pools_lock = Lock()
+
+    def __init__(self, address: str, max_connections: int = 8):
+        self.address = address
+        self.max_connections = max_connections
+
+        self._free = []
+        self._opened_count = 0
+        self._condition = Condition()
+
+    @classmethod
+    def shared(cls, address: str, max_connections: int = 8):
+        """
+        :return: pool of the connections to the database, which is shared by the whole process
+        """
+        with cls._shared_pools_lock:
+            if address not in cls._shared_pools:
+                cls._shared_pools[address] = cls(address, max_connections)
+
+            return cls._shared_pools[address]
+
+    def acquire(self) -> Connection:
+        """
+        :return: free connection (waits for one, if :max_connections are in use)
+        """
+        with self._condition:
+            while not self._free and self._opened_count >= self.max_connections:
+                self._condition.wait()
+
+            if self._free:
+                return self._free.pop()
+
+            self._opened_count += 1
+
+        try:
+            return postgresql.open(self.address)
+
+        except BaseException:
+            self._discard()
+            raise
+
+    def release(self, db: Connection):
+        # closed (e.g. broken) connections are not reused
+        if db.closed:
+            self._discard()
+            return
+
+        with self._condition:
+            self._free.append(db)
+            self._condition.notify()
+
+    def _discard(self):
+        with self._condition:
+            self._opened_count -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+
+        try:
+            yield db
+
+        finally:
+            self.release(db)
+
+    def close(self):
+        """
+        Closes the free connections
+        """
+        with self._condition:
+            for db in self._free:
+                db.close()
+
+            self._opened_count -= len(self._free)
+            self._free.clear()
+            self._condition.notify_all()
@@ -2,7 +2,7 @@ import json
 import re
 from datetime import datetime
 from getpass import getpass
-from typing import Set, List, Any
+from typing import Set, List, Any, Callable
 
 from bson import ObjectId
 from pymongo import MongoClient
@@ -10,9 +10,13 @@ from pymongo.database import Database
 
 from models import ChatsEntities
 from models import UserInBot, Bot, FoodOrder, BusClick, PlacedAd
+from telegram import ChatsListener
 from telegram import SettingsHolder
 from telegram import TgClient
+from telegram import TgClientsPool
+from .pipeline import ChatsPipeline
 from .settings import Settings
+from .uploading import DataUploader
 
 
 class DataParser:
@@ -21,22 +25,106 @@ class DataParser:
     def __init__(self):
         self.mongo_client = MongoClient(Settings.mongo_host, int(Settings.mongo_port))
 
-    @classmethod
-    def get_chat_entities(cls) -> ChatsEntities:
-        # load tg_settings and initialize Telegram client
-        tg_client = TgClient(debug_mode=True, **SettingsHolder(Settings.tg_config_file_path).get_settings_dict())
-
+    @staticmethod
+    def _authorize(tg_client: TgClient):
         if not tg_client.authorized():
-            if not tg_client.enter_code(input('Enter Telegram code: ')):
+            if not tg_client.enter_code(input('Enter Telegram code (%s): ' % tg_client.user_phone)):
                 if not tg_client.enter_password(getpass('Enter Telegram password (two-step verification is enabled')):
                     raise ValueError('Error authorizing in Telegram')
 
-        # read information about
+    @staticmethod
+    def _read_target_chats_titles() -> List[str]:
         with open(Settings.target_chats_file_path, 'r', encoding='utf-8') as f:
-            chats_titles = [title.replace('\n', '') for title in f if not title.startswith('#')]
+            return [title.replace('\n', '') for title in f if not title.startswith('#')]
+
+    @classmethod
+    def get_chat_entities(cls) -> ChatsEntities:
+        # read information about
+        chats_titles = cls._read_target_chats_titles()
+
+        # download information about chats by all the accounts together
+        if Settings.tg_extra_config_files_paths:
+            tg_pool = TgClientsPool([Settings.tg_config_file_path] + Settings.tg_extra_config_files_paths,
+                                    debug_mode=True)
+
+            for tg_client in tg_pool.clients:
+                cls._authorize(tg_client)
+
+            return tg_pool.get_chats_entities(chats_titles, incremental=Settings.tg_incremental_sync)
+
+        # load tg_settings and initialize Telegram client
+        tg_client = TgClient(debug_mode=True, **SettingsHolder(Settings.tg_config_file_path).get_settings_dict())
+        cls._authorize(tg_client)
 
         # download information about chats
-        entities = tg_client.get_chats_entities(chats_titles)
+        entities = tg_client.get_chats_entities(chats_titles,
+                                                concurrent_chats=Settings.tg_concurrent_chats,
+                                                incremental=Settings.tg_incremental_sync)
+
+        return entities
+
+    @classmethod
+    def pipe_chat_entities(cls, uploader: DataUploader):
+        """
+        Downloads information about the target chats and uploads it by the :uploader at the same time
+        """
+        chats_titles = cls._read_target_chats_titles()
+
+        tg_client = TgClient(debug_mode=True, **SettingsHolder(Settings.tg_config_file_path).get_settings_dict())
+        cls._authorize(tg_client)
+
+        pipeline = ChatsPipeline(tg_client, uploader,
+                                 concurrent_chats=Settings.tg_concurrent_chats,
+                                 max_pages=Settings.tg_pipeline_pages,
+                                 max_batches=Settings.tg_pipeline_batches,
+                                 batch_messages=Settings.tg_pipeline_batch_messages)
+
+        pipeline.run(chats_titles, incremental=Settings.tg_incremental_sync)
+
+    @classmethod
+    def listen_chat_entities(cls, on_entities: Callable[[ChatsEntities], Any], duration: float = None):
+        """
+        Receives new messages of the target chats from Telegram in real time (until interrupted),
+        and passes the parsed entities to :on_entities in micro-batches
+        """
+        chats_titles = cls._read_target_chats_titles()
+
+        tg_client = TgClient(debug_mode=True, **SettingsHolder(Settings.tg_config_file_path).get_settings_dict())
+        cls._authorize(tg_client)
+
+        channels = tg_client.find_chats(chats_titles)
+
+        not_found = set(chats_titles).difference(channels.keys())
+        if not_found:
+            raise ValueError('Chats %s not found, exiting.' % str(not_found))
+
+        listener = ChatsListener(tg_client, channels.values(), on_entities,
+                                 flush_interval=Settings.tg_live_flush_interval,
+                                 flush_messages=Settings.tg_live_flush_messages)
+
+        print('Listening to the new messages of %d chats (press Ctrl+C to stop)...' % len(channels))
+        listener.listen(duration)
+
+    @classmethod
+    def get_cached_chat_entities(cls) -> ChatsEntities:
+        """
+        Parses chats entities from the messages caches of the Telegram sessions (without downloading).
+        Each chat is parsed from the cache of the first account, which has it.
+        """
+        chats_titles = set(cls._read_target_chats_titles())
+        entities = ChatsEntities()
+
+        for config_file_path in [Settings.tg_config_file_path] + Settings.tg_extra_config_files_paths:
+            session_name = SettingsHolder(config_file_path).get_settings_dict().get('session_name')
+
+            session_entities = TgClient.get_cached_chats_entities(session_name, list(chats_titles))
+
+            entities.chats.update(session_entities.chats)
+            entities.users.update(session_entities.users)
+            entities.messages.update(session_entities.messages)
+            entities.users_in_chats.update(session_entities.users_in_chats)
+
+            chats_titles.difference_update(chat.title for chat in session_entities.chats)
 
         return entities
 
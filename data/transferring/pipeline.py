@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Full, Empty
+from threading import Event
+from typing import List
+
+from models import ChatsEntities, Message, UserInChat
+from telegram import TgClient
+from .uploading import DataUploader
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class ChatsPipeline:
+    """
+    Downloading, parsing and uploading of the chats at the same time:
+    pages of messages flow from the downloads of the chats to the parser, and parsed entities flow
+    from the parser to the uploader through bounded queues.
+
+    A stage, which is ahead, waits for the next one (e.g. downloads are paused while the database is behind),
+    so at most :max_pages pages of raw messages and :max_batches batches of parsed entities
+    (each of about :batch_messages messages) are kept in memory at once, besides the users statistics.
+    """
+    # end of the stream of pages or entities
+    _end = None
+
+    # how often (in seconds) a waiting stage checks whether the others have failed
+    _poll_interval = 0.5
+
+    def __init__(self, client: TgClient, uploader: DataUploader, concurrent_chats: int = 1,
+                 max_pages: int = 64, max_batches: int = 4, batch_messages: int = 10000):
+        self._client = client
+        self._uploader = uploader
+        self._concurrent_chats = concurrent_chats
+        self._batch_messages = batch_messages
+
+        self._pages = Queue(maxsize=max_pages)
+        self._batches = Queue(maxsize=max_batches)
+
+        # set once any of the stages has failed, so the others don't wait forever
+        self._stopped = Event()
+
+    def _put(self, queue: Queue, item):
+        while True:
+            if self._stopped.is_set():
+                raise PipelineStopped()
+
+            try:
+                queue.put(item, timeout=self._poll_interval)
+                return
+
+            except Full:
+                pass
+
+    def _get(self, queue: Queue):
+        while True:
+            if self._stopped.is_set():
+                raise PipelineStopped()
+
+            try:
+                return queue.get(timeout=self._poll_interval)
+
+            except Empty:
+                pass
+
+    def _download(self, chat):
+        try:
+            for messages_count, history, senders in self._client.iter_chat_pages(chat):
+                self._put(self._pages, (chat, messages_count, history, senders))
+
+            # no pages of the chat will come anymore
+            self._put(self._pages, (chat, messages_count, None, None))
+
+        except BaseException:
+            # the other downloads are stopped at once, not when the result of this one is waited for
+            self._stopped.set()
+            raise
+
+    def _download_all(self, chats: List):
+        try:
+            with ThreadPoolExecutor(max_workers=self._concurrent_chats) as executor:
+                downloads = [executor.submit(self._download, chat) for chat in chats]
+
+                for download in as_completed(downloads):
+                    if download.exception():
+                        # the downloads, which haven't started yet, are not started at all
+                        for pending_download in downloads:
+                            pending_download.cancel()
+                        break
+
+            # the error, which has stopped the downloads, is raised (not the ones it has caused in the others)
+            errors = [d.exception() for d in downloads if not d.cancelled() and d.exception()]
+            errors.sort(key=lambda e: isinstance(e, PipelineStopped))
+            if errors:
+                raise errors[0]
+
+            self._put(self._pages, self._end)
+
+        except BaseException:
+            self._stopped.set()
+            raise
+
+    def _parse(self):
+        parsers = {}
+
+        try:
+            while True:
+                page = self._get(self._pages)
+
+                if page is self._end:
+                    break
+
+                chat, messages_count, history, senders = page
+
+                if chat.id not in parsers:
+                    parsers[chat.id] = self._client.get_history_parser(chat)
+
+                history_parser, entities = parsers[chat.id], ChatsEntities()
+
+                # the chat is downloaded: the rest of the entities and users_in_chat ones are uploaded
+                if history is None:
+                    self._client.add_chat_entities(entities, messages_count, parsers.pop(chat.id))
+                    self._put(self._batches, entities)
+
+                    continue
+
+                history_parser.add_page(history, senders)
+
+                if len(history_parser.messages) >= self._batch_messages:
+                    history_parser.pop_entities(entities, messages_count)
+                    self._put(self._batches, entities)
+
+            self._put(self._batches, self._end)
+
+        except BaseException:
+            self._stopped.set()
+            raise
+
+    def _upload(self):
+        try:
+            while True:
+                entities = self._get(self._batches)
+
+                if entities is self._end:
+                    break
+
+                self._uploader.upload_chats_entities(entities)
+
+        except BaseException:
+            self._stopped.set()
+            raise
+
+    def run(self, chats_names: List[str], incremental: bool = True):
+        """
+        Downloads, parses and uploads the chats with the given titles.
+        :param incremental: see TgClient.get_chats_entities; if False - the messages and users in chats are replaced
+            by the downloaded ones at once, once all the chats are uploaded
+        """
+        self._client.start_sync(incremental)
+
+        channels = self._client.find_chats(chats_names)
+
+        # if some chats not found
+        not_found = set(chats_names).difference(channels.keys())
+        if not_found:
+            raise ValueError('Chats %s not found, exiting.' % str(not_found))
+        else:
+            print('Found all the %d chats.\nMessages and users gathering started.' % len(channels))
+
+        # messages and users in chats are fully reloaded through the shadow tables (chats and users are updated)
+        reloaded_types = [Message, UserInChat] if not incremental else []
+
+        with self._uploader.reloading(*reloaded_types):
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                stages = [executor.submit(self._download_all, list(channels.values())),
+                          executor.submit(self._parse),
+                          executor.submit(self._upload)]
+
+                errors = [stage.exception() for stage in stages]
+
+            # the error, which has stopped the pipeline, is raised (not the ones it has caused in the other stages)
+            errors = [e for e in errors if e and not isinstance(e, PipelineStopped)]
+            if errors:
+                raise errors[0]
+
+        # the next run starts from the uploaded messages (otherwise the interrupted downloads are resumed)
+        self._client.complete_sync(channels.values())
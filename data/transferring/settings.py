@@ -6,6 +6,30 @@ class Settings:
     target_chats_file_path = os.path.join(os.path.dirname(__file__), 'raw_data/target_chats')
     tg_config_file_path = os.path.join(os.path.dirname(__file__), 'raw_data/tg_config')
 
+    # configs of the additional Telegram accounts: if any - chats are downloaded by all the accounts together
+    tg_extra_config_files_paths = []
+
+    # how many chats can be downloaded from Telegram at the same time (by a single account)
+    tg_concurrent_chats = 4
+
+    # download only messages newer than the ones downloaded by the previous run
+    tg_incremental_sync = True
+
+    # download, parse and upload the chats at the same time (only if a single account is used)
+    tg_pipeline = True
+
+    # memory of the pipeline is bounded by pages of raw messages and batches of parsed entities in flight
+    tg_pipeline_pages = 64
+    tg_pipeline_batches = 4
+    tg_pipeline_batch_messages = 10000
+
+    # real-time mode: received messages are uploaded every N seconds, or once M messages have been received
+    tg_live_flush_interval = 10.
+    tg_live_flush_messages = 1000
+
+    # how many connections to Postgres can be opened at the same time (tables are uploaded by them in parallel)
+    postgres_max_connections = 8
+
     # Mongo settings to connect
     mongo_host = 'localhost'
     mongo_port = 27017
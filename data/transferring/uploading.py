@@ -1,11 +1,14 @@
-from typing import List, Union, Any, Generator, Iterable
+from typing import List, Union, Any, Generator, Iterable, Dict, Tuple
 
-import postgresql
 from postgresql.exceptions import Error
 
 from models import UserPrediction
 from models import User, Chat, Message, ChatsEntities, Bot, UserInBot, FoodOrder, BusClick, PlacedAd, BaseEntity
 from models import UserInChat
+from .bulk_loading import ParallelLoader
+from .connections import ConnectionsPool
+from .settings import Settings
+from .users_ids import UsersIdsCache
 
 postgres_db_address = 'pq://postgres:postgres@localhost:5432/Telegram Data'
 
@@ -13,28 +16,73 @@ postgres_db_address = 'pq://postgres:postgres@localhost:5432/Telegram Data'
 # TODO: change format
 # TODO: change SQL schema
 class DataUploader:
-    def __init__(self):
-        self.db = postgresql.open(postgres_db_address)
-
-        self._insert_user = self.db.prepare('SELECT * FROM insert_user($1, $2, $3, $4)')
+    def __init__(self, pool: ConnectionsPool = None):
+        """
+        :param pool: pool of the connections to the database (the one shared by the process by default)
+        """
+        self._pool = pool or ConnectionsPool.shared(postgres_db_address, Settings.postgres_max_connections)
+
+        # connection of the uploader (prepared statements belong to it), tables are bulk loaded by the other ones
+        self.db = self._pool.acquire()
+
+        # local ids of the users by their Telegram ids, so the rows, which reference the users, are written
+        # with the local ids already resolved (instead of looking them up by the stored functions for each row)
+        self._users_ids = UsersIdsCache()
+
+        self._insert_user = self.db.prepare('INSERT INTO users(tg_id, first_name, last_name, username) '
+                                            'VALUES ($1, $2, $3, $4) '
+                                            'ON CONFLICT (tg_id) DO UPDATE SET (first_name, last_name, username) = '
+                                            '(EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.username) '
+                                            'WHERE (users.first_name, users.last_name, users.username) '
+                                            'IS DISTINCT FROM '
+                                            '(EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.username) '
+                                            'RETURNING local_id')
         self._insert_chat = self.db.prepare('INSERT INTO '
                                             'chats(chat_id, title, members_count, messages_count, creation_date) '
-                                            'VALUES ($1, $2, $3, $4, $5)')
-        self._insert_user_in_chat = self.db.prepare('SELECT * FROM insert_user_in_chat($1, $2, $3, $4, $5)')
-        self._insert_message = self.db.prepare('SELECT * FROM insert_message($1, $2, $3, $4, $5)')
+                                            'VALUES ($1, $2, $3, $4, $5) '
+                                            'ON CONFLICT (chat_id) DO UPDATE SET '
+                                            '(title, members_count, messages_count, creation_date) = '
+                                            '(EXCLUDED.title, EXCLUDED.members_count, '
+                                            'EXCLUDED.messages_count, EXCLUDED.creation_date)')
+        self._insert_user_in_chat = self.db.prepare('INSERT INTO '
+                                                    'users_in_chats(chat_id, user_id, entering_diff, '
+                                                    'avg_msg_frequency, avg_msg_length) '
+                                                    'VALUES ($1, $2, $3, $4, $5) '
+                                                    'ON CONFLICT (chat_id, user_id) DO UPDATE SET '
+                                                    '(entering_diff, avg_msg_frequency, avg_msg_length) = '
+                                                    '(EXCLUDED.entering_diff, EXCLUDED.avg_msg_frequency, '
+                                                    'EXCLUDED.avg_msg_length)')
+        self._insert_message = self.db.prepare('INSERT INTO messages(msg_id, text, date, chat_id, user_id) '
+                                               'VALUES ($1, $2, $3, $4, $5) '
+                                               'ON CONFLICT (msg_id, user_id, chat_id) DO UPDATE SET '
+                                               '(text, date) = (EXCLUDED.text, EXCLUDED.date)')
 
         self._insert_bot = self.db.prepare('INSERT INTO bots(title, members_count) VALUES ($1, $2)')
-        self._insert_user_in_bot = self.db.prepare('SELECT * FROM insert_user_in_bot($1, $2, $3)')
-
-        self._insert_food_order = self.db.prepare('SELECT * FROM insert_food_order($1, $2, $3, $4, $5)')
-        self._insert_bus_click = self.db.prepare('SELECT * FROM insert_bus_click($1, $2, $3, $4, $5)')
-        self._insert_placed_ad = self.db.prepare('SELECT * FROM insert_placed_ad($1, $2, $3, $4, $5, $6)')
+        self._insert_user_in_bot = self.db.prepare('INSERT INTO users_in_bots(bot_title, user_id, lang) '
+                                                   'VALUES ($1, $2, $3) '
+                                                   'ON CONFLICT (bot_title, user_id) DO UPDATE SET '
+                                                   'lang = EXCLUDED.lang')
+
+        self._insert_food_order = self.db.prepare('INSERT INTO '
+                                                  'food_orders(user_id, food_category, food_item, quantity, '
+                                                  'order_timestamp) '
+                                                  'VALUES ($1, $2, $3, $4, $5)')
+        self._insert_bus_click = self.db.prepare('INSERT INTO '
+                                                 'buses_clicks(user_id, click_timestamp, route_id, route_start_time, '
+                                                 'shuttle_id) '
+                                                 'VALUES ($1, $2, $3, $4, $5)')
+        self._insert_placed_ad = self.db.prepare('INSERT INTO '
+                                                 'placed_ads(user_id, placed_timestamp, category_title, ad_type, '
+                                                 'views_count, likes_count) '
+                                                 'VALUES ($1, $2, $3, $4, $5, $6)')
 
         self._insert_user_gender = self.db.prepare('INSERT INTO users_genders VALUES ($1, $2)')
         self._insert_predicted_gender = self.db.prepare('INSERT INTO predicted_genders VALUES ($1, $2, $3)')
 
+        self._bulk_loader = ParallelLoader(self._pool, self._users_ids)
+
     def __del__(self):
-        self.db.close()
+        self._pool.release(self.db)
 
     def insert_entity(self, e: BaseEntity):
         try:
@@ -72,71 +120,140 @@ class DataUploader:
             print(e)
             raise Error('Error inserting entity %s' % str(type(e)))
 
+    def _get_local_user_id(self, tg_id: int) -> Union[int, None]:
+        """
+        :return: local id of the user by the Telegram id (the user is inserted, if it doesn't exist yet)
+        """
+        if tg_id is None:
+            return None
+
+        local_ids = self._users_ids.get(self.db, (tg_id,))
+
+        if tg_id not in local_ids:
+            local_ids = UsersIdsCache.insert_users(self.db, (tg_id,))
+            self._users_ids.update(local_ids)
+
+        return local_ids[tg_id]
+
     def insert_user(self, user: User):
-        self._insert_user(user.uid, user.first_name, user.last_name, user.username)
+        # local id is returned only if the user is inserted or changed
+        for local_id, in self._insert_user(user.uid, user.first_name, user.last_name, user.username):
+            self._users_ids.update({user.uid: local_id})
 
     def insert_chat(self, chat: Chat):
         self._insert_chat(chat.cid, chat.title, chat.members_count, chat.messages_count, chat.creation_date)
 
     def insert_users_in_chat(self, users_in_chats: List[UserInChat]):
         for entry in users_in_chats:
-            self._insert_user_in_chat(entry.chat_id, entry.user_id,
+            if entry.user_id is None:
+                continue
+
+            self._insert_user_in_chat(entry.chat_id, self._get_local_user_id(entry.user_id),
                                       entry.entering_difference, entry.avg_msg_frequency, entry.avg_msg_length)
 
     def insert_message(self, msg: Message):
-        self._insert_message(msg.msg_id, msg.text, msg.date, msg.chat_id, msg.author_id)
+        # only messages shorter than 500 symbols are stored
+        if msg.text is None or len(msg.text) > 500 or msg.author_id is None:
+            return
+
+        self._insert_message(msg.msg_id, msg.text, msg.date, msg.chat_id, self._get_local_user_id(msg.author_id))
 
     def insert_bot(self, bot: Bot):
         self._insert_bot(bot.title, bot.members_count)
 
     def insert_user_in_bot(self, user_in_bot: UserInBot):
-        self._insert_user_in_bot(user_in_bot.bot_title, user_in_bot.user_id, user_in_bot.lang)
+        if user_in_bot.user_id is None:
+            return
+
+        self._insert_user_in_bot(user_in_bot.bot_title, self._get_local_user_id(user_in_bot.user_id),
+                                 user_in_bot.lang)
 
     def insert_food_order(self, food_order: FoodOrder):
-        self._insert_food_order(food_order.user_id,
+        self._insert_food_order(self._get_local_user_id(food_order.user_id),
                                 food_order.food_category, food_order.food_item, food_order.quantity,
                                 food_order.timestamp)
 
     def insert_bus_click(self, bus_click: BusClick):
-        self._insert_bus_click(bus_click.user_id,
+        self._insert_bus_click(self._get_local_user_id(bus_click.user_id),
                                bus_click.click_timestamp,
                                bus_click.route_id, bus_click.route_start_time,
                                bus_click.shuttle_id)
 
     def insert_placed_ad(self, placed_ad: PlacedAd):
-        self._insert_placed_ad(placed_ad.user_id,
+        self._insert_placed_ad(self._get_local_user_id(placed_ad.user_id),
                                placed_ad.placed_timestamp,
                                placed_ad.category_title, placed_ad.ad_type,
                                placed_ad.views_count, placed_ad.likes_count)
 
+    @staticmethod
+    def _get_chats_rows(entities: ChatsEntities) -> Tuple[Iterable[tuple], Iterable[tuple], Iterable[tuple],
+                                                          Iterable[tuple]]:
+        """
+        :return: rows of users, chats, messages and users in chats (see upload_chats_rows)
+        """
+        return (((u.uid, u.first_name, u.last_name, u.username) for u in entities.users),
+                ((c.cid, c.title, c.members_count, c.messages_count, c.creation_date) for c in entities.chats),
+                ((m.msg_id, m.text, m.date, m.chat_id, m.author_id) for m in entities.messages),
+                ((e.chat_id, e.user_id, e.entering_difference, e.avg_msg_frequency, e.avg_msg_length)
+                 for e in entities.users_in_chats))
+
     def upload_chats_entities(self, entities: ChatsEntities):
+        self.upload_chats_rows(*self._get_chats_rows(entities))
+
+    def upload_chats_rows(self, users: Iterable[tuple], chats: Iterable[tuple], messages: Iterable[tuple],
+                          users_in_chats: Iterable[tuple], sync: bool = False):
+        """
+        Uploads chats entities given as rows (e.g. by ColumnarChatsEntities.to_rows):
+        users (uid, first_name, last_name, username),
+        chats (cid, title, members_count, messages_count, creation_date),
+        messages (msg_id, text, date, chat_id, author_id) and
+        users in chats (chat_id, user_id, entering_difference, avg_msg_frequency, avg_msg_length)
+        :param sync: if True - chats, messages and users in chats, which are missing from the rows, are deleted
+            (see sync_entities)
+        """
         try:
-            with self.db.xact():
-                # insert users
-                users = entities.users
-                for u in users:
-                    self.insert_user(u)
+            self._bulk_loader.load_chats_rows(users, chats, messages, users_in_chats, sync)
 
-            with self.db.xact():
-                # insert chats and users in chats
-                chats = entities.chats
-                for c in chats:
-                    self.insert_chat(c)
+        except Error as e:
+            print(e)
+            raise Exception('Error uploading chats entities')
 
-            with self.db.xact():
-                # insert messages
-                messages = entities.messages
-                for m in messages:
-                    self.insert_message(m)
+    def sync_chats_entities(self, entities: ChatsEntities):
+        """
+        Makes the chats tables equal to the entities (instead of clearing them and uploading the entities)
+        """
+        self.upload_chats_rows(*self._get_chats_rows(entities), sync=True)
 
-            with self.db.xact():
-                # insert users in chats
-                users_in_chats = entities.users_in_chats
-                self.insert_users_in_chat(users_in_chats)
+    def upload_entities(self, entities: Iterable[BaseEntity]):
+        """
+        Uploads the entities of any types by the bulk loader (instead of inserting them one by one)
+        """
+        try:
+            self._bulk_loader.load_entities(entities)
+
+        except Error as e:
+            print(e)
+            raise Exception('Error uploading entities')
+
+    def sync_entities(self, entities: Iterable[BaseEntity], *tables_types):
+        """
+        Makes the tables of the given types equal to the entities: only the inserted, changed and deleted rows
+        are written (instead of clearing the tables and uploading all the entities)
+        """
+        try:
+            self._bulk_loader.sync_entities(entities, *tables_types)
 
         except Error as e:
             print(e)
-            raise Exception('Error uploading chats entities %s' % str(entities))
+            raise Exception('Error syncing entities')
+
+    def reloading(self, *tables_types):
+        """
+        Context of the full reload of the tables of the given types (the ones, which aren't referenced by the others):
+        entities of these types uploaded inside it are loaded into the shadow tables without indexes,
+        which replace the tables at once on exit. Readers see the old tables until then (not the partially loaded ones).
+        """
+        return self._bulk_loader.reloading(*tables_types)
 
     @staticmethod
     def _table_title_by_type(entity_type: BaseEntity):
@@ -184,19 +301,97 @@ class DataUploader:
             print(e)
             raise Exception('Error clearing table %s' % table_title)
 
+        if User in tables_types:
+            self._users_ids.clear()
+
+    def _iter_chunks(self, table_title: str, columns: Iterable[str] = None, where: str = None,
+                     fetch_size: int = 10000) -> Generator[List[tuple], None, None]:
+        """
+        Streams the rows of "SELECT {columns} FROM table_title WHERE {where}" by a server-side cursor
+        in chunks of :fetch_size rows (by a separate connection of the pool, so the uploader can be used meanwhile)
+        """
+        q_text = 'SELECT {columns} FROM {table_title}'.format(columns=', '.join(columns) if columns else '*',
+                                                              table_title=table_title)
+
+        if where:
+            q_text += ' WHERE {where}'.format(where=where)
+
+        with self._pool.connection() as db:
+            with db.xact():
+                cursor = db.prepare(q_text).declare()
+
+                while True:
+                    rows = cursor.read(fetch_size)
+                    if not rows:
+                        break
+
+                    yield rows
+
+    def iter_rows(self, table_title: str, columns: Iterable[str] = None, where: str = None,
+                  fetch_size: int = 10000) -> Generator[tuple, None, None]:
+        """
+        Streams raw tuples of the rows (no entities are built), so the memory doesn't depend on the size of the table.
+        :param columns: selected columns (all of them by default)
+        :param fetch_size: how many rows are fetched from the server at once
+        """
+        for rows in self._iter_chunks(table_title, columns, where, fetch_size):
+            yield from rows
+
+    # noinspection PyPep8Naming
+    def iter_entities(self, table_title, schema, Type, where=None, columns=None,
+                      fetch_size: int = 10000) -> Generator[Any, None, None]:
+        """
+        Streams entities of Type, mapped to the given schema (names of the fields in the order of the selected columns)
+        """
+        for t in self.iter_rows(table_title, columns, where, fetch_size):
+            yield Type(**dict(zip(schema, t)))
+
     # noinspection PyPep8Naming
     def get_entities(self, table_title, schema, Type, where=None) -> Iterable[Any]:
         """
         Query "SELECT * FROM table_title WHERE {filter}" and return entities of Type, mapped to the given schema
         """
-        q_text = 'SELECT * FROM {table_title}'.format(table_title=table_title)
+        return list(self.iter_entities(table_title, schema, Type, where))
 
-        if where:
-            q_text += ' WHERE {where}'.format(where=where)
+    def get_columns(self, table_title: str, columns: List[str], where: str = None, fetch_size: int = 10000,
+                    dtypes: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Reads the selected columns as numpy arrays (numpy is required), no objects are built for the rows.
+        :param dtypes: dtypes of the arrays by the columns (inferred by numpy by default)
+        :return: Dict[column, numpy array of its values]
+        """
+        # numpy is needed only here, so the uploader doesn't depend on it
+        import numpy as np
 
-        tuples = self.db.query(q_text)
+        dtypes = dtypes or {}
+        chunks = {column: [] for column in columns}
 
-        return [Type(**dict(zip(schema, t))) for t in tuples]
+        for rows in self._iter_chunks(table_title, columns, where, fetch_size):
+            for column, values in zip(columns, zip(*rows)):
+                chunks[column].append(np.array(values, dtype=dtypes.get(column)))
+
+        return {column: np.concatenate(arrays) if arrays else np.array([], dtype=dtypes.get(column))
+                for column, arrays in chunks.items()}
+
+    def get_columnar_chats_entities(self, with_messages: bool = True) -> Any:
+        """
+        Reads the chats tables into ColumnarChatsEntities (numpy is required), no entities are built for the rows.
+        Users are identified by their local ids (as by get_users).
+        :param with_messages: if False - the messages aren't read (the table of them is empty)
+        """
+        # numpy is needed only here, so the uploader doesn't depend on it
+        from models.columnar import ColumnarChatsEntities, ChatsTable, UsersTable, MessagesTable, UsersInChatsTable
+
+        messages = (self.iter_rows('messages', ('msg_id', 'text', 'date', 'user_id', 'chat_id'))
+                    if with_messages else [])
+
+        return ColumnarChatsEntities(
+            ChatsTable.from_rows(self.iter_rows('chats', ('chat_id', 'title', 'members_count', 'messages_count',
+                                                          'creation_date'))),
+            UsersTable.from_rows(self.iter_rows('users', ('local_id', 'first_name', 'last_name', 'username'))),
+            MessagesTable.from_rows(messages),
+            UsersInChatsTable.from_rows(self.iter_rows('users_in_chats', ('chat_id', 'user_id', 'entering_diff',
+                                                                          'avg_msg_frequency', 'avg_msg_length'))))
 
     def get_users_in_chats(self):
         schema = 'chat_id', 'user_id', 'entering_difference', 'avg_msg_frequency', 'avg_msg_length'
@@ -242,19 +437,26 @@ class DataUploader:
         """
         If uid is specified - returns messages only of the user with this id, otherwise - all the messages.
         """
+        return list(self.iter_messages(uid))
+
+    def iter_messages(self, uid=None, fetch_size: int = 10000) -> Generator[Message, None, None]:
+        """
+        Streams messages (see get_messages)
+        """
         schema = 'msg_id', 'text', 'date', 'chat_id', 'author_id'
 
         if uid:
-            return self.get_entities('messages', schema, Message, where='user_id={uid}'.format(uid=uid))
+            return self.iter_entities('messages', schema, Message, where='user_id={uid}'.format(uid=uid),
+                                      fetch_size=fetch_size)
 
-        return self.get_entities('messages', schema, Message)
+        return self.iter_entities('messages', schema, Message, fetch_size=fetch_size)
 
     def upload_users_genders(self):
         self.db.execute('DELETE FROM users_genders *;')
-        users = self.get_users()
+        users_genders = User.get_genders(self.get_users())
 
-        for user in users:
-            self._insert_user_gender(user.uid, user.get_gender())
+        for user_id, gender in users_genders.items():
+            self._insert_user_gender(user_id, gender)
 
     def get_users_genders(self):
         """
@@ -0,0 +1,60 @@
+from threading import Lock
+from typing import Iterable, Dict
+
+from postgresql.api import Connection
+
+
+class UsersIdsCache:
+    """
+    Local ids of the users by their Telegram ids (the tables reference the users by the local ids).
+    All the ids are preloaded by one query on the first use, then the cache is filled in as the users are inserted,
+    so the rows, which reference the users, are written with the local ids already resolved.
+    """
+
+    def __init__(self):
+        self._local_ids = None
+        self._lock = Lock()
+
+    def get(self, db: Connection, tg_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        :return: local ids of the cached users among the given ones
+        """
+        with self._lock:
+            if self._local_ids is None:
+                self._local_ids = dict(db.prepare('SELECT tg_id, local_id FROM users')())
+
+            return {tg_id: self._local_ids[tg_id] for tg_id in tg_ids if tg_id in self._local_ids}
+
+    def update(self, local_ids: Dict[int, int]):
+        with self._lock:
+            if self._local_ids is not None:
+                self._local_ids.update(local_ids)
+
+    def clear(self):
+        """
+        Drops the cached ids (e.g. once the users are deleted), they are preloaded again on the next use
+        """
+        with self._lock:
+            self._local_ids = None
+
+    @staticmethod
+    def insert_users(db: Connection, tg_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Inserts the users, which don't exist yet (only their Telegram ids are known).
+        The ids aren't cached here, as the transaction of :db can still be rolled back.
+        :return: local ids of all the given users
+        """
+        # in the order of the ids, so uploads running at the same time don't deadlock
+        tg_ids = sorted(tg_ids)
+
+        local_ids = dict(db.prepare('INSERT INTO users (tg_id) SELECT unnest($1::INTEGER[]) ORDER BY 1 '
+                                    'ON CONFLICT (tg_id) DO NOTHING RETURNING tg_id, local_id')(tg_ids))
+
+        # the ones, which have been inserted meanwhile
+        existing_tg_ids = [tg_id for tg_id in tg_ids if tg_id not in local_ids]
+
+        if existing_tg_ids:
+            local_ids.update(db.prepare('SELECT tg_id, local_id FROM users '
+                                        'WHERE tg_id = ANY($1::INTEGER[])')(existing_tg_ids))
+
+        return local_ids
@@ -1,3 +1,4 @@
 from .base_entities import *
 from .complex_entitites import UserInChat, ChatsEntities
+from .entities_file import ChatsEntitiesFile
 from .prediction import UserSample, FeaturesFromChat, FeaturesFromBot, UserClass, UserPrediction
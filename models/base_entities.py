@@ -3,15 +3,53 @@ import pickle
 import re
 from abc import abstractmethod
 from datetime import datetime
-from typing import List
+from functools import lru_cache
+from operator import attrgetter
+from typing import List, Iterable, Dict
 
 __all__ = ["BaseEntity", "User", "Chat", "Message", "Bot", "UserInBot", "FoodOrder", "BusClick", "PlacedAd"]
 
 
 class BaseEntity:
+    """
+    Entities declare their fields in __slots__ (so they don't have a dict of attributes);
+    the ones, which don't declare them, have a dict as usual.
+    Constructors of the entities with slots assign the fields themselves (this constructor is not called by them).
+    """
+    __slots__ = ()
 
     def __init__(self, **kwargs):
-        self.__dict__ = kwargs
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __getstate__(self):
+        # entities with slots are pickled as tuples of the values of the fields
+        return self._values() if self.__slots__ else self.__dict__
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # getter of the values of all the fields of the entities, which have slots
+        if cls.__slots__:
+            cls._get_values = staticmethod(attrgetter(*cls.__slots__))
+
+    def __setstate__(self, state):
+        if not self.__slots__:
+            self.__dict__.update(state)
+            return
+
+        # entities pickled by the older versions have a dict of the attributes (some of them may be missed)
+        if isinstance(state, dict):
+            state = [state.get(name) for name in self.__slots__]
+
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def _values(self) -> tuple:
+        """
+        Values of the fields of the entity (in the order of the slots)
+        """
+        return self._get_values(self)
 
     # TODO: add try/except
     def serialize(self):
@@ -19,7 +57,7 @@ class BaseEntity:
         # return self.__dict__
 
     def deserialize(self, _json):
-        self.__dict__ = pickle.loads(_json).__dict__
+        self.__setstate__(pickle.loads(_json).__getstate__())
         # self.__dict__ = _json
 
     def from_file(self, filename):
@@ -28,7 +66,8 @@ class BaseEntity:
         #         open(filename, 'r', encoding='utf-8')
         #     )
         # )
-        self.__dict__ = pickle.load(open(filename, 'rb')).__dict__
+        with open(filename, 'rb') as f:
+            self.__setstate__(pickle.load(f).__getstate__())
 
     def to_file(self, filename):
         # with open(filename, 'w', encoding='utf-8') as f:
@@ -48,6 +87,13 @@ class NamesLoader:
     _names_path = os.path.join(os.path.dirname(__file__), 'names')
     _m_filepath, _f_filepath = os.path.join(_names_path, 'males.txt'), os.path.join(_names_path, 'females.txt')
 
+    # names compiled from the files: Tuple(signature of the files, males' names, females' names)
+    _compiled_filepath = os.path.join(_names_path, 'names.compiled')
+
+    # names loaded by this process (on the first use)
+    _m_f_names = None
+    _names_genders = None
+
     @classmethod
     def _update_names(cls, m, f):
         # remove duplicates
@@ -56,16 +102,74 @@ class NamesLoader:
         # return sorted
         return sorted(m), sorted(f)
 
+    @staticmethod
+    def _read_names(file_path: str) -> List[str]:
+        with open(file_path, encoding='utf-8') as f:
+            return [name.replace('\n', '').lower().replace('ё', 'е') for name in f if name]
+
+    @classmethod
+    def _get_files_signature(cls) -> tuple:
+        """
+        Modification times and sizes of the names files (the compiled names are rebuilt once they are changed)
+        """
+        files_stats = [os.stat(file_path) for file_path in (cls._m_filepath, cls._f_filepath)]
+
+        return tuple((stat.st_mtime_ns, stat.st_size) for stat in files_stats)
+
+    @classmethod
+    def _load_compiled(cls, files_signature: tuple):
+        try:
+            with open(cls._compiled_filepath, 'rb') as f:
+                compiled_signature, m_names, f_names = pickle.load(f)
+
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+
+        return (m_names, f_names) if compiled_signature == files_signature else None
+
+    @classmethod
+    def _save_compiled(cls, files_signature: tuple, m_names: List[str], f_names: List[str]):
+        tmp_filepath = '%s.%d.tmp' % (cls._compiled_filepath, os.getpid())
+
+        try:
+            with open(tmp_filepath, 'wb') as f:
+                pickle.dump((files_signature, m_names, f_names), f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_filepath, cls._compiled_filepath)
+
+        # the names are compiled again by the next process
+        except OSError as e:
+            print('Warning: names are not compiled (%s)' % str(e))
+
     @classmethod
     def get_m_f_names(cls):
-        with open(cls._m_filepath, encoding='utf-8') as f:
-            male_names = [name.replace('\n', '').lower().replace('ё', 'е') for name in f if name]
+        """
+        Males' and females' names (lowercase, sorted and without duplicates), loaded once by the first use.
+        They are compiled from the names files, and the compiled ones are used until the files are changed.
+        """
+        if cls._m_f_names is None:
+            files_signature = cls._get_files_signature()
+            m_f_names = cls._load_compiled(files_signature)
 
-        with open(cls._f_filepath, encoding='utf-8') as f:
-            female_names = [name.replace('\n', '').lower().replace('ё', 'е') for name in f if name]
+            if m_f_names is None:
+                m_f_names = cls._update_names(cls._read_names(cls._m_filepath), cls._read_names(cls._f_filepath))
+                cls._save_compiled(files_signature, *m_f_names)
 
-        # return updated
-        return cls.update_and_save(male_names, female_names)
+            cls._m_f_names = m_f_names
+
+        return cls._m_f_names
+
+    @classmethod
+    def get_names_genders(cls) -> Dict[str, str]:
+        """
+        Index of the names: Dict[name, gender] (males' names take precedence)
+        """
+        if cls._names_genders is None:
+            m_names, f_names = cls.get_m_f_names()
+
+            cls._names_genders = dict([(name, 'f') for name in f_names] + [(name, 'm') for name in m_names])
+
+        return cls._names_genders
 
     @classmethod
     def update_and_save(cls, m: List[str], f: List[str]):
@@ -81,43 +185,58 @@ class NamesLoader:
                 f.write(n)
                 f.write('\n')
 
+        # the names are loaded again from the updated files (and the genders of the names are inferred again)
+        cls._m_f_names, cls._names_genders = None, None
+        User._get_name_gender.cache_clear()
+
         # return updated
         return m_names, f_names
 
 
 class User(BaseEntity):
-    _name_pattern = re.compile('[a-zA-Zа-яА-Я]{3,30}')
-
-    # load names from files
-    _names = dict(zip(('m', 'f'), NamesLoader.get_m_f_names()))
-
-    def __init__(self, uid: int, first_name: str, last_name: str=None, username: str=None, **other):
-        self.tg_id = None
+    __slots__ = ('tg_id', 'last_name', 'first_name', 'uid', 'username')
 
-        super().__init__(**other)
+    _name_pattern = re.compile('[a-zA-Zа-яА-Я]{3,30}')
 
+    def __init__(self, uid: int, first_name: str, last_name: str=None, username: str=None, tg_id: int=None):
+        self.tg_id = tg_id
         self.last_name = last_name
         self.first_name = first_name
         self.uid = uid
         self.username = username
 
-    def get_gender(self):
-        name_str = ' '.join([self.first_name or '', self.last_name or '', self.username or '']).replace('ё', 'е')
+    @classmethod
+    @lru_cache(maxsize=100000)
+    def _get_name_gender(cls, name: str) -> str:
+        """
+        Gender of the first known part of the name (memoized, as the names are repeated a lot)
+        """
+        for name_part in re.findall(cls._name_pattern, name.replace('ё', 'е')):
+            gender = NamesLoader.get_names_genders().get(name_part.lower())
 
-        names_parts = re.findall(self._name_pattern, name_str)
+            if gender:
+                return gender
 
-        for name_part in names_parts:
-            if re.match(self._name_pattern, name_part):
-                lower_name = name_part.lower()
+        return 'u'
 
-                if lower_name in self._names['m']:
-                    return 'm'
+    def get_gender(self):
+        # parts of the first name go first, then the ones of the last name and the username
+        for name in (self.first_name, self.last_name, self.username):
+            if name:
+                gender = self._get_name_gender(name)
 
-                elif lower_name in self._names['f']:
-                    return 'f'
+                if gender != 'u':
+                    return gender
 
         return 'u'
 
+    @staticmethod
+    def get_genders(users: Iterable['User']) -> Dict[int, str]:
+        """
+        :return: Dict[user id, gender] of the given users
+        """
+        return {user.uid: user.get_gender() for user in users}
+
     def __eq__(self, other):
         return other.uid == self.uid
 
@@ -126,9 +245,9 @@ class User(BaseEntity):
 
 
 class Chat(BaseEntity):
-    def __init__(self, cid: int, title: str, members_count: int, messages_count: int, creation_date: datetime, **other):
-        super().__init__(**other)
+    __slots__ = ('cid', 'title', 'members_count', 'messages_count', 'creation_date')
 
+    def __init__(self, cid: int, title: str, members_count: int, messages_count: int, creation_date: datetime):
         self.cid = cid
         self.title = title
         self.members_count = members_count
@@ -143,9 +262,9 @@ class Chat(BaseEntity):
 
 
 class Message(BaseEntity):
-    def __init__(self, msg_id: int, text: str, date: datetime, author_id: int, chat_id: int, **other):
-        super().__init__(**other)
+    __slots__ = ('chat_id', 'author_id', 'date', 'text', 'msg_id')
 
+    def __init__(self, msg_id: int, text: str, date: datetime, author_id: int, chat_id: int):
         self.chat_id = chat_id
         self.author_id = author_id
         self.date = date
@@ -156,13 +275,13 @@ class Message(BaseEntity):
         return self.msg_id == other.msg_id and self.author_id == other.author_id and self.chat_id == other.chat_id
 
     def __hash__(self):
-        return int(str(self.chat_id) + str(self.author_id) + str(self.msg_id))
+        return hash((self.chat_id, self.author_id, self.msg_id))
 
 
 class Bot(BaseEntity):
-    def __init__(self, title: str, members_count: int, **other):
-        super().__init__(**other)
+    __slots__ = ('members_count', 'title')
 
+    def __init__(self, title: str, members_count: int):
         self.members_count = members_count
         self.title = title
 
@@ -174,9 +293,9 @@ class Bot(BaseEntity):
 
 
 class UserInBot(BaseEntity):
-    def __init__(self, bot_title: str, user_id: int, lang: str, **other):
-        super().__init__(**other)
+    __slots__ = ('lang', 'user_id', 'bot_title')
 
+    def __init__(self, bot_title: str, user_id: int, lang: str):
         self.lang = lang
         self.user_id = user_id
         self.bot_title = bot_title
@@ -185,15 +304,15 @@ class UserInBot(BaseEntity):
         return self.bot_title == other.bot_title and self.user_id == other.user_id
 
     def __hash__(self):
-        return hash(self.bot_title + str(self.user_id))
+        return hash((self.bot_title, self.user_id))
 
 
 class FoodOrder(BaseEntity):
-    def __init__(self, user_id: int, food_category: str, food_item: str, quantity: int, timestamp: datetime, **other):
-        self.order_id = None
-
-        super().__init__(**other)
+    __slots__ = ('order_id', 'user_id', 'food_category', 'food_item', 'timestamp', 'quantity')
 
+    def __init__(self, user_id: int, food_category: str, food_item: str, quantity: int, timestamp: datetime,
+                 order_id: int=None):
+        self.order_id = order_id
         self.user_id = user_id
         self.food_category = food_category
         self.food_item = food_item
@@ -201,19 +320,18 @@ class FoodOrder(BaseEntity):
         self.quantity = quantity
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self._values() == other._values()
 
     def __hash__(self):
-        return hash(str(self.user_id) + (self.food_category or 'Unknown_category') + (self.food_item or 'Unknown_item'))
+        return hash((self.user_id, self.food_category, self.food_item))
 
 
 class BusClick(BaseEntity):
-    def __init__(self, user_id: int, click_timestamp: datetime, route_id: str, shuttle_id: int,
-                 route_start_time: datetime, **other):
-        self.click_id = None
-
-        super().__init__(**other)
+    __slots__ = ('click_id', 'user_id', 'click_timestamp', 'route_id', 'shuttle_id', 'route_start_time')
 
+    def __init__(self, user_id: int, click_timestamp: datetime, route_id: str, shuttle_id: int,
+                 route_start_time: datetime, click_id: int=None):
+        self.click_id = click_id
         self.user_id = user_id
         self.click_timestamp = click_timestamp
         self.route_id = route_id
@@ -221,19 +339,18 @@ class BusClick(BaseEntity):
         self.route_start_time = route_start_time
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self._values() == other._values()
 
     def __hash__(self):
-        return hash(str(self.user_id) + str(self.click_timestamp) + str(self.shuttle_id))
+        return hash((self.user_id, self.click_timestamp, self.shuttle_id))
 
 
 class PlacedAd(BaseEntity):
-    def __init__(self, user_id: int, placed_timestamp: datetime, category_title: str, ad_type: str,
-                 views_count: int, likes_count: int, **other):
-        self.ad_id = None
-
-        super().__init__(**other)
+    __slots__ = ('ad_id', 'user_id', 'ad_type', 'category_title', 'placed_timestamp', 'views_count', 'likes_count')
 
+    def __init__(self, user_id: int, placed_timestamp: datetime, category_title: str, ad_type: str,
+                 views_count: int, likes_count: int, ad_id: int=None):
+        self.ad_id = ad_id
         self.user_id = user_id
         self.ad_type = ad_type
         self.category_title = category_title
@@ -242,10 +359,10 @@ class PlacedAd(BaseEntity):
         self.likes_count = likes_count
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self._values() == other._values()
 
     def __hash__(self):
-        return hash(str(self.user_id) + str(self.placed_timestamp) + str(self.ad_type) + str(self.category_title))
+        return hash((self.user_id, self.placed_timestamp, self.ad_type, self.category_title))
 
 if __name__ == '__main__':
-    NamesLoader.update_and_save(**User._names)
\ No newline at end of file
+    NamesLoader.update_and_save(*NamesLoader.get_m_f_names())
\ No newline at end of file
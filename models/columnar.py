@@ -0,0 +1,283 @@
+from datetime import datetime
+from typing import Iterable, Tuple, Generator, Union, Any, Dict
+
+import numpy as np
+
+from .base_entities import Chat, User, Message
+from .complex_entitites import UserInChat, ChatsEntities
+
+
+class TextColumn:
+    """
+    Column of strings: utf-8 bytes of all the strings in one buffer and offsets of the strings in it
+    (string i is data[offsets[i]:offsets[i + 1]]). None values are marked by the nulls mask.
+    """
+
+    def __init__(self, data: bytes, offsets: np.ndarray, nulls: np.ndarray = None):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls if nulls is not None else np.zeros(len(offsets) - 1, dtype=bool)
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]):
+        encoded, nulls = [], []
+
+        for s in strings:
+            encoded.append(s.encode('utf-8') if s is not None else b'')
+            nulls.append(s is None)
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+
+        return cls(b''.join(encoded), offsets, np.array(nulls, dtype=bool))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if self.nulls[i]:
+            return None
+
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self) -> np.ndarray:
+        """
+        Lengths of the strings in characters
+        """
+        # each character starts with a byte, which is not a continuation one (0b10xxxxxx)
+        buffer = np.frombuffer(self.data, dtype=np.uint8)
+        chars_starts = np.zeros(len(buffer) + 1, dtype=np.int64)
+        np.cumsum((buffer & 0xC0) != 0x80, out=chars_starts[1:])
+
+        return chars_starts[self.offsets[1:]] - chars_starts[self.offsets[:-1]]
+
+    def take(self, indices: np.ndarray):
+        """
+        :return: column of the strings with the given indices
+        """
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        lengths = ends - starts
+
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # position of each byte of the new buffer in the old one
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        data = np.frombuffer(self.data, dtype=np.uint8)[positions].tobytes()
+
+        return TextColumn(data, offsets, self.nulls[indices])
+
+
+class EntitiesTable:
+    """
+    Entities of a type stored by columns: numpy arrays of ids, numbers and timestamps, and text columns.
+    Missed ids are stored as 0 and missed numbers - as NaN, both are marked by the nulls masks
+    (as the None values of the texts); missed timestamps are stored as NaT.
+    """
+    _entity_type = None
+
+    # Tuple(field name, dtype) in the order of the arguments of the entity constructor; dtype of the texts is None
+    _fields = ()
+
+    def __init__(self, nulls: Dict[str, np.ndarray] = None, **columns):
+        """
+        :param nulls: masks of the None values of the numeric columns (only of the ones, which have them)
+        """
+        self.columns = columns
+        self.nulls = nulls or {}
+
+    @classmethod
+    def _from_values(cls, fields_values: Iterable[list]):
+        """
+        :param fields_values: lists of the values of each field (in the order of the _fields)
+        """
+        columns, nulls = {}, {}
+
+        for (name, dtype), values in zip(cls._fields, fields_values):
+            if dtype is None:
+                columns[name] = TextColumn.from_strings(values)
+
+            elif dtype in (np.int64, np.float64):
+                missed_value = 0 if dtype == np.int64 else np.nan
+                columns[name] = np.array([v if v is not None else missed_value for v in values], dtype=dtype)
+
+                mask = np.array([v is None for v in values], dtype=bool)
+                if mask.any():
+                    nulls[name] = mask
+
+            else:
+                columns[name] = np.array(values, dtype=dtype)
+
+        return cls(nulls, **columns)
+
+    @classmethod
+    def from_entities(cls, entities: Iterable[Any]):
+        entities = list(entities)
+
+        return cls._from_values([getattr(e, name) for e in entities] for name, _ in cls._fields)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]):
+        """
+        :param rows: tuples of the values of the fields (in the order of the _fields)
+        """
+        rows = list(rows)
+
+        return cls._from_values([row[i] for row in rows] for i in range(len(cls._fields)))
+
+    def __len__(self):
+        return len(self.columns[self._fields[0][0]])
+
+    def __getitem__(self, name: str) -> Union[np.ndarray, TextColumn]:
+        return self.columns[name]
+
+    def filter(self, selection: np.ndarray):
+        """
+        :param selection: boolean mask or indices of the entities
+        :return: table of the selected entities
+        """
+        indices = np.flatnonzero(selection) if selection.dtype == bool else selection
+
+        return type(self)({name: mask[indices] for name, mask in self.nulls.items()},
+                          **{name: column.take(indices) if isinstance(column, TextColumn) else column[indices]
+                             for name, column in self.columns.items()})
+
+    def group_by(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: Tuple(unique values of the :key column, index of the group of each entity)
+        """
+        return np.unique(self.columns[key], return_inverse=True)
+
+    def aggregate(self, key: str, values: Union[str, np.ndarray] = None,
+                  func: str = 'count') -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Aggregates :values (a numeric column or an array) by the groups of the :key column.
+        :param func: 'count', 'sum', 'mean', 'min' or 'max'
+        :return: Tuple(unique values of the :key column, aggregated value of each group)
+        """
+        keys, groups = self.group_by(key)
+        counts = np.bincount(groups, minlength=len(keys))
+
+        if func == 'count':
+            return keys, counts
+
+        values = self.columns[values] if isinstance(values, str) else values
+
+        if func in ('sum', 'mean'):
+            sums = np.bincount(groups, weights=values, minlength=len(keys))
+
+            return keys, sums if func == 'sum' else sums / counts
+
+        if func in ('min', 'max'):
+            if not len(keys):
+                return keys, values[:0]
+
+            result = np.full(len(keys), values.max() if func == 'min' else values.min(), dtype=values.dtype)
+            (np.minimum if func == 'min' else np.maximum).at(result, groups, values)
+
+            return keys, result
+
+        raise ValueError('Unknown aggregation function %s' % func)
+
+    def rows(self, *fields: str) -> Iterable[tuple]:
+        """
+        :return: tuples of the values of the given fields (all the fields by default) as Python objects
+        """
+        fields = fields or [name for name, _ in self._fields]
+
+        return zip(*[self._get_values(name) for name in fields])
+
+    def _get_values(self, name: str) -> list:
+        """
+        :return: values of the column as Python objects (None for the masked ones)
+        """
+        column = self.columns[name]
+
+        if isinstance(column, TextColumn):
+            return list(column)
+
+        if name not in self.nulls:
+            return column.tolist()
+
+        return [None if null else v for v, null in zip(column.tolist(), self.nulls[name].tolist())]
+
+    def to_records(self, *fields: str) -> np.ndarray:
+        """
+        :return: numpy structured array of the given (non-text) fields
+        """
+        return np.rec.fromarrays([self.columns[name] for name in fields], names=list(fields))
+
+    def to_entities(self) -> Generator[Any, None, None]:
+        for row in self.rows():
+            yield self._entity_type(*row)
+
+
+class ChatsTable(EntitiesTable):
+    _entity_type = Chat
+    _fields = (('cid', np.int64), ('title', None), ('members_count', np.int64), ('messages_count', np.int64),
+               ('creation_date', 'datetime64[us]'))
+
+
+class UsersTable(EntitiesTable):
+    _entity_type = User
+    _fields = (('uid', np.int64), ('first_name', None), ('last_name', None), ('username', None))
+
+
+class MessagesTable(EntitiesTable):
+    _entity_type = Message
+    _fields = (('msg_id', np.int64), ('text', None), ('date', 'datetime64[us]'), ('author_id', np.int64),
+               ('chat_id', np.int64))
+
+
+class UsersInChatsTable(EntitiesTable):
+    _entity_type = UserInChat
+    _fields = (('chat_id', np.int64), ('user_id', np.int64), ('entering_difference', np.float64),
+               ('avg_msg_frequency', np.float64), ('avg_msg_length', np.float64))
+
+
+class ColumnarChatsEntities:
+    """
+    Columnar variant of the ChatsEntities: each kind of entities is stored as a table of columns
+    """
+
+    def __init__(self, chats: ChatsTable, users: UsersTable, messages: MessagesTable,
+                 users_in_chats: UsersInChatsTable, incremental: bool = False):
+        self.chats = chats
+        self.users = users
+        self.messages = messages
+        self.users_in_chats = users_in_chats
+
+        self.incremental = incremental
+
+    @classmethod
+    def from_chats_entities(cls, entities: ChatsEntities):
+        return cls(ChatsTable.from_entities(entities.chats),
+                   UsersTable.from_entities(entities.users),
+                   MessagesTable.from_entities(entities.messages),
+                   UsersInChatsTable.from_entities(entities.users_in_chats),
+                   entities.incremental)
+
+    def to_chats_entities(self) -> ChatsEntities:
+        return ChatsEntities(set(self.chats.to_entities()), set(self.users.to_entities()),
+                             set(self.messages.to_entities()), set(self.users_in_chats.to_entities()),
+                             self.incremental)
+
+    def to_rows(self) -> Tuple[Iterable[tuple], Iterable[tuple], Iterable[tuple], Iterable[tuple]]:
+        """
+        :return: rows of users, chats, messages and users_in_chats (see DataUploader.upload_chats_rows)
+        """
+        return (self.users.rows('uid', 'first_name', 'last_name', 'username'),
+                self.chats.rows('cid', 'title', 'members_count', 'messages_count', 'creation_date'),
+                self.messages.rows('msg_id', 'text', 'date', 'chat_id', 'author_id'),
+                self.users_in_chats.rows('chat_id', 'user_id', 'entering_difference', 'avg_msg_frequency',
+                                         'avg_msg_length'))
+
+    def messages_of_users(self, users_ids: Iterable[int]) -> MessagesTable:
+        return self.messages.filter(np.isin(self.messages['author_id'], np.fromiter(users_ids, dtype=np.int64)))
+
+    def messages_since(self, since: datetime) -> MessagesTable:
+        return self.messages.filter(self.messages['date'] >= np.datetime64(since, 'us'))
@@ -6,14 +6,15 @@ from models.base_entities import Message, Chat, User, BaseEntity
 
 
 class UserInChat(BaseEntity):
+    __slots__ = ('chat_id', 'user_id', 'entering_difference', 'avg_msg_frequency', 'avg_msg_length')
+
     def __hash__(self):
-        return hash(str(self.user_id) + str(self.chat_id))
+        return hash((self.user_id, self.chat_id))
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return self._values() == other._values()
 
     def __init__(self, chat_id, user_id, entering_difference, avg_msg_frequency, avg_msg_length):
-        super().__init__()
         self.chat_id = chat_id
         self.user_id = user_id
 
@@ -23,6 +24,9 @@ class UserInChat(BaseEntity):
 
 
 class ChatsEntities(BaseEntity):
+    # entities gathered by the older versions don't have the flag
+    incremental = False
+
     def __eq__(self, other):
         pass
 
@@ -30,7 +34,11 @@ class ChatsEntities(BaseEntity):
         pass
 
     def __init__(self, chats: Set[Chat]=None, users: Set[User]=None, messages: Set[Message]=None,
-                 users_in_chats: Set[UserInChat]=None):
+                 users_in_chats: Set[UserInChat]=None, incremental: bool=False):
+        """
+        :param incremental: if True - only messages newer than the previously uploaded ones are contained,
+        so the entities have to be merged with the uploaded ones instead of replacing them
+        """
         super().__init__()
 
         self.messages = messages or set()
@@ -39,6 +47,8 @@ class ChatsEntities(BaseEntity):
 
         self.users_in_chats = users_in_chats or set()
 
+        self.incremental = incremental
+
     # TODO: pickle
     # def serialize(self):
     #     return json.dumps({
@@ -0,0 +1,170 @@
+import os
+import pickle
+import struct
+import zlib
+from itertools import islice
+from typing import Generator, Iterable, Any
+
+from .complex_entitites import ChatsEntities
+
+
+class StreamedTable:
+    """
+    Entities of a table of the file, which are read from disk on each iteration
+    """
+
+    def __init__(self, entities_file, table: str):
+        self._entities_file = entities_file
+        self._table = table
+
+    def __iter__(self):
+        return self._entities_file.iter_table(self._table)
+
+
+class StreamedChatsEntities:
+    """
+    Chats entities, which are streamed from the file instead of being loaded into memory
+    (each table can be iterated like the sets of the ChatsEntities)
+    """
+
+    def __init__(self, entities_file, incremental: bool):
+        self.chats = StreamedTable(entities_file, 'chats')
+        self.users = StreamedTable(entities_file, 'users')
+        self.messages = StreamedTable(entities_file, 'messages')
+        self.users_in_chats = StreamedTable(entities_file, 'users_in_chats')
+
+        self.incremental = incremental
+
+
+class ChatsEntitiesFile:
+    """
+    Chunked file format of the ChatsEntities, which is written and read without holding the whole pickle in memory.
+
+    The file starts with a header: magic bytes, version of the format and flags of the entities.
+    Then each table is written as a sequence of chunks: 1 byte of the table index, 1 byte of the compression flag
+    and 4 bytes of the chunk length are followed by the (zlib-compressed) pickle of the list of at most :chunk_size
+    entities. Chunks of other tables are skipped without reading, so each table can be iterated lazily.
+    Files of the older versions (the whole ChatsEntities pickled) are read as well.
+    """
+    _magic = b'TGCE'
+    _version = 1
+    _header = struct.Struct('>4sHB')
+    _chunk_header = struct.Struct('>BBI')
+
+    _tables = ('chats', 'users', 'messages', 'users_in_chats')
+
+    # flags of the header
+    _incremental_flag = 1
+
+    def __init__(self, file_path: str, chunk_size: int = 10000, compression_level: int = 6):
+        """
+        :param compression_level: zlib compression level of the chunks (0 - chunks are not compressed)
+        """
+        self._file_path = file_path
+        self._chunk_size = chunk_size
+        self._compression_level = compression_level
+
+    def _write_table(self, f, table_index: int, entities: Iterable[Any]):
+        entities = iter(entities)
+
+        while True:
+            chunk = list(islice(entities, self._chunk_size))
+            if not chunk:
+                break
+
+            data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+
+            compressed = self._compression_level > 0
+            if compressed:
+                data = zlib.compress(data, self._compression_level)
+
+            f.write(self._chunk_header.pack(table_index, compressed, len(data)))
+            f.write(data)
+
+    def write(self, entities: ChatsEntities):
+        # the file is replaced only once it's completely written
+        tmp_file_path = self._file_path + '.tmp'
+
+        with open(tmp_file_path, 'wb') as f:
+            flags = self._incremental_flag if entities.incremental else 0
+            f.write(self._header.pack(self._magic, self._version, flags))
+
+            for table_index, table in enumerate(self._tables):
+                self._write_table(f, table_index, getattr(entities, table))
+
+        os.replace(tmp_file_path, self._file_path)
+
+    def _read_header(self, f) -> int:
+        """
+        :return: flags of the entities (or None, if the file has the older format)
+        """
+        header = f.read(self._header.size)
+
+        if len(header) < self._header.size or not header.startswith(self._magic):
+            return None
+
+        magic, version, flags = self._header.unpack(header)
+
+        if version > self._version:
+            raise ValueError('Unsupported version %d of the entities file %s' % (version, self._file_path))
+
+        return flags
+
+    def iter_table(self, table: str) -> Generator[Any, None, None]:
+        """
+        Reads the entities of the table (one of 'chats', 'users', 'messages', 'users_in_chats') chunk by chunk
+        """
+        table_index = self._tables.index(table)
+
+        with open(self._file_path, 'rb') as f:
+            if self._read_header(f) is None:
+                yield from getattr(self._read_pickle(), table)
+                return
+
+            while True:
+                chunk_header = f.read(self._chunk_header.size)
+                if len(chunk_header) < self._chunk_header.size:
+                    break
+
+                chunk_table_index, compressed, chunk_length = self._chunk_header.unpack(chunk_header)
+
+                if chunk_table_index != table_index:
+                    f.seek(chunk_length, os.SEEK_CUR)
+                    continue
+
+                data = f.read(chunk_length)
+                if len(data) < chunk_length:
+                    raise ValueError('Entities file %s is truncated' % self._file_path)
+
+                yield from pickle.loads(zlib.decompress(data) if compressed else data)
+
+    def _read_pickle(self) -> ChatsEntities:
+        entities = ChatsEntities()
+        entities.from_file(self._file_path)
+
+        return entities
+
+    def _read_flags(self) -> int:
+        with open(self._file_path, 'rb') as f:
+            return self._read_header(f)
+
+    def read(self) -> ChatsEntities:
+        flags = self._read_flags()
+
+        if flags is None:
+            return self._read_pickle()
+
+        return ChatsEntities(*[set(self.iter_table(table)) for table in self._tables],
+                             incremental=bool(flags & self._incremental_flag))
+
+    def stream(self) -> StreamedChatsEntities:
+        """
+        :return: entities, which tables are read from the file on iteration
+        """
+        flags = self._read_flags()
+
+        # the older format can't be streamed
+        if flags is None:
+            return self._read_pickle()
+
+        return StreamedChatsEntities(self, bool(flags & self._incremental_flag))
@@ -0,0 +1,193 @@
+import pickle
+import random
+import re
+import tracemalloc
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from models import Message, User, FoodOrder
+from models.base_entities import NamesLoader
+
+
+class DictEntity:
+    """
+    Entity with a dict of attributes (the way the entities were stored before the slots)
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__ = kwargs
+
+
+class DictMessage(DictEntity):
+    def __init__(self, msg_id: int, text: str, date: datetime, author_id: int, chat_id: int, **other):
+        super().__init__(**other)
+
+        self.chat_id = chat_id
+        self.author_id = author_id
+        self.date = date
+        self.text = text
+        self.msg_id = msg_id
+
+    def __eq__(self, other):
+        return self.msg_id == other.msg_id and self.author_id == other.author_id and self.chat_id == other.chat_id
+
+    def __hash__(self):
+        return int(str(self.chat_id) + str(self.author_id) + str(self.msg_id))
+
+
+class DictUser(DictEntity):
+    def __init__(self, uid: int, first_name: str, last_name: str=None, username: str=None, **other):
+        self.tg_id = None
+
+        super().__init__(**other)
+
+        self.last_name = last_name
+        self.first_name = first_name
+        self.uid = uid
+        self.username = username
+
+    def __eq__(self, other):
+        return other.uid == self.uid
+
+    def __hash__(self):
+        return self.uid
+
+
+def _measure(title: str, create, count: int):
+    """
+    Prints construction time, memory per object, set insertion time and pickling time/size of :count objects
+    """
+    # texts and dates are shared by both the variants, so only the objects themselves are measured
+    tracemalloc.start()
+
+    start_time = perf_counter()
+    objects = [create(i) for i in range(count)]
+    construction_time = perf_counter() - start_time
+
+    objects_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start_time = perf_counter()
+    objects_set = set(objects)
+    set_time = perf_counter() - start_time
+
+    start_time = perf_counter()
+    dump = pickle.dumps(objects_set, pickle.HIGHEST_PROTOCOL)
+    pickle.loads(dump)
+    pickling_time = perf_counter() - start_time
+
+    print('%-12s construction %.2f s, %5.0f bytes/object, set of them %.2f s, pickle round trip %.2f s (%.1f MB)'
+          % (title, construction_time, objects_memory / count, set_time, pickling_time, len(dump) / 1024 / 1024))
+
+
+def benchmark_entities(count: int = 10 ** 6):
+    date, text = datetime(2017, 1, 1), 'some text of the message'
+    dates = [date + timedelta(seconds=i) for i in range(count)]
+
+    print('%d messages:' % count)
+    _measure('dict', lambda i: DictMessage(i, text, dates[i], i % 1000, 42), count)
+    _measure('slots', lambda i: Message(i, text, dates[i], i % 1000, 42), count)
+
+    print('%d users:' % count)
+    _measure('dict', lambda i: DictUser(i, 'Ivan', 'Ivanov', 'ivan%d' % (i % 10)), count)
+    _measure('slots', lambda i: User(i, 'Ivan', 'Ivanov', 'ivan%d' % (i % 10)), count)
+
+
+class StrHashMessage(Message):
+    """
+    Message with the hash of the concatenated ids (the way it was hashed before)
+    """
+    __slots__ = ()
+
+    def __hash__(self):
+        return int(str(self.chat_id) + str(self.author_id) + str(self.msg_id))
+
+
+class StrHashFoodOrder(FoodOrder):
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(str(self.user_id) + (self.food_category or 'Unknown_category') + (self.food_item or 'Unknown_item'))
+
+
+def _measure_hashing(title: str, objects: list):
+    start_time = perf_counter()
+    for o in objects:
+        hash(o)
+    hashing_time = perf_counter() - start_time
+
+    start_time = perf_counter()
+    objects_set = set(objects)
+    set_time = perf_counter() - start_time
+
+    start_time = perf_counter()
+    found = sum(1 for o in objects if o in objects_set)
+    lookup_time = perf_counter() - start_time
+
+    # different (not equal) objects with the same hash
+    collisions = len(objects_set) - len({hash(o) for o in objects_set})
+
+    print('%-22s hash %.2f s, set building %.2f s, lookups %.2f s (%d found), %d hash collisions'
+          % (title, hashing_time, set_time, lookup_time, found, collisions))
+
+
+def benchmark_hashing(count: int = 10 ** 6):
+    date = datetime(2017, 1, 1)
+
+    # ids of chats and authors of different digits counts, so concatenated ids collide
+    ids = [(i % 1000 + 1, (i * 7919) % 100000 + 1, i // 1000 + 1) for i in range(count)]
+
+    print('%d messages:' % count)
+    _measure_hashing('concatenated ids', [StrHashMessage(msg_id, '', date, author_id, chat_id)
+                                          for chat_id, author_id, msg_id in ids])
+    _measure_hashing('tuple of ids', [Message(msg_id, '', date, author_id, chat_id)
+                                      for chat_id, author_id, msg_id in ids])
+
+    print('%d food orders:' % count)
+    _measure_hashing('concatenated fields', [StrHashFoodOrder(i % 5000, 'pizza', 'item%d' % (i % 100), 1, date)
+                                             for i in range(count)])
+    _measure_hashing('tuple of fields', [FoodOrder(i % 5000, 'pizza', 'item%d' % (i % 100), 1, date)
+                                         for i in range(count)])
+
+
+def _get_gender_by_scan(user: User) -> str:
+    """
+    Gender inference by scanning the lists of names (the way it was done before the index)
+    """
+    name_str = ' '.join([user.first_name or '', user.last_name or '', user.username or '']).replace('ё', 'е')
+    m_names, f_names = NamesLoader.get_m_f_names()
+
+    for name_part in re.findall(User._name_pattern, name_str):
+        lower_name = name_part.lower()
+
+        if lower_name in m_names:
+            return 'm'
+
+        elif lower_name in f_names:
+            return 'f'
+
+    return 'u'
+
+
+def benchmark_genders(count: int = 10 ** 5):
+    random.seed(0)
+
+    names = [name.capitalize() for name in sum(NamesLoader.get_m_f_names(), []) if name]
+    users = [User(i, random.choice(names), random.choice(names + [None]), 'user%d' % i) for i in range(count)]
+
+    start_time = perf_counter()
+    [_get_gender_by_scan(user) for user in users]
+    print('%d users: scan of the names %.2f s' % (count, perf_counter() - start_time))
+
+    start_time = perf_counter()
+    User.get_genders(users)
+    print('%d users: index of the names %.2f s' % (count, perf_counter() - start_time))
+
+
+if __name__ == '__main__':
+    benchmark_entities()
+    benchmark_hashing()
+    benchmark_genders()
@@ -4,6 +4,7 @@ import re
 from typing import Tuple, List, Dict, Set
 
 from data.transferring import DataUploader
+from data.transferring.connections import ConnectionsPool
 from models import FeaturesFromBot
 from models import FeaturesFromChat
 from models import UserClass
@@ -14,28 +15,22 @@ from research.text_processing.mystem import TextProcessor
 
 
 class FeaturesExtractor(DataUploader):
-    def __init__(self):
-        super(FeaturesExtractor, self).__init__()
+    def __init__(self, pool: ConnectionsPool = None):
+        super(FeaturesExtractor, self).__init__(pool)
 
     def _get_chats_bots_features(self, existed_users_features: Dict[int, Set[Features]]=None) -> Dict[int, Set[Features]]:
         """
         Adds features from chats and bots to the existing :users_features dict
         """
-        chats = self.get_chats()
-        users = self.get_users()
+        # chats, users and users in chats are read by columns (no entities are built for them)
+        entities = self.get_columnar_chats_entities(with_messages=False)
         bots = self.get_bots()
 
         # if passed user features dict is None - create it from scratch
-        users_features = existed_users_features or {u.uid: set() for u in users}
+        users_features = existed_users_features or {uid: set() for uid in entities.users['uid'].tolist()}
 
         # collect from chats (only with participation)
-        for index, user_in_chat in enumerate(self.get_users_in_chats()):
-            chat_id, uid, diff, freq, length = (user_in_chat.chat_id,
-                                                user_in_chat.user_id,
-                                                user_in_chat.entering_difference,
-                                                user_in_chat.avg_msg_frequency,
-                                                user_in_chat.avg_msg_length)
-
+        for chat_id, uid, diff, freq, length in entities.users_in_chats.rows():
             if users_features.get(uid) is None:
                 users_features[uid] = set()
                 print('Warning: user with uid %d was absent; added. (Chats features extraction) ' % uid)
@@ -56,7 +51,7 @@ class FeaturesExtractor(DataUploader):
             users_features[uid].add(FeaturesFromBot(bot_title, participation=1, language=lang))
 
         # for each chat and bot, create features without participation
-        not_part_chats_bots = {FeaturesFromChat(chat.cid, 0) for chat in chats}
+        not_part_chats_bots = {FeaturesFromChat(chat_id, 0) for chat_id in entities.chats['cid'].tolist()}
         not_part_chats_bots.update([FeaturesFromBot(bot.title, 0) for bot in bots])
 
         # for each user, add features for that chats and bots, where user is not presented
@@ -249,22 +244,24 @@ class FeaturesExtractor(DataUploader):
  
             return pickle.load(open(_dump_filepath, 'rb'))
 
-        messages = list(filter(lambda m: re.match('.*[а-яА-Яa-zA-Z]+.*', m.text), self.get_messages()))
+        # only texts and authors of the messages are needed, so they are streamed as raw tuples
+        messages = [(text, author_id) for text, author_id in self.iter_rows('messages', ('text', 'user_id'))
+                    if re.match('.*[а-яА-Яa-zA-Z]+.*', text)]
         users = self.get_users()
 
         users_messages = {u.uid: list() for u in users}
 
         # stem texts of all the messages
         with TextProcessor() as tp:
-            stemmed_texts = tp.stemming([m.text for m in messages])
+            stemmed_texts = tp.stemming([text for text, _ in messages])
 
         # sort stemmed messages texts by their authors
-        for msg, stemmed_text in zip(messages, stemmed_texts):
-            if users_messages.get(msg.author_id) is None:
-                users_messages[msg.author_id] = set()
-                print('Warning: user with uid %d was absent; added. (Messages features extraction) ' % msg.author_id)
+        for (_, author_id), stemmed_text in zip(messages, stemmed_texts):
+            if users_messages.get(author_id) is None:
+                users_messages[author_id] = list()
+                print('Warning: user with uid %d was absent; added. (Messages features extraction) ' % author_id)
 
-            users_messages[msg.author_id].append(stemmed_text)
+            users_messages[author_id].append(stemmed_text)
 
         fe = TextFeaturesExtractor(n_gram=1, max_features=5000, min_occurrence_rate=2)
 
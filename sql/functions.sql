@@ -1,163 +1,199 @@
--- use SQL statement instead of functions for inserting chats and bots (there are no such functions here)
+-- set-based functions: rows are given as arrays of their fields (one array per column),
+-- existing rows are updated by ON CONFLICT (only if they are changed) and local ids of the users are resolved by one join
 
--- update or insert user
-CREATE OR REPLACE FUNCTION insert_user(user_id INTEGER, first_name VARCHAR(250), last_name VARCHAR(250), username VARCHAR(250)) RETURNS VOID AS $$
+-- update or insert users
+CREATE OR REPLACE FUNCTION insert_users(_tg_ids INTEGER[], _first_names VARCHAR(250)[], _last_names VARCHAR(250)[], _usernames VARCHAR(250)[]) RETURNS VOID AS $$
   BEGIN
 
-    -- if the user exists - update it, otherwise - add new user
-    IF user_id IN (SELECT tg_id FROM users) THEN
-      UPDATE users SET (first_name, last_name, username) = ($2, $3, $4)
-      WHERE users.tg_id = user_id;
-    ELSE
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES ($1, $2, $3, $4);
-    END IF;
+    INSERT INTO users (tg_id, first_name, last_name, username)
+    SELECT DISTINCT ON (u.tg_id) u.tg_id, u.first_name, u.last_name, u.username
+    FROM unnest(_tg_ids, _first_names, _last_names, _usernames) AS u(tg_id, first_name, last_name, username)
+    ON CONFLICT (tg_id) DO UPDATE SET (first_name, last_name, username) = (EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.username)
+    WHERE (users.first_name, users.last_name, users.username) IS DISTINCT FROM (EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.username);
 
   END;
 $$ LANGUAGE plpgsql;
 
--- replace user_id with the local id
-CREATE OR REPLACE FUNCTION insert_user_in_chat(_chat_id INTEGER, _user_id INTEGER, _entering_diff FLOAT, _avg_msg_frequency FLOAT, _avg_msg_length FLOAT) RETURNS VOID AS $$
-  DECLARE
-    local_user_id INTEGER := (SELECT local_id FROM users WHERE tg_id = _user_id);
+-- add users, which are referenced by the telegram ids, but don't exist yet
+CREATE OR REPLACE FUNCTION insert_missing_users(_tg_ids INTEGER[]) RETURNS VOID AS $$
   BEGIN
 
-    -- check if the chat exists
-    IF _chat_id NOT IN (SELECT chat_id FROM chats) THEN
-      RAISE EXCEPTION 'Error inserting user in chat: there is no chat with the given chat_id';
-    END IF;
+    INSERT INTO users (tg_id)
+    SELECT DISTINCT u.tg_id FROM unnest(_tg_ids) AS u(tg_id)
+    WHERE u.tg_id IS NOT NULL
+    ORDER BY u.tg_id  -- in the order of the ids, so uploads running at the same time don't deadlock
+    ON CONFLICT (tg_id) DO NOTHING;
+
+  END;
+$$ LANGUAGE plpgsql;
 
-    -- if there is no such user - insert it into the Users table
-    IF _user_id NOT IN (SELECT tg_id FROM users) THEN
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES (_user_id, NULL, NULL, NULL);
-      local_user_id := (SELECT local_id FROM users WHERE tg_id = user_id);
-    END IF;
+-- update or insert chats
+CREATE OR REPLACE FUNCTION insert_chats(_chat_ids INTEGER[], _titles VARCHAR(100)[], _members_counts INTEGER[], _messages_counts INTEGER[], _creation_dates TIMESTAMP[]) RETURNS VOID AS $$
+  BEGIN
 
-    -- if the user_in_chat exists - update it; otherwise - add new one
-    IF (_chat_id, local_user_id) IN (SELECT chat_id, user_id FROM users_in_chats) THEN
-      UPDATE users_in_chats SET (entering_diff, avg_msg_frequency, avg_msg_length) = (_entering_diff, _avg_msg_frequency, _avg_msg_length)
-      WHERE chat_id = _chat_id AND user_id = local_user_id;
-    ELSE
-      INSERT INTO users_in_chats VALUES (_chat_id, local_user_id, _entering_diff, _avg_msg_frequency, _avg_msg_length);
-    END IF;
+    INSERT INTO chats (chat_id, title, members_count, messages_count, creation_date)
+    SELECT DISTINCT ON (c.chat_id) c.chat_id, c.title, c.members_count, c.messages_count, c.creation_date
+    FROM unnest(_chat_ids, _titles, _members_counts, _messages_counts, _creation_dates) AS c(chat_id, title, members_count, messages_count, creation_date)
+    ON CONFLICT (chat_id) DO UPDATE SET (title, members_count, messages_count, creation_date) = (EXCLUDED.title, EXCLUDED.members_count, EXCLUDED.messages_count, EXCLUDED.creation_date)
+    WHERE (chats.title, chats.members_count, chats.messages_count, chats.creation_date) IS DISTINCT FROM (EXCLUDED.title, EXCLUDED.members_count, EXCLUDED.messages_count, EXCLUDED.creation_date);
 
   END;
 $$ LANGUAGE plpgsql;
 
-SELECT * FROM insert_user_in_bot('InnoHelpBot', 216842240, 'en');
--- replace user_id with the local id
-CREATE OR REPLACE FUNCTION insert_user_in_bot(_bot_title VARCHAR(50), _user_id INTEGER, _lang VARCHAR(10)) RETURNS VOID AS $$
-  DECLARE
-    local_user_id INTEGER := (SELECT local_id FROM users WHERE tg_id = _user_id);
+-- update or insert users in chats (users are given by the telegram ids), chats must exist
+CREATE OR REPLACE FUNCTION insert_users_in_chats(_chat_ids INTEGER[], _user_ids INTEGER[], _entering_diffs FLOAT[], _avg_msg_frequencies FLOAT[], _avg_msg_lengths FLOAT[]) RETURNS VOID AS $$
   BEGIN
 
-    -- check if the bot exists
-    IF _bot_title NOT IN (SELECT title FROM bots) THEN
-      RAISE EXCEPTION 'Error inserting user in bot: there is no bot with the given bot title';
-    END IF;
+    PERFORM insert_missing_users(_user_ids);
 
-    -- if there is no such user - add it into the Users table
-    IF _user_id NOT IN (SELECT tg_id FROM users) THEN
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES (_user_id, NULL, NULL, NULL);
-      local_user_id := (SELECT local_id FROM users WHERE tg_id = _user_id);
-    END IF;
+    INSERT INTO users_in_chats (chat_id, user_id, entering_diff, avg_msg_frequency, avg_msg_length)
+    SELECT DISTINCT ON (e.chat_id, u.local_id) e.chat_id, u.local_id, e.entering_diff, e.avg_msg_frequency, e.avg_msg_length
+    FROM unnest(_chat_ids, _user_ids, _entering_diffs, _avg_msg_frequencies, _avg_msg_lengths) AS e(chat_id, user_tg_id, entering_diff, avg_msg_frequency, avg_msg_length)
+    INNER JOIN users u ON u.tg_id = e.user_tg_id
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET (entering_diff, avg_msg_frequency, avg_msg_length) = (EXCLUDED.entering_diff, EXCLUDED.avg_msg_frequency, EXCLUDED.avg_msg_length)
+    WHERE (users_in_chats.entering_diff, users_in_chats.avg_msg_frequency, users_in_chats.avg_msg_length) IS DISTINCT FROM (EXCLUDED.entering_diff, EXCLUDED.avg_msg_frequency, EXCLUDED.avg_msg_length);
 
-    -- if the user_in_bot exists - update it; otherwise - add new one
-    IF (_bot_title, local_user_id) IN (SELECT bot_title, user_id FROM users_in_bots) THEN
-      UPDATE users_in_bots SET (lang) = (_lang)
-      WHERE bot_title = _bot_title AND user_id = local_user_id;
-    ELSE
-      INSERT INTO users_in_bots VALUES (_bot_title, local_user_id, _lang);
-    END IF;
+  END;
+$$ LANGUAGE plpgsql;
+
+-- update or insert messages (only the ones shorter than 500 symbols), chats must exist
+CREATE OR REPLACE FUNCTION insert_messages(_msg_ids INTEGER[], _msg_texts VARCHAR(4000)[], _dates TIMESTAMP[], _chat_ids INTEGER[], _user_ids INTEGER[]) RETURNS VOID AS $$
+  BEGIN
+
+    PERFORM insert_missing_users(_user_ids);
+
+    INSERT INTO messages (msg_id, text, date, chat_id, user_id)
+    SELECT DISTINCT ON (m.msg_id, u.local_id, m.chat_id) m.msg_id, m.msg_text, m.msg_date, m.chat_id, u.local_id
+    FROM unnest(_msg_ids, _msg_texts, _dates, _chat_ids, _user_ids) AS m(msg_id, msg_text, msg_date, chat_id, user_tg_id)
+    INNER JOIN users u ON u.tg_id = m.user_tg_id
+    WHERE char_length(m.msg_text) <= 500
+    ON CONFLICT (msg_id, user_id, chat_id) DO UPDATE SET (text, date) = (EXCLUDED.text, EXCLUDED.date)
+    WHERE (messages.text, messages.date) IS DISTINCT FROM (EXCLUDED.text, EXCLUDED.date);
 
   END;
 $$ LANGUAGE plpgsql;
 
--- check if the message length is less than 500, and replace user_id with local id
-DROP FUNCTION insert_message(INTEGER, VARCHAR(4000), VARCHAR(50), INTEGER, INTEGER);
-CREATE OR REPLACE FUNCTION insert_message(_msg_id INTEGER, _msg_text VARCHAR(4000), _date TIMESTAMP, _chat_id INTEGER, _user_id INTEGER) RETURNS VOID AS $$
-  DECLARE
-    local_user_id INTEGER := (SELECT local_id FROM users WHERE tg_id = _user_id);
+-- update or insert bots
+CREATE OR REPLACE FUNCTION insert_bots(_titles VARCHAR(50)[], _members_counts INTEGER[]) RETURNS VOID AS $$
   BEGIN
-    -- check if the message length is less than 500
-    IF char_length(_msg_text) > 500 THEN
-      RETURN ;-- RAISE EXCEPTION 'Error inserting message: size of the text must be <= 500';
-    END IF;
 
-    -- check if the chat exists
-    IF _chat_id NOT IN (SELECT chat_id FROM chats) THEN
-      RAISE EXCEPTION 'Error inserting message: there is no chat with the given chat_id';
-    END IF;
+    INSERT INTO bots (title, members_count)
+    SELECT DISTINCT ON (b.title) b.title, b.members_count
+    FROM unnest(_titles, _members_counts) AS b(title, members_count)
+    ON CONFLICT (title) DO UPDATE SET members_count = EXCLUDED.members_count
+    WHERE bots.members_count IS DISTINCT FROM EXCLUDED.members_count;
 
-    -- if there is no such user - add it into the Users table
-    IF _user_id NOT IN (SELECT tg_id FROM users) THEN
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES (_user_id, NULL, NULL, NULL);
-      local_user_id := (SELECT local_id FROM users WHERE tg_id = _user_id);
-    END IF;
+  END;
+$$ LANGUAGE plpgsql;
+
+-- update or insert users in bots (users are given by the telegram ids), bots must exist
+CREATE OR REPLACE FUNCTION insert_users_in_bots(_bot_titles VARCHAR(50)[], _user_ids INTEGER[], _langs VARCHAR(10)[]) RETURNS VOID AS $$
+  BEGIN
+
+    PERFORM insert_missing_users(_user_ids);
 
-    -- if the message_in_chat exists - update it; otherwise - add new one
-    IF (_msg_id, _chat_id, local_user_id) IN (SELECT msg_id, chat_id, user_id FROM messages) THEN
-      UPDATE messages SET (text, date) = (_msg_text, _date)
-      WHERE msg_id = _msg_id AND chat_id = _chat_id AND _user_id = local_user_id;
-    ELSE
-      INSERT INTO messages(msg_id, text, date, chat_id, user_id)  VALUES (_msg_id, _msg_text, _date, _chat_id, local_user_id);
-    END IF;
+    INSERT INTO users_in_bots (bot_title, user_id, lang)
+    SELECT DISTINCT ON (e.bot_title, u.local_id) e.bot_title, u.local_id, e.lang
+    FROM unnest(_bot_titles, _user_ids, _langs) AS e(bot_title, user_tg_id, lang)
+    INNER JOIN users u ON u.tg_id = e.user_tg_id
+    ON CONFLICT (bot_title, user_id) DO UPDATE SET lang = EXCLUDED.lang
+    WHERE users_in_bots.lang IS DISTINCT FROM EXCLUDED.lang;
 
   END;
 $$ LANGUAGE plpgsql;
 
--- replace user_id with local id
--- SELECT * FROM insert_food_order(216842240, 'pizza', 'маргарита', '2017-02-15 15:45:19.173Z');
-CREATE OR REPLACE FUNCTION insert_food_order(_user_id INTEGER, _food_category VARCHAR(100), _food_item VARCHAR(500), _quantity INTEGER, _order_timestamp TIMESTAMP) RETURNS VOID AS $$
-  DECLARE
-    local_user_id INTEGER := (SELECT local_id FROM users WHERE tg_id = _user_id);
+-- insert food orders (users are given by the telegram ids)
+CREATE OR REPLACE FUNCTION insert_food_orders(_user_ids INTEGER[], _food_categories VARCHAR(100)[], _food_items VARCHAR(500)[], _quantities INTEGER[], _order_timestamps TIMESTAMP[]) RETURNS VOID AS $$
   BEGIN
 
-    -- check if the user exists
-    IF _user_id NOT IN (SELECT tg_id FROM users) THEN
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES (_user_id, NULL, NULL, NULL);
-      local_user_id := (SELECT local_id FROM users WHERE tg_id = _user_id);
-    END IF;
+    PERFORM insert_missing_users(_user_ids);
 
-    -- insert new food order
-    INSERT INTO food_orders(user_id, food_category, food_item, quantity, order_timestamp)
-      VALUES (local_user_id, _food_category, _food_item, _quantity, _order_timestamp);
+    INSERT INTO food_orders (user_id, food_category, food_item, quantity, order_timestamp)
+    SELECT u.local_id, o.food_category, o.food_item, o.quantity, o.order_timestamp
+    FROM unnest(_user_ids, _food_categories, _food_items, _quantities, _order_timestamps) AS o(user_tg_id, food_category, food_item, quantity, order_timestamp)
+    LEFT JOIN users u ON u.tg_id = o.user_tg_id;
 
   END;
 $$ LANGUAGE plpgsql;
 
--- replace user_id with local id
-CREATE OR REPLACE FUNCTION insert_bus_click(_user_id INTEGER, _click_timestamp TIMESTAMP, _route_id VARCHAR(50), _route_start_time TIMESTAMP, _shuttle_id INTEGER) RETURNS VOID AS $$
-  DECLARE
-    local_user_id INTEGER := (SELECT local_id FROM users WHERE tg_id = _user_id);
+-- insert buses clicks (users are given by the telegram ids)
+CREATE OR REPLACE FUNCTION insert_bus_clicks(_user_ids INTEGER[], _click_timestamps TIMESTAMP[], _route_ids VARCHAR(50)[], _route_start_times TIMESTAMP[], _shuttle_ids INTEGER[]) RETURNS VOID AS $$
   BEGIN
 
-    -- check if the user exists
-    IF _user_id NOT IN (SELECT tg_id FROM users) THEN
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES (_user_id, NULL, NULL, NULL);
-      local_user_id := (SELECT local_id FROM users WHERE tg_id = _user_id);
-    END IF;
+    PERFORM insert_missing_users(_user_ids);
 
-    INSERT INTO buses_clicks(user_id, click_timestamp, route_id, route_start_time, shuttle_id)
-    VALUES (local_user_id, _click_timestamp, _route_id, _route_start_time, _shuttle_id);
+    INSERT INTO buses_clicks (user_id, click_timestamp, route_id, route_start_time, shuttle_id)
+    SELECT u.local_id, c.click_timestamp, c.route_id, c.route_start_time, c.shuttle_id
+    FROM unnest(_user_ids, _click_timestamps, _route_ids, _route_start_times, _shuttle_ids) AS c(user_tg_id, click_timestamp, route_id, route_start_time, shuttle_id)
+    LEFT JOIN users u ON u.tg_id = c.user_tg_id;
 
   END;
 $$ LANGUAGE plpgsql;
 
--- replace user_id with local id
-CREATE OR REPLACE FUNCTION insert_placed_ad(_user_id INTEGER, _placed_timestamp TIMESTAMP, _category_title VARCHAR(15), _ad_type VARCHAR(15), _views_count INTEGER, _likes_count INTEGER) RETURNS VOID AS $$
-  DECLARE
-    local_user_id INTEGER := (SELECT local_id FROM users WHERE tg_id = _user_id);
+-- insert placed ads (users are given by the telegram ids)
+CREATE OR REPLACE FUNCTION insert_placed_ads(_user_ids INTEGER[], _placed_timestamps TIMESTAMP[], _category_titles VARCHAR(15)[], _ad_types VARCHAR(15)[], _views_counts INTEGER[], _likes_counts INTEGER[]) RETURNS VOID AS $$
+  BEGIN
+
+    PERFORM insert_missing_users(_user_ids);
+
+    INSERT INTO placed_ads (user_id, placed_timestamp, category_title, ad_type, views_count, likes_count)
+    SELECT u.local_id, a.placed_timestamp, a.category_title, a.ad_type, a.views_count, a.likes_count
+    FROM unnest(_user_ids, _placed_timestamps, _category_titles, _ad_types, _views_counts, _likes_counts) AS a(user_tg_id, placed_timestamp, category_title, ad_type, views_count, likes_count)
+    LEFT JOIN users u ON u.tg_id = a.user_tg_id;
+
+  END;
+$$ LANGUAGE plpgsql;
+
+-- functions for single rows are kept for compatibility, they call the set-based ones
+
+-- update or insert user
+CREATE OR REPLACE FUNCTION insert_user(user_id INTEGER, first_name VARCHAR(250), last_name VARCHAR(250), username VARCHAR(250)) RETURNS VOID AS $$
+  BEGIN
+    PERFORM insert_users(ARRAY[$1], ARRAY[$2], ARRAY[$3], ARRAY[$4]);
+  END;
+$$ LANGUAGE plpgsql;
+
+-- replace user_id with the local id
+CREATE OR REPLACE FUNCTION insert_user_in_chat(_chat_id INTEGER, _user_id INTEGER, _entering_diff FLOAT, _avg_msg_frequency FLOAT, _avg_msg_length FLOAT) RETURNS VOID AS $$
+  BEGIN
+    PERFORM insert_users_in_chats(ARRAY[_chat_id], ARRAY[_user_id], ARRAY[_entering_diff], ARRAY[_avg_msg_frequency], ARRAY[_avg_msg_length]);
+  END;
+$$ LANGUAGE plpgsql;
+
+-- replace user_id with the local id
+CREATE OR REPLACE FUNCTION insert_user_in_bot(_bot_title VARCHAR(50), _user_id INTEGER, _lang VARCHAR(10)) RETURNS VOID AS $$
+  BEGIN
+    PERFORM insert_users_in_bots(ARRAY[_bot_title], ARRAY[_user_id], ARRAY[_lang]);
+  END;
+$$ LANGUAGE plpgsql;
+
+-- check if the message length is less than 500, and replace user_id with local id
+DROP FUNCTION insert_message(INTEGER, VARCHAR(4000), VARCHAR(50), INTEGER, INTEGER);
+CREATE OR REPLACE FUNCTION insert_message(_msg_id INTEGER, _msg_text VARCHAR(4000), _date TIMESTAMP, _chat_id INTEGER, _user_id INTEGER) RETURNS VOID AS $$
   BEGIN
+    PERFORM insert_messages(ARRAY[_msg_id], ARRAY[_msg_text], ARRAY[_date], ARRAY[_chat_id], ARRAY[_user_id]);
+  END;
+$$ LANGUAGE plpgsql;
 
-    -- check if the user exists
-    IF _user_id NOT IN (SELECT tg_id FROM users) THEN
-      INSERT INTO users (tg_id, first_name, last_name, username) VALUES (_user_id, NULL, NULL, NULL);
-      local_user_id := (SELECT local_id FROM users WHERE tg_id = _user_id);
-    END IF;
+-- replace user_id with local id
+-- SELECT * FROM insert_food_order(216842240, 'pizza', 'маргарита', '2017-02-15 15:45:19.173Z');
+CREATE OR REPLACE FUNCTION insert_food_order(_user_id INTEGER, _food_category VARCHAR(100), _food_item VARCHAR(500), _quantity INTEGER, _order_timestamp TIMESTAMP) RETURNS VOID AS $$
+  BEGIN
+    PERFORM insert_food_orders(ARRAY[_user_id], ARRAY[_food_category], ARRAY[_food_item], ARRAY[_quantity], ARRAY[_order_timestamp]);
+  END;
+$$ LANGUAGE plpgsql;
 
-    INSERT INTO placed_ads(user_id, placed_timestamp, category_title, ad_type, views_count, likes_count)
-    VALUES (local_user_id, _placed_timestamp, _category_title, _ad_type, _views_count, _likes_count);
+-- replace user_id with local id
+CREATE OR REPLACE FUNCTION insert_bus_click(_user_id INTEGER, _click_timestamp TIMESTAMP, _route_id VARCHAR(50), _route_start_time TIMESTAMP, _shuttle_id INTEGER) RETURNS VOID AS $$
+  BEGIN
+    PERFORM insert_bus_clicks(ARRAY[_user_id], ARRAY[_click_timestamp], ARRAY[_route_id], ARRAY[_route_start_time], ARRAY[_shuttle_id]);
+  END;
+$$ LANGUAGE plpgsql;
 
+-- replace user_id with local id
+CREATE OR REPLACE FUNCTION insert_placed_ad(_user_id INTEGER, _placed_timestamp TIMESTAMP, _category_title VARCHAR(15), _ad_type VARCHAR(15), _views_count INTEGER, _likes_count INTEGER) RETURNS VOID AS $$
+  BEGIN
+    PERFORM insert_placed_ads(ARRAY[_user_id], ARRAY[_placed_timestamp], ARRAY[_category_title], ARRAY[_ad_type], ARRAY[_views_count], ARRAY[_likes_count]);
   END;
 $$ LANGUAGE plpgsql;
 
@@ -1 +1,3 @@
 from .telegram_client import TgClient, SettingsHolder
+from .clients_pool import TgClientsPool
+from .chats_listener import ChatsListener
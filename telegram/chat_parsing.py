@@ -0,0 +1,250 @@
+from datetime import datetime, timedelta
+from typing import List, Any, Iterable
+
+from telethon.tl.types import Channel
+from telethon.tl.types import MessageActionChatAddUser
+from telethon.tl.types import MessageActionChatJoinedByLink
+from telethon.tl.types import MessageService
+
+from models import Chat, ChatsEntities, Message, User
+from models import UserInChat
+from .sync_state import ChatSyncState
+
+
+class UserStatistics:
+    """
+    Fixed-size statistics of a user in a chat, which are enough to calculate the UserInChat entity
+    """
+    __slots__ = ('total_len', 'text_msgs_count', 'total_msgs_count', 'join_datetime')
+
+    def __init__(self, total_len: int = 0, text_msgs_count: int = 0, total_msgs_count: int = 0,
+                 join_datetime: datetime = None):
+        self.total_len = total_len
+        self.text_msgs_count = text_msgs_count
+        self.total_msgs_count = total_msgs_count
+        self.join_datetime = join_datetime
+
+    def copy(self):
+        return UserStatistics(self.total_len, self.text_msgs_count, self.total_msgs_count, self.join_datetime)
+
+    def add_joining(self, join_datetime: datetime):
+        # the earliest joining is kept
+        if not self.join_datetime or join_datetime < self.join_datetime:
+            self.join_datetime = join_datetime
+
+
+class ChatHistoryParser:
+    """
+    Streaming parser of the history of a chat.
+
+    Pages of raw messages are consumed as they are downloaded (in any order), and only per-user statistics,
+    parsed users and parsed messages are kept, so the memory doesn't depend on the size of the raw history.
+    """
+
+    def __init__(self, chat: Channel, chat_state: ChatSyncState = None):
+        """
+        :param chat_state: state of the chat after the previous sync (if only newer messages are parsed)
+        """
+        self.chat = chat
+        self._incremental = chat_state is not None
+
+        if chat_state:
+            self._max_msg_id = chat_state.max_msg_id
+            self._creation_datetime = min(chat.date, chat_state.creation_datetime)
+            self._users_statistics = {u_id: s.copy() for u_id, s in chat_state.users_statistics.items()}
+
+        else:
+            self._max_msg_id = 0
+            self._creation_datetime = chat.date
+            self._users_statistics = {}
+
+        # users, who have joined the chat, but are unknown yet: Dict[user id, first name]
+        self._joined_users = {}
+
+        # users, whose statistics have been changed by the consumed pages
+        self._changed_users_ids = set()
+
+        self.users, self.messages = set(), set()
+
+        # ids of the parsed users, which have been already popped (see pop_entities)
+        self._popped_users_ids = set()
+
+    @staticmethod
+    def parse_chat(chat: Channel, users_count: int, messages_count: int, creation_datetime: datetime) -> Chat:
+        if chat:
+            return Chat(chat.id, chat.title, users_count, messages_count, creation_datetime)
+
+    @staticmethod
+    def parse_message(msg, channel_id) -> Message:
+        # service message: who has joined, who has been invited, ...
+        if msg and not isinstance(msg, MessageService) and msg.message:
+            message_text = msg.message
+
+            if message_text and 2 < len(message_text) < 500:
+                return Message(msg.id, message_text, msg.date, msg.from_id, channel_id)
+
+    @staticmethod
+    def parse_user(user) -> User:
+        if user:
+            return User(user.id, user.first_name, user.last_name, user.username)
+
+    def _add_joining(self, joiner_id: int, first_name: str, join_datetime: datetime):
+        joiner_statistics = self._users_statistics.get(joiner_id)
+
+        if not joiner_statistics:
+            self._joined_users[joiner_id] = first_name
+
+            joiner_statistics = self._users_statistics[joiner_id] = UserStatistics()
+
+        joiner_statistics.add_joining(join_datetime)
+        self._changed_users_ids.add(joiner_id)
+
+    def add_page(self, history: List[Any], senders: List[Any]):
+        """
+        Consumes the page of raw messages and their senders
+        """
+        # TODO: parse who added who
+        for user in senders:
+            if user.id not in self._users_statistics:
+                self._users_statistics[user.id] = UserStatistics()
+                self._changed_users_ids.add(user.id)
+
+            self.users.add(self.parse_user(user))
+
+        for msg in history:
+            if msg.id > self._max_msg_id:
+                self._max_msg_id = msg.id
+
+            # service message
+            if isinstance(msg, MessageService):
+                action = msg.action
+
+                join_datetime = msg.date
+                if join_datetime < self._creation_datetime:
+                    self._creation_datetime = join_datetime
+
+                # user has joined the chat by link or has been invited by someone
+                if isinstance(action, MessageActionChatJoinedByLink):
+                    # MessageActionChatJoinedByLink:
+                    #   action.inviter_id - id of the people who has joined
+                    self._add_joining(msg.from_id, 'joined by link', join_datetime)
+
+                elif isinstance(action, MessageActionChatAddUser):
+                    # MessageActionChatAddUser:
+                    #   msg.from_id - id of the people who has invited
+                    #   action.users - list of users who have been invited
+                    if not action.users:
+                        print('Warning: empty "users" field of the MessageActionChatAddUser')
+                        continue
+
+                    for joiner_id in action.users:
+                        self._add_joining(joiner_id, 'was invited', join_datetime)
+
+            # message written directly by user
+            else:
+                message = self.parse_message(msg, self.chat.id)
+
+                if message:
+                    self.messages.add(message)
+
+                sender_statistics = self._users_statistics.get(msg.from_id)
+
+                if not sender_statistics:
+                    print('Missed user with id #%s' % str(msg.from_id if msg.from_id else 'None'))
+                    continue
+
+                # message with a text
+                if msg.message:
+                    # increase total messages length
+                    sender_statistics.total_len += len(msg.message)
+                    sender_statistics.text_msgs_count += 1
+
+                sender_statistics.total_msgs_count += 1
+                self._changed_users_ids.add(msg.from_id)
+
+    def _get_users_in_chat(self, users_ids: Iterable[int]) -> List[UserInChat]:
+        """
+        # 1) Average common messages frequency (count/day)
+        # 2) Average messages length
+        # 3) Difference between chat creation and chat entering
+        """
+        users_in_chat = []
+
+        now = datetime.now()
+
+        for u_id in users_ids:
+            statistics = self._users_statistics[u_id]
+            join_datetime = statistics.join_datetime
+
+            # calculate average messages length
+            text_msgs_count, total_len = statistics.text_msgs_count, statistics.total_len
+            avg_msg_len = total_len / text_msgs_count if text_msgs_count else 0
+
+            # calculate average messages frequency
+            # TODO: add chat characteristic
+            total_msgs_count = statistics.total_msgs_count
+
+            if join_datetime:
+                now_entering_diff = now - join_datetime
+            else:
+                now_entering_diff = now - self._creation_datetime
+
+            days_count = now_entering_diff.days
+            avg_daily_freq = total_msgs_count / days_count if days_count else 0
+
+            # calculate difference between chat entering and chat creation
+            if join_datetime:
+                creation_entering_diff = join_datetime - self._creation_datetime
+
+            else:
+                creation_entering_diff = timedelta()
+
+            users_in_chat.append(UserInChat(self.chat.id, u_id,
+                                            creation_entering_diff.total_seconds(),
+                                            avg_daily_freq, avg_msg_len))
+
+        return users_in_chat
+
+    def pop_entities(self, entities: ChatsEntities, messages_count: int):
+        """
+        Moves the users and messages parsed so far to the :entities (with the chat entity, which they refer to),
+        so they can be uploaded before the whole history is consumed. Statistics of the users are kept.
+        """
+        entities.users.update(self.users)
+        entities.messages.update(self.messages)
+
+        entities.chats.add(self.parse_chat(self.chat, len(self._users_statistics), messages_count,
+                                           self._creation_datetime))
+
+        self._popped_users_ids.update(u.uid for u in self.users)
+        self.users, self.messages = set(), set()
+
+    def finish(self, entities: ChatsEntities, messages_count: int, only_changed_users: bool = False) -> ChatSyncState:
+        """
+        Adds entities parsed from the consumed pages to the :entities
+        :param only_changed_users: if True - users_in_chat entities are added only for the users,
+        whose statistics have been changed by the consumed pages (otherwise - for all the users of the chat)
+        :return: new state of the chat
+        """
+        if self._incremental:
+            entities.incremental = True
+
+        # add users_in_chat entities for the chat
+        users_ids = self._changed_users_ids if only_changed_users else self._users_statistics.keys()
+        entities.users_in_chats.update(self._get_users_in_chat(users_ids))
+
+        # add users from the chat, and the joined ones, who have never sent anything
+        parsed_users_ids = self._popped_users_ids.union(u.uid for u in self.users)
+        extra_chat_users = {User(u_id, first_name) for u_id, first_name in self._joined_users.items()
+                            if u_id not in parsed_users_ids}
+
+        entities.users.update(self.users.union(extra_chat_users))
+
+        # add messages from the chat
+        entities.messages.update(self.messages)
+
+        # finally - add chat entity
+        entities.chats.add(self.parse_chat(self.chat, len(self._users_statistics), messages_count,
+                                           self._creation_datetime))
+
+        return ChatSyncState(self._max_msg_id, self._creation_datetime, self._users_statistics)
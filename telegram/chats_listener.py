@@ -0,0 +1,232 @@
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterable, List, Any
+
+from telethon.tl.types import Channel, MessageService, MessageActionChatAddUser
+from telethon.tl.types import UpdatesTg, UpdatesCombined, UpdateNewChannelMessage
+
+from models import ChatsEntities
+from .chat_parsing import ChatHistoryParser
+from .telegram_client import TgClient
+
+
+class ChatsListener:
+    """
+    Real-time ingestion of the chats: new messages (and joinings) are received as updates from Telegram
+    and parsed as soon as they come, continuing from the sync state of the chats.
+
+    Parsed entities are flushed in micro-batches: messages and users, which have come since the previous flush,
+    and users_in_chat entities (frequency, average length, joining) of the users, whose statistics have changed.
+    A flush happens every :flush_interval seconds, or once :flush_messages new messages have been received.
+
+    Chats, which have been synced before, are first downloaded from their high-water marks (see start),
+    so the messages posted while nobody was listening are not skipped. After a flush the sync state of these chats
+    is saved, so the next crawl continues from the received messages.
+    High-water marks of the chats, which have never been synced, are not saved (only the received messages
+    are parsed for them), so the next crawl still downloads their whole histories.
+    """
+
+    def __init__(self, client: TgClient, chats: Iterable[Channel], on_flush: Callable[[ChatsEntities], Any],
+                 flush_interval: float = 10., flush_messages: int = 1000):
+        """
+        :param on_flush: callback, which receives the entities of each micro-batch (e.g. uploads them)
+        """
+        self._client = client
+        self._on_flush = on_flush
+        self._flush_interval, self._flush_messages = flush_interval, flush_messages
+
+        self._chats = {chat.id: chat for chat in chats}
+
+        # ids of the chats, which have been synced before
+        self._synced_chats_ids = {chat_id for chat_id in self._chats if client.get_sync_state(chat_id)}
+
+        # states of the chats, which have never been synced (they are kept only by the listener)
+        self._unsynced_states = {}
+
+        # parsers of the messages received since the previous flush and total messages counts of the chats
+        self._parsers = {chat_id: client.get_history_parser(chat) for chat_id, chat in self._chats.items()}
+        self._messages_counts = {chat_id: client.get_messages_count(chat) for chat_id, chat in self._chats.items()}
+
+        # ids of the newest parsed messages of the chats (older messages are not parsed again)
+        self._max_msg_ids = {chat_id: client.get_sync_state(chat_id).max_msg_id for chat_id in self._synced_chats_ids}
+        self._max_msg_ids.update({chat_id: 0 for chat_id in self._chats if chat_id not in self._synced_chats_ids})
+
+        # updates are buffered until the chats are downloaded from their high-water marks (see start)
+        self._backfilling = False
+        self._buffered_pages = []
+
+        # chats, which have received messages since the previous flush
+        self._changed_chats_ids = set()
+        self._pending_messages_count = 0
+        self._last_flush_time = monotonic()
+
+        # parsers are changed by the updates handlers; flushes are made one at a time
+        self._lock, self._flush_lock = Lock(), Lock()
+
+    def _on_update(self, update):
+        """
+        Handler of the updates from Telegram (called by the updates thread of the client)
+        """
+        if isinstance(update, (UpdatesTg, UpdatesCombined)):
+            updates, users = update.updates, update.users
+        else:
+            updates, users = [update], []
+
+        messages = [u.message for u in updates if isinstance(u, UpdateNewChannelMessage)]
+        messages = [m for m in messages if m and getattr(m.to_id, 'channel_id', None) in self._chats]
+
+        if not messages:
+            return
+
+        users = {u.id: u for u in users}
+
+        with self._lock:
+            for chat_id in {m.to_id.channel_id for m in messages}:
+                history = [m for m in messages if m.to_id.channel_id == chat_id]
+
+                # senders of the messages and the invited users
+                users_ids = {m.from_id for m in history}
+                for m in history:
+                    if isinstance(m, MessageService) and isinstance(m.action, MessageActionChatAddUser):
+                        users_ids.update(m.action.users or [])
+
+                senders = [users[u_id] for u_id in users_ids if u_id in users]
+
+                if self._backfilling:
+                    self._buffered_pages.append((chat_id, history, senders))
+                else:
+                    self._add_received_page(chat_id, history, senders)
+
+            # high-water marks can't be saved until the chats are downloaded (pages go from newest to oldest)
+            flush_needed = not self._backfilling and self._pending_messages_count >= self._flush_messages
+
+        if flush_needed:
+            try:
+                self.flush()
+
+            # errors are not propagated by the updates thread
+            except Exception as e:
+                print('Error flushing received messages: %s' % str(e))
+
+    def _add_received_page(self, chat_id: int, history: List[Any], senders: List[Any]):
+        """
+        Parses the received messages of the chat, which have not been parsed yet (should be called under the lock)
+        """
+        history = [m for m in history if m.id > self._max_msg_ids[chat_id]]
+
+        if not history:
+            return
+
+        self._max_msg_ids[chat_id] = max(m.id for m in history)
+
+        self._messages_counts[chat_id] += len(history)
+        self._client.cache_new_messages(self._chats[chat_id], history, senders, self._messages_counts[chat_id])
+
+        self._parsers[chat_id].add_page(history, senders)
+        self._changed_chats_ids.add(chat_id)
+        self._pending_messages_count += len(history)
+
+    def _backfill(self):
+        """
+        Downloads the messages of the synced chats, which have been posted since their high-water marks
+        """
+        for chat_id in self._synced_chats_ids:
+            chat = self._chats[chat_id]
+
+            for messages_count, history, senders in self._client.iter_chat_pages(chat):
+                with self._lock:
+                    self._messages_counts[chat_id] = messages_count
+                    self._parsers[chat_id].add_page(history, senders)
+
+                    if history:
+                        self._max_msg_ids[chat_id] = max(self._max_msg_ids[chat_id], max(m.id for m in history))
+                        self._changed_chats_ids.add(chat_id)
+                        self._pending_messages_count += len(history)
+
+    def flush(self) -> ChatsEntities:
+        """
+        Passes the entities parsed since the previous flush to the callback, and saves the sync state
+        :return: flushed entities
+        """
+        with self._flush_lock:
+            entities = ChatsEntities()
+
+            with self._lock:
+                for chat_id in self._changed_chats_ids:
+                    chat = self._chats[chat_id]
+
+                    # the next batch continues from the new state of the chat
+                    if chat_id in self._synced_chats_ids:
+                        self._client.add_chat_entities(entities, self._messages_counts[chat_id],
+                                                       self._parsers[chat_id], only_changed_users=True)
+
+                        self._parsers[chat_id] = self._client.get_history_parser(chat)
+
+                    else:
+                        self._unsynced_states[chat_id] = self._parsers[chat_id].finish(
+                            entities, self._messages_counts[chat_id], only_changed_users=True)
+
+                        self._parsers[chat_id] = ChatHistoryParser(chat, self._unsynced_states[chat_id])
+
+                flushed_chats = [self._chats[chat_id] for chat_id in self._changed_chats_ids
+                                 if chat_id in self._synced_chats_ids]
+
+                self._changed_chats_ids.clear()
+                self._pending_messages_count = 0
+                self._last_flush_time = monotonic()
+
+            if entities.chats:
+                self._on_flush(entities)
+
+            # the received messages of the synced chats are not downloaded by the next crawl
+            if flushed_chats:
+                self._client.complete_sync(flushed_chats)
+
+            return entities
+
+    def start(self):
+        """
+        Starts receiving the updates, and downloads the synced chats from their high-water marks meanwhile:
+        the updates received during the download are parsed after it (the downloaded messages are skipped)
+        """
+        with self._lock:
+            self._backfilling = True
+
+        self._client.add_update_handler(self._on_update)
+
+        try:
+            self._backfill()
+
+        finally:
+            with self._lock:
+                for chat_id, history, senders in self._buffered_pages:
+                    self._add_received_page(chat_id, history, senders)
+
+                self._buffered_pages.clear()
+                self._backfilling = False
+
+    def stop(self):
+        self._client.remove_update_handler(self._on_update)
+
+        self.flush()
+
+    def listen(self, duration: float = None):
+        """
+        Receives the updates until the :duration (in seconds) has passed (or forever), flushing them periodically
+        """
+        start_time = monotonic()
+
+        self.start()
+
+        try:
+            while duration is None or monotonic() - start_time < duration:
+                sleep(max(self._last_flush_time + self._flush_interval - monotonic(), 0.))
+
+                if monotonic() - self._last_flush_time >= self._flush_interval:
+                    self.flush()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.stop()
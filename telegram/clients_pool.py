@@ -0,0 +1,105 @@
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from typing import List, Optional
+
+from models import ChatsEntities
+from .telegram_client import TgClient, SettingsHolder
+
+
+class TgClientsPool:
+    """
+    Pool of Telegram clients of several accounts, which download the chats together.
+
+    Each chat is assigned to one of the accounts, which have it in dialogs (the same one between runs,
+    so the high-water marks of the account are used). Once an account runs out of its chats, it steals
+    not started chats of the others; an account throttled by the server doesn't start new chats,
+    so they are stolen by the accounts, which are free.
+    """
+    # flood wait (in seconds), after which an account is considered as throttled
+    _throttled_after = 10.
+
+    def __init__(self, config_files_paths: List[str], debug_mode=False):
+        self.clients = [TgClient(debug_mode=debug_mode, **SettingsHolder(config_file_path).get_settings_dict())
+                        for config_file_path in config_files_paths]
+
+        self._lock = Lock()
+
+    def _next_chat(self, client_index: int, queues: List[deque], clients_chats: List[dict]) -> Optional[str]:
+        """
+        :return: title of the next chat for the client: its own one, or stolen from the most loaded client
+        """
+        with self._lock:
+            if queues[client_index]:
+                return queues[client_index].popleft()
+
+            for queue in sorted(queues, key=len, reverse=True):
+                # the last chats of the queue are stolen (the owner would take them last)
+                for title in reversed(queue):
+                    if title in clients_chats[client_index]:
+                        queue.remove(title)
+
+                        return title
+
+            return None
+
+    def _work(self, client_index: int, queues: List[deque], clients_chats: List[dict], entities: ChatsEntities):
+        client, client_chats = self.clients[client_index], clients_chats[client_index]
+        downloaded_chats = []
+
+        while True:
+            # don't take chats while throttled - they can be downloaded by the other accounts meanwhile
+            while client.requests_blocked_for > self._throttled_after:
+                sleep(client.requests_blocked_for - self._throttled_after)
+
+            title = self._next_chat(client_index, queues, clients_chats)
+            if title is None:
+                break
+
+            messages_count, history_parser = client.download_chat(client_chats[title])
+            downloaded_chats.append(client_chats[title])
+
+            with self._lock:
+                client.add_chat_entities(entities, messages_count, history_parser)
+
+        return downloaded_chats
+
+    def get_chats_entities(self, chats_names: List[str], incremental: bool = True) -> ChatsEntities:
+        """
+        Downloads and parses histories of the chats with the given titles using all the accounts of the pool.
+        :param incremental: see TgClient.get_chats_entities
+        """
+        clients_chats = []
+
+        for client in self.clients:
+            client.start_sync(incremental)
+            clients_chats.append(client.find_chats(chats_names))
+
+        # if some chats not found
+        not_found = set(chats_names).difference(*[client_chats.keys() for client_chats in clients_chats])
+        if not_found:
+            raise ValueError('Chats %s not found, exiting.' % str(not_found))
+        else:
+            print('Found all the %d chats.\nMessages and users gathering started.' % len(set(chats_names)))
+
+        # shard the chats between the accounts, which have them in dialogs (by stable hash of the title)
+        queues = [deque() for _ in self.clients]
+
+        for title in set(chats_names):
+            owners = [i for i, client_chats in enumerate(clients_chats) if title in client_chats]
+            queues[owners[zlib.crc32(title.encode('utf-8')) % len(owners)]].append(title)
+
+        chats_entities = ChatsEntities()
+
+        with ThreadPoolExecutor(max_workers=len(self.clients)) as executor:
+            works = [executor.submit(self._work, i, queues, clients_chats, chats_entities)
+                     for i in range(len(self.clients))]
+
+            clients_downloaded_chats = [work.result() for work in works]
+
+        for client, downloaded_chats in zip(self.clients, clients_downloaded_chats):
+            client.complete_sync(downloaded_chats)
+
+        return chats_entities
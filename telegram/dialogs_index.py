@@ -0,0 +1,38 @@
+import os
+import pickle
+from typing import Any, Optional
+
+
+class DialogsIndex:
+    """
+    Persisted index of the chats (dialogs) of a Telegram session: Dict[title, chat entity].
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+
+        self._chats = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self._file_path):
+            return {}
+
+        with open(self._file_path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self):
+        tmp_file_path = self._file_path + '.tmp'
+
+        with open(tmp_file_path, 'wb') as f:
+            pickle.dump(self._chats, f)
+
+        os.replace(tmp_file_path, self._file_path)
+
+    def get(self, title: str) -> Optional[Any]:
+        return self._chats.get(title)
+
+    def set(self, title: str, chat: Any):
+        self._chats[title] = chat
+
+    def __contains__(self, title: str):
+        return title in self._chats
@@ -0,0 +1,122 @@
+import os
+import pickle
+import shutil
+import struct
+import zlib
+from typing import Generator, List, Tuple, Any
+
+
+class MessagesCache:
+    """
+    Append-only on-disk store of raw pages of messages, downloaded from Telegram.
+
+    Each chat has its own folder with numbered segment files. A segment is a sequence of records:
+    4 bytes of the record length followed by the zlib-compressed pickle of Tuple(messages, senders) of a page.
+    A new segment is started by each process writing to the chat and once the current one exceeds :segment_size bytes,
+    so a record torn by a killed process can only be the last one of its segment.
+    Besides the pages, the chat folder keeps the raw chat entity and its total messages count.
+    """
+    _record_header = struct.Struct('>I')
+    _segment_name_format = '%08d.seg'
+    _chat_filename = 'chat'
+
+    def __init__(self, folder_path: str, segment_size: int = 16 * 1024 * 1024, compression_level: int = 6):
+        self._folder_path = folder_path
+        self._segment_size = segment_size
+        self._compression_level = compression_level
+
+        # segments written by this process: Dict[chat id, segment path]
+        self._active_segments = {}
+
+        if not os.path.exists(self._folder_path):
+            os.makedirs(self._folder_path)
+
+    def _chat_folder(self, chat_id: int) -> str:
+        return os.path.join(self._folder_path, str(chat_id))
+
+    def _segments_paths(self, chat_id: int) -> List[str]:
+        chat_folder = self._chat_folder(chat_id)
+
+        if not os.path.exists(chat_folder):
+            return []
+
+        # segments names are zero-padded numbers, so they are sorted in order of writing
+        return [os.path.join(chat_folder, name) for name in sorted(os.listdir(chat_folder)) if name.endswith('.seg')]
+
+    def append_page(self, chat_id: int, messages: List[Any], senders: List[Any]):
+        chat_folder = self._chat_folder(chat_id)
+
+        if not os.path.exists(chat_folder):
+            os.makedirs(chat_folder)
+
+        # continue the segment of this process, or start the new one if there is no such or it's full
+        segment_path = self._active_segments.get(chat_id)
+
+        if not segment_path or os.path.getsize(segment_path) >= self._segment_size:
+            segment_path = os.path.join(chat_folder, self._segment_name_format % len(self._segments_paths(chat_id)))
+            self._active_segments[chat_id] = segment_path
+
+        record = zlib.compress(pickle.dumps((messages, senders), pickle.HIGHEST_PROTOCOL), self._compression_level)
+
+        with open(segment_path, 'ab') as f:
+            f.write(self._record_header.pack(len(record)))
+            f.write(record)
+
+    def iter_pages(self, chat_id: int) -> Generator[Tuple[List[Any], List[Any]], None, None]:
+        """
+        Yields Tuple(messages, senders) of each cached page of the chat, in order of writing.
+        A record, which was not completely written (e.g. the process was killed), ends its segment.
+        """
+        for segment_path in self._segments_paths(chat_id):
+            with open(segment_path, 'rb') as f:
+                while True:
+                    header = f.read(self._record_header.size)
+                    if len(header) < self._record_header.size:
+                        break
+
+                    record_length, = self._record_header.unpack(header)
+                    record = f.read(record_length)
+
+                    try:
+                        page = pickle.loads(zlib.decompress(record))
+
+                    except (zlib.error, pickle.UnpicklingError, EOFError):
+                        print('Warning: incomplete record at the end of %s' % segment_path)
+                        break
+
+                    yield page
+
+    def save_chat(self, chat: Any, messages_count: int):
+        chat_folder = self._chat_folder(chat.id)
+
+        if not os.path.exists(chat_folder):
+            os.makedirs(chat_folder)
+
+        with open(os.path.join(chat_folder, self._chat_filename), 'wb') as f:
+            pickle.dump((chat, messages_count), f, pickle.HIGHEST_PROTOCOL)
+
+    def get_chat(self, chat_id: int) -> Tuple[Any, int]:
+        """
+        :return: Tuple(raw chat entity, total messages count)
+        """
+        with open(os.path.join(self._chat_folder(chat_id), self._chat_filename), 'rb') as f:
+            return pickle.load(f)
+
+    def get_chats_ids(self) -> List[int]:
+        """
+        Ids of the chats, which have been completely downloaded at least once
+        """
+        return [int(name) for name in os.listdir(self._folder_path)
+                if os.path.exists(os.path.join(self._folder_path, name, self._chat_filename))]
+
+    def clear_chat(self, chat_id: int):
+        chat_folder = self._chat_folder(chat_id)
+
+        self._active_segments.pop(chat_id, None)
+
+        if os.path.exists(chat_folder):
+            shutil.rmtree(chat_folder)
+
+    def clear(self):
+        for chat_id in os.listdir(self._folder_path):
+            self.clear_chat(int(chat_id))
@@ -0,0 +1,94 @@
+from threading import Lock
+from time import monotonic, sleep
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket, shared by all the requests of a client (and all the downloads they are made for).
+
+    Each request takes a token; tokens are refilled with the current rate (requests per second).
+    The rate is halved when the server asks to wait (FLOOD_WAIT), and it is increased by :rate_step
+    after each :speed_up_after successful requests in a row, so it follows the real limit of the server.
+    """
+
+    def __init__(self, rate: float = 1., min_rate: float = 0.1, max_rate: float = 10., rate_step: float = 0.1,
+                 speed_up_after: int = 50, burst: int = 1):
+        """
+        :param rate: initial rate (requests per second)
+        :param burst: capacity of the bucket (how many requests can be made at once after a pause)
+        """
+        self._rate = rate
+        self._min_rate, self._max_rate, self._rate_step = min_rate, max_rate, rate_step
+        self._speed_up_after = speed_up_after
+        self._burst = burst
+
+        self._lock = Lock()
+
+        # tokens are refilled from the last refill time (it's in the future while the server's flood wait lasts)
+        self._tokens = float(burst)
+        self._last_refill_time = monotonic()
+
+        self._successes_in_row = 0
+
+    @property
+    def rate(self) -> float:
+        """
+        Current rate (requests per second)
+        """
+        return self._rate
+
+    @property
+    def blocked_for(self) -> float:
+        """
+        How long (in seconds) the requests are blocked by the server's flood wait
+        """
+        return max(self._last_refill_time - monotonic(), 0.)
+
+    def _refill(self, now: float):
+        if now > self._last_refill_time:
+            self._tokens = min(self._burst, self._tokens + (now - self._last_refill_time) * self._rate)
+            self._last_refill_time = now
+
+    def acquire(self):
+        """
+        Blocks the calling thread until the next request is allowed.
+        """
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+
+            # take the token in advance: if there are no tokens, the caller waits until it is refilled
+            self._tokens -= 1
+            wait_time = max(self._last_refill_time - now, 0) + max(-self._tokens / self._rate, 0)
+
+        if wait_time > 0:
+            sleep(wait_time)
+
+    def on_success(self):
+        """
+        Should be called after each successful request
+        """
+        with self._lock:
+            self._successes_in_row += 1
+
+            if self._successes_in_row >= self._speed_up_after:
+                self._successes_in_row = 0
+                self._set_rate(self._rate + self._rate_step)
+
+    def on_flood_wait(self, seconds: float):
+        """
+        Should be called when the server has asked to wait :seconds before the next request
+        """
+        with self._lock:
+            self._successes_in_row = 0
+            self._set_rate(self._rate / 2)
+
+            # nobody makes requests until the wait is over, and the bucket starts empty after it
+            self._tokens = min(self._tokens, 0.)
+            self._last_refill_time = max(self._last_refill_time, monotonic() + seconds)
+
+    def _set_rate(self, rate: float):
+        # tokens collected with the old rate must not be lost
+        self._refill(monotonic())
+
+        self._rate = min(max(rate, self._min_rate), self._max_rate)
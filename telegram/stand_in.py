@@ -0,0 +1,273 @@
+import os
+import tempfile
+import tracemalloc
+from abc import abstractmethod
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import List, Tuple, Any
+
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.messages import GetDialogsRequest
+from telethon.tl.types import Channel, ChatPhotoEmpty, PeerChannel, PeerUser, User
+from telethon.tl.types import Message, MessageService, MessageActionChatAddUser, MessageActionChatJoinedByLink
+
+from .messages_cache import MessagesCache
+from .telegram_client import TgClient
+
+
+class UnsupportedRequestError(Exception):
+    """
+    Raised by the stand-in for requests, which are not served by it (only the requests sent by TgClient are)
+    """
+    pass
+
+
+class DialogsPage:
+    """
+    Result of the GetDialogsRequest (only the fields used by TgClient)
+    """
+
+    def __init__(self, dialogs: List[Any], messages: List[Any], users: List[Any], chats: List[Any]):
+        self.dialogs = dialogs
+        self.messages = messages
+        self.users = users
+        self.chats = chats
+
+
+class StandInDialog:
+    def __init__(self, peer: Any, top_message: int):
+        self.peer = peer
+        self.top_message = top_message
+
+
+class StandInBackend:
+    """
+    Local stand-in for Telegram servers: serves dialogs and pages of messages of the chats.
+    The server's flood wait is raised on each :flood_wait_every-th request (never, if it's 0).
+    """
+
+    def __init__(self, flood_wait_every: int = 0, flood_wait_seconds: int = 1):
+        self._flood_wait_every = flood_wait_every
+        self._flood_wait_seconds = flood_wait_seconds
+
+        self.requests_count = 0
+
+    @abstractmethod
+    def get_chats(self) -> List[Channel]:
+        pass
+
+    def get_other_dialogs_count(self) -> int:
+        """
+        How many dialogs with users are there besides the chats
+        """
+        return 0
+
+    @abstractmethod
+    def _get_messages(self, chat: Channel, limit: int, offset_id: int, min_id: int) -> Tuple[int, List[Any]]:
+        """
+        :return: Tuple(total messages count of the chat, messages older than :offset_id and newer than :min_id
+        from newest to oldest, at most :limit)
+        """
+        pass
+
+    def _get_user(self, user_id: int) -> User:
+        return User(id=user_id, first_name='user%d' % user_id, last_name=None, username=None)
+
+    def _count_request(self):
+        self.requests_count += 1
+
+        if self._flood_wait_every and self.requests_count % self._flood_wait_every == 0:
+            raise FloodWaitError(self._flood_wait_seconds)
+
+    def get_message_history(self, chat: Channel, limit: int, offset_id: int = 0, min_id: int = 0):
+        self._count_request()
+
+        messages_count, messages = self._get_messages(chat, limit, offset_id, min_id)
+
+        # senders of the messages and the invited users
+        users_ids = {m.from_id for m in messages}
+        for m in messages:
+            if isinstance(m, MessageService) and isinstance(m.action, MessageActionChatAddUser):
+                users_ids.update(m.action.users)
+
+        return messages_count, messages, [self._get_user(user_id) for user_id in users_ids]
+
+    def get_dialogs(self, request: GetDialogsRequest) -> DialogsPage:
+        self._count_request()
+
+        # dialogs with users go after the chats; top message of the dialog number i has id (dialogs count - i)
+        chats = self.get_chats()
+        dialogs_count = len(chats) + self.get_other_dialogs_count()
+
+        # the dialog with the offset id is the last one of the previous page, so the page starts after it
+        start = dialogs_count - request.offset_id + 1 if request.offset_id else 0
+        numbers = range(start, min(start + request.limit, dialogs_count))
+
+        dialogs, users, page_chats = [], [], []
+        for i in numbers:
+            if i < len(chats):
+                dialogs.append(StandInDialog(PeerChannel(chats[i].id), dialogs_count - i))
+                page_chats.append(chats[i])
+            else:
+                dialogs.append(StandInDialog(PeerUser(i), dialogs_count - i))
+                users.append(self._get_user(i))
+
+        messages = [Message(id=d.top_message, to_id=d.peer, date=datetime.now(), message='') for d in dialogs]
+
+        return DialogsPage(dialogs, messages, users, page_chats)
+
+    def invoke(self, request):
+        if isinstance(request, GetDialogsRequest):
+            return self.get_dialogs(request)
+
+        raise UnsupportedRequestError('Request %s is not supported by the stand-in' % type(request).__name__)
+
+
+class SyntheticBackend(StandInBackend):
+    """
+    Stand-in backend with synthetic chats: each message is generated from its id, so nothing is stored.
+    Every :service_every-th message is a service one: joining by link or inviting of a user.
+    """
+    _start_datetime = datetime(2017, 1, 1)
+
+    def __init__(self, chats_count: int = 4, messages_per_chat: int = 10000, users_per_chat: int = 500,
+                 service_every: int = 50, other_dialogs_count: int = 0, **kwargs):
+        super().__init__(**kwargs)
+
+        self._messages_per_chat = messages_per_chat
+        self._users_per_chat = users_per_chat
+        self._service_every = service_every
+        self._other_dialogs_count = other_dialogs_count
+
+        self._chats = [Channel(id=chat_id, title='Stand-in chat #%d' % chat_id, photo=ChatPhotoEmpty(),
+                               date=self._start_datetime, version=0, access_hash=chat_id)
+                       for chat_id in range(1, chats_count + 1)]
+
+    def get_chats(self) -> List[Channel]:
+        return self._chats
+
+    def get_other_dialogs_count(self) -> int:
+        return self._other_dialogs_count
+
+    def _get_message(self, chat: Channel, msg_id: int):
+        # users of different chats overlap partially
+        author_id = chat.id * self._users_per_chat // 2 + (msg_id * 2654435761) % self._users_per_chat
+        date = self._start_datetime + timedelta(minutes=msg_id)
+
+        if self._service_every and msg_id % self._service_every == 0:
+            if msg_id % (2 * self._service_every):
+                action = MessageActionChatJoinedByLink(inviter_id=author_id)
+            else:
+                action = MessageActionChatAddUser(users=[author_id + self._users_per_chat])
+
+            return MessageService(id=msg_id, to_id=PeerChannel(chat.id), date=date, action=action, from_id=author_id)
+
+        return Message(id=msg_id, to_id=PeerChannel(chat.id), date=date, from_id=author_id,
+                       message='m' * ((msg_id * 7919) % 120))
+
+    def _get_messages(self, chat: Channel, limit: int, offset_id: int, min_id: int) -> Tuple[int, List[Any]]:
+        newest_id = min(offset_id - 1, self._messages_per_chat) if offset_id else self._messages_per_chat
+        oldest_id = max(newest_id - limit + 1, min_id + 1, 1)
+
+        return self._messages_per_chat, [self._get_message(chat, msg_id)
+                                         for msg_id in range(newest_id, oldest_id - 1, -1)]
+
+
+class RecordedBackend(StandInBackend):
+    """
+    Stand-in backend, which replays the chats recorded in the messages cache of a session
+    (see TgClient.get_cached_chats_entities)
+    """
+
+    def __init__(self, cache_folder_path: str, **kwargs):
+        super().__init__(**kwargs)
+
+        messages_cache = MessagesCache(cache_folder_path)
+
+        self._chats, self._messages_counts, self._messages = [], {}, {}
+
+        for chat_id in messages_cache.get_chats_ids():
+            chat, messages_count = messages_cache.get_chat(chat_id)
+
+            self._chats.append(chat)
+            self._messages_counts[chat_id] = messages_count
+
+            messages = {m.id: m for history, _ in messages_cache.iter_pages(chat_id) for m in history}
+            self._messages[chat_id] = [messages[msg_id] for msg_id in sorted(messages, reverse=True)]
+
+    def get_chats(self) -> List[Channel]:
+        return self._chats
+
+    def _get_messages(self, chat: Channel, limit: int, offset_id: int, min_id: int) -> Tuple[int, List[Any]]:
+        messages = [m for m in self._messages[chat.id] if (not offset_id or m.id < offset_id) and m.id > min_id]
+
+        return self._messages_counts[chat.id], messages[:limit]
+
+
+class StandInTgClient(TgClient):
+    """
+    TgClient, which talks to the stand-in backend instead of Telegram servers (nothing is sent to the network).
+    Sessions and cache of the client are kept in the given folder.
+    """
+    _initial_requests_rate, _max_requests_rate = 10000., 100000.
+
+    # noinspection PyMissingConstructor
+    def __init__(self, backend: StandInBackend, storage_folder: str, session_name: str = 'stand_in',
+                 debug_mode=False):
+        self._debug = (lambda text: print(text)) if debug_mode else (lambda text: text)
+        self._backend = backend
+
+        self._sessions_folder = os.path.join(storage_folder, 'sessions')
+        self._cache_folder = os.path.join(storage_folder, 'cache')
+
+        if not os.path.exists(self._sessions_folder):
+            os.makedirs(self._sessions_folder)
+
+        self.user_phone = None
+
+        self._init_crawling(session_name)
+
+    def is_user_authorized(self):
+        return True
+
+    def get_message_history(self, entity, limit=20, offset_date=None, offset_id=0, max_id=0, min_id=0,
+                            add_offset=0):
+        return self._backend.get_message_history(entity, limit, offset_id=offset_id, min_id=min_id)
+
+    def invoke(self, request, *args, **kwargs):
+        return self._backend.invoke(request)
+
+
+def benchmark_crawl(backend: StandInBackend, concurrent_chats: int = 1, trace_memory: bool = True):
+    """
+    Downloads all the chats of the backend by the stand-in client, and prints throughput and peak memory
+    """
+    chats_titles = [chat.title for chat in backend.get_chats()]
+
+    with tempfile.TemporaryDirectory() as storage_folder:
+        client = StandInTgClient(backend, storage_folder)
+
+        if trace_memory:
+            tracemalloc.start()
+
+        start_time = perf_counter()
+        entities = client.get_chats_entities(chats_titles, concurrent_chats=concurrent_chats)
+        elapsed_time = perf_counter() - start_time
+
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+        tracemalloc.stop()
+
+    raw_messages_count = sum(chat.messages_count for chat in entities.chats)
+
+    print('%d messages (%d parsed, %d users): %.1f s, %.0f messages/s, %d requests, peak memory %s'
+          % (raw_messages_count, len(entities.messages), len(entities.users), elapsed_time,
+             raw_messages_count / elapsed_time, backend.requests_count,
+             '%.1f MB' % (peak_memory / 1024 / 1024) if trace_memory else 'not traced'))
+
+
+if __name__ == '__main__':
+    # tracing of the memory slows the crawl down by ~3.5 times, so the largest run goes without it
+    for total_messages, trace_memory in ((10 ** 4, True), (10 ** 5, True), (10 ** 6, True), (10 ** 7, False)):
+        benchmark_crawl(SyntheticBackend(chats_count=4, messages_per_chat=total_messages // 4,
+                                         other_dialogs_count=150),
+                        concurrent_chats=4, trace_memory=trace_memory)
@@ -0,0 +1,115 @@
+import os
+import pickle
+from datetime import datetime
+from typing import Dict, Optional, Any
+
+
+class ChatSyncState:
+    """
+    What is known about a chat after the last sync:
+    the highest downloaded message id (high-water mark), chat creation datetime and per-user statistics
+    """
+
+    def __init__(self, max_msg_id: int, creation_datetime: datetime, users_statistics: Dict[int, Any]):
+        self.max_msg_id = max_msg_id
+        self.creation_datetime = creation_datetime
+        self.users_statistics = users_statistics
+
+
+class SyncState:
+    """
+    Per-chat high-water marks of a Telegram session, persisted between runs.
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+
+        self._chats = self._load()
+
+    def _load(self) -> Dict[int, ChatSyncState]:
+        if not os.path.exists(self._file_path):
+            return {}
+
+        with open(self._file_path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self):
+        # write to a temp file first, so the state is never left half-written
+        tmp_file_path = self._file_path + '.tmp'
+
+        with open(tmp_file_path, 'wb') as f:
+            pickle.dump(self._chats, f)
+
+        os.replace(tmp_file_path, self._file_path)
+
+    def reset(self):
+        self._chats.clear()
+
+        if os.path.exists(self._file_path):
+            os.remove(self._file_path)
+
+    def get_chat(self, chat_id: int) -> Optional[ChatSyncState]:
+        return self._chats.get(chat_id)
+
+    def set_chat(self, chat_id: int, chat_state: ChatSyncState):
+        self._chats[chat_id] = chat_state
+
+
+class CrawlCheckpoint:
+    """
+    Progress of the download of a chat, saved after each page
+    """
+
+    def __init__(self, chat_id: int, min_msg_id: int, offset_id: int, pages_done: int, messages_count: int):
+        """
+        :param min_msg_id: high-water mark of the chat the download has started from
+        :param offset_id: id of the oldest downloaded message (the next page starts right before it)
+        """
+        self.chat_id = chat_id
+        self.min_msg_id = min_msg_id
+        self.offset_id = offset_id
+        self.pages_done = pages_done
+        self.messages_count = messages_count
+
+
+class CrawlCheckpoints:
+    """
+    Checkpoints of the chats downloads of a Telegram session: a small file per chat in the given folder.
+    """
+
+    def __init__(self, folder_path: str):
+        self._folder_path = folder_path
+
+        if not os.path.exists(self._folder_path):
+            os.makedirs(self._folder_path)
+
+    def _file_path(self, chat_id: int) -> str:
+        return os.path.join(self._folder_path, str(chat_id))
+
+    def get(self, chat_id: int) -> Optional[CrawlCheckpoint]:
+        file_path = self._file_path(chat_id)
+
+        if not os.path.exists(file_path):
+            return None
+
+        with open(file_path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, checkpoint: CrawlCheckpoint):
+        file_path = self._file_path(checkpoint.chat_id)
+        tmp_file_path = file_path + '.tmp'
+
+        with open(tmp_file_path, 'wb') as f:
+            pickle.dump(checkpoint, f)
+
+        os.replace(tmp_file_path, file_path)
+
+    def remove(self, chat_id: int):
+        file_path = self._file_path(chat_id)
+
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def clear(self):
+        for name in os.listdir(self._folder_path):
+            os.remove(os.path.join(self._folder_path, name))
@@ -1,17 +1,21 @@
+import asyncio
 import os
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
-from time import sleep
-from typing import Set, List, Tuple
+from typing import List, Tuple, Dict, Iterable, Generator, Optional, Any
 
 from telethon import RPCError, TelegramClient
-from telethon.tl.types import Channel
-from telethon.tl.types import MessageActionChatAddUser
-from telethon.tl.types import MessageActionChatJoinedByLink
-from telethon.tl.types import MessageService
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.messages import GetDialogsRequest
+from telethon.tl.types import Channel, InputPeerEmpty, PeerUser
+from telethon.utils import get_input_peer
 
-from models import Chat, ChatsEntities, Message, User
-from models import UserInChat
+from models import ChatsEntities
+from .chat_parsing import ChatHistoryParser
+from .dialogs_index import DialogsIndex
+from .messages_cache import MessagesCache
+from .rate_limiting import RateLimiter
+from .sync_state import SyncState, ChatSyncState, CrawlCheckpoints, CrawlCheckpoint
 
 
 class SettingsHolder:
@@ -67,7 +71,15 @@ class SettingsHolder:
 
 class TgClient(TelegramClient):
     _dialogs_per_time, _messages_per_time = 100, 100
+
+    # initial and maximal rates of requests of the client (requests per second)
+    _initial_requests_rate, _max_requests_rate = 1.3, 30.
+
+    # how many times a request is repeated if the server asks to wait
+    _flood_wait_retries = 5
+
     _sessions_folder = os.path.join(os.path.dirname(__file__), 'sessions')
+    _cache_folder = os.path.join(os.path.dirname(__file__), 'cache')
 
     def __init__(self, session_name: str = None, user_phone: str = None, api_id: int = None, api_hash: str = None,
                  proxy=None,
@@ -85,11 +97,32 @@ class TgClient(TelegramClient):
         # save the current user's phone
         self.user_phone = user_phone
 
+        self._init_crawling(session_name)
+
         self._debug('Connecting to Telegram servers...')
         self.connect()
 
         self._debug('Connected!')
 
+    def _init_crawling(self, session_name: str):
+        """
+        Initializes everything needed for downloading the chats (except the connection itself)
+        """
+        # rate limiter shared by all the requests (and all the downloads)
+        self._rate_limiter = RateLimiter(rate=self._initial_requests_rate, max_rate=self._max_requests_rate)
+
+        # chats found in the dialogs of the user by the previous runs
+        self._dialogs_index = DialogsIndex(os.path.join(self._sessions_folder, '%s.dialogs' % session_name))
+
+        # high-water marks of the chats synced by the previous runs
+        self._sync_state = SyncState(os.path.join(self._sessions_folder, '%s.sync' % session_name))
+
+        # progress of the downloads of the chats, which can be resumed after the interruption
+        self._checkpoints = CrawlCheckpoints(os.path.join(self._sessions_folder, '%s.checkpoints' % session_name))
+
+        # raw pages of messages downloaded by this and the previous runs
+        self._messages_cache = MessagesCache(os.path.join(self._cache_folder, session_name))
+
     def authorized(self):
         """
         Checks whether the session of the user contains authorization data (user is authorized)
@@ -123,237 +156,356 @@ class TgClient(TelegramClient):
 
         return code_ok
 
-    @staticmethod
-    def _parse_chat(chat: Channel, users_count: int, messages_count: int, creation_datetime: datetime) -> Chat:
-        if chat:
-            return Chat(chat.id, chat.title, users_count, messages_count, creation_datetime)
+    @property
+    def requests_rate(self) -> float:
+        """
+        Current rate of requests to Telegram (requests per second)
+        """
+        return self._rate_limiter.rate
+
+    @property
+    def requests_blocked_for(self) -> float:
+        """
+        How long (in seconds) the requests are blocked by the server's flood wait
+        """
+        return self._rate_limiter.blocked_for
 
-    @staticmethod
-    def _parse_message(msg, channel_id) -> Message:
-        # service message: who has joined, who has been invited, ...
-        if msg and not isinstance(msg, MessageService) and msg.message:
-            message_text = msg.message
+    def _request(self, method, *args, **kwargs):
+        """
+        Calls the given method of the client once the rate limiter allows it.
+        If the server asks to wait (FLOOD_WAIT) - slows down, waits and repeats the request.
+        """
+        for attempt in range(self._flood_wait_retries + 1):
+            self._rate_limiter.acquire()
+
+            try:
+                result = method(*args, **kwargs)
 
-            if message_text and 2 < len(message_text) < 500:
-                return Message(msg.id, message_text, msg.date, msg.from_id, channel_id)
+            except FloodWaitError as e:
+                if attempt == self._flood_wait_retries:
+                    raise
 
-    @staticmethod
-    def _parse_user(user) -> User:
-        if user:
-            return User(user.id, user.first_name, user.last_name, user.username)
+                self._rate_limiter.on_flood_wait(e.seconds)
+                self._debug('Flood wait for %d seconds; requests rate is reduced to %.2f/s'
+                            % (e.seconds, self._rate_limiter.rate))
+
+            else:
+                self._rate_limiter.on_success()
 
-    @staticmethod
-    def _parse_users_in_chat(chat, chat_users, chat_messages) -> Tuple[List[UserInChat], Set[User], datetime]:
+                return result
+
+    def download_chat(self, chat) -> Tuple[int, ChatHistoryParser]:
         """
-        # 1) Average common messages frequency (count/day)
-        # 2) Average messages length
-        # 3) Difference between chat creation and chat entering
-        :return: Tuple(UserChats, NewUsers, chat creation datetime)
+        Downloads the history of the chat (see iter_chat_pages). Each page is parsed as soon as it's downloaded.
+        :return: Tuple(messages count, parser, which has consumed the downloaded history)
         """
-        # TODO: parse who added who
+        history_parser = self.get_history_parser(chat)
 
-        def _get_empty_params():
-            return {
-                'last_day_msgs_count': 0,
-                'active_days_count': 0,
-                'last_day': None,
+        messages_count = None
+        for messages_count, history, senders in self.iter_chat_pages(chat):
+            history_parser.add_page(history, senders)
 
-                'total_len': 0,
-                'text_msgs_count': 0,
-                'total_msgs_count': 0,
+        return messages_count, history_parser
 
-                'join_datetime': None
-            }
+    def iter_chat_pages(self, chat) -> Generator[Tuple[int, List[Any], List[Any]], None, None]:
+        """
+        Downloads the history of the chat: the whole one, or only the messages newer than the high-water mark
+        of the chat (if the chat has been synced before).
+        Pages are keyed on message ids, so messages posted during the download don't shift them.
+        If the previous download of the chat was interrupted - it's resumed from the last downloaded page.
+        :return: generator of Tuple(messages count, messages, senders) of each page (from newest to oldest messages);
+        the last page is empty (the end of the history)
+        """
+        chat_state = self._sync_state.get_chat(chat.id)
+        min_msg_id = chat_state.max_msg_id if chat_state else 0
 
-        chat_creation_datetime = chat.date
+        # pages are cached (so the download can be resumed), but the cache of the chat is kept only if it's complete:
+        # the whole history is downloaded, or the new messages are appended to the completely cached history
+        cache_complete = not chat_state or chat.id in self._messages_cache.get_chats_ids()
 
-        users_ids = {user.id: _get_empty_params()
-                     for user in chat_users}
-        new_users = set()
+        checkpoint = self._checkpoints.get(chat.id)
 
-        # traverse history from newest to oldest messages
-        chat_messages = sorted(list(chat_messages), key=lambda m: m.date, reverse=True)
+        # the checkpoint of the download, which has started from another high-water mark, is useless
+        if checkpoint and checkpoint.min_msg_id != min_msg_id:
+            checkpoint = None
 
-        for msg in chat_messages:
-            sender_params = users_ids.get(msg.from_id)
+        if checkpoint:
+            messages_count, offset_id, pages_done = (checkpoint.messages_count,
+                                                     checkpoint.offset_id,
+                                                     checkpoint.pages_done)
 
-            # service message
-            if isinstance(msg, MessageService):
-                action = msg.action
+            self._debug('Resuming download of the chat "%s" after %d pages' % (chat.title, pages_done))
 
-                join_datetime = msg.date
-                if join_datetime < chat_creation_datetime:
-                    chat_creation_datetime = join_datetime
+            for history, senders in self._iter_restored_pages(chat, min_msg_id, offset_id):
+                yield messages_count, history, senders
 
-                # user has joined the chat by link or has been invited by someone
-                if isinstance(action, MessageActionChatJoinedByLink):
-                    # MessageActionChatJoinedByLink:
-                    #   action.inviter_id - id of the people who has joined
-                    joiner_id = msg.from_id
+        else:
+            messages_count, offset_id, pages_done = None, 0, 0
 
-                    sender_params = users_ids.get(joiner_id)
+            # the whole history is cached again
+            if not chat_state:
+                self._messages_cache.clear_chat(chat.id)
 
-                    if not sender_params:
-                        new_users.add(User(joiner_id, 'joined by link'))
+        # download chat information (page by page, from newest to oldest messages)
+        while True:
+            total_count, history, senders = self._request(self.get_message_history, chat,
+                                                          self._messages_per_time,
+                                                          offset_id=offset_id, min_id=min_msg_id)
 
-                        users_ids[joiner_id] = _get_empty_params()
-                        sender_params = users_ids[joiner_id]
+            # total messages count of the chat is the one at the start of the download
+            if messages_count is None:
+                messages_count = total_count
 
-                    sender_params['join_datetime'] = join_datetime
+            history = [m for m in history if m]
+            senders = [s for s in senders if s]
 
-                elif isinstance(action, MessageActionChatAddUser):
-                    # MessageActionChatAddUser:
-                    #   msg.from_id - id of the people who has invited
-                    #   action.users - list of users who have been invited
-                    if not action.users:
-                        print('Warning: empty "users" field of the MessageActionChatAddUser')
-                        continue
+            # save the page to the cache before parsing
+            if history:
+                self._messages_cache.append_page(chat.id, history, senders)
 
-                    for joiner_id in action.users:
-                        sender_params = users_ids.get(joiner_id)
+            yield messages_count, history, senders
 
-                        if not sender_params:
-                            new_users.add(User(joiner_id, 'was invited'))
+            # there are no older messages (or no messages newer than the high-water mark)
+            if not history:
+                break
 
-                            users_ids[joiner_id] = _get_empty_params()
-                            sender_params = users_ids[joiner_id]
+            # next page starts right before the oldest message of the current one
+            offset_id = min(m.id for m in history)
+            pages_done += 1
 
-                        sender_params['join_datetime'] = join_datetime
+            self._checkpoints.save(CrawlCheckpoint(chat.id, min_msg_id, offset_id, pages_done, messages_count))
 
-                else:
-                    continue
+        if cache_complete:
+            self._messages_cache.save_chat(chat, messages_count)
+        else:
+            self._messages_cache.clear_chat(chat.id)
 
-            # message written directly by user
-            else:
-                if not sender_params:
-                    print('Missed user with id #%s' % str(msg.from_id if msg.from_id else 'None'))
-                    continue
+        self._debug('Downloaded %d pages of the chat "%s" (requests rate is %.2f/s)'
+                    % (pages_done, chat.title, self.requests_rate))
 
-                # message with a text
-                if msg.message:
-                    # increase total messages length
-                    sender_params['total_len'] += len(msg.message)
-                    sender_params['text_msgs_count'] += 1
+    def _iter_restored_pages(self, chat, min_msg_id: int,
+                             offset_id: int) -> Generator[Tuple[List[Any], List[Any]], None, None]:
+        """
+        Restores from the cache the pages of the interrupted download of the chat:
+        messages newer than the high-water mark :min_msg_id, down to the last downloaded one :offset_id
+        """
+        # the pages downloaded after the last checkpoint may be cached several times, so ids are tracked
+        msgs_ids = set()
 
-                # message without a text
-                else:
-                    pass
+        for history, senders in self._messages_cache.iter_pages(chat.id):
+            history = [m for m in history if min_msg_id < m.id and offset_id <= m.id and m.id not in msgs_ids]
 
-                sender_params['total_msgs_count'] += 1
+            if history:
+                yield history, senders
+                msgs_ids.update(m.id for m in history)
 
-                msg_date = msg.date.date()
+    async def _download_chats_concurrently(self, chats: List[Channel], concurrent_chats: int,
+                                           entities: ChatsEntities):
+        """
+        Downloads histories of the chats at the same time (at most :concurrent_chats at once)
+        and adds parsed entities of each chat to the :entities as soon as the chat is downloaded.
+        All the downloads share the rate limiter of the client.
+        """
+        loop = asyncio.get_event_loop()
 
-                if msg_date != sender_params['last_day']:
-                    # add new active day
-                    sender_params['active_days_count'] += 1
+        with ThreadPoolExecutor(max_workers=concurrent_chats) as executor:
+            downloads = [loop.run_in_executor(executor, self.download_chat, chat) for chat in chats]
 
-                    # reset params
-                    sender_params['last_day'] = msg_date
-                    sender_params['last_day_msgs_count'] = 1
+            for download in asyncio.as_completed(downloads):
+                self.add_chat_entities(entities, *await download)
 
-                else:
-                    sender_params['last_day_msgs_count'] += 1
+    def get_sync_state(self, chat_id: int) -> Optional[ChatSyncState]:
+        """
+        :return: state of the chat after the previous sync (None, if the chat has never been synced)
+        """
+        return self._sync_state.get_chat(chat_id)
 
-        users_in_chat = []
+    def get_history_parser(self, chat: Channel) -> ChatHistoryParser:
+        """
+        :return: parser of the messages newer than the ones of the previous sync of the chat
+        """
+        return ChatHistoryParser(chat, self._sync_state.get_chat(chat.id))
 
-        for u_id, params in users_ids.items():
-            join_datetime = params['join_datetime']
+    def get_messages_count(self, chat: Channel) -> int:
+        """
+        :return: total messages count of the chat known after the previous sync
+        (approximated by the high-water mark if the chat is not cached)
+        """
+        if chat.id in self._messages_cache.get_chats_ids():
+            return self._messages_cache.get_chat(chat.id)[1]
 
-            # calculate average messages length
-            text_msgs_count, total_len = params['text_msgs_count'], params['total_len']
-            avg_msg_len = total_len / text_msgs_count if text_msgs_count else 0
+        chat_state = self._sync_state.get_chat(chat.id)
 
-            # calculate average messages frequency
-            # TODO: add chat characteristic
-            active_days_count = params['active_days_count']
+        return chat_state.max_msg_id if chat_state else 0
 
-            total_msgs_count = params['total_msgs_count']
+    def cache_new_messages(self, chat: Channel, history: List[Any], senders: List[Any], messages_count: int):
+        """
+        Appends the messages received after the sync to the cache of the chat
+        (only if the whole history of the chat is cached, so the cache is never partial)
+        """
+        if chat.id in self._messages_cache.get_chats_ids():
+            self._messages_cache.append_page(chat.id, history, senders)
+            self._messages_cache.save_chat(chat, messages_count)
 
-            if join_datetime:
-                now_entering_diff = datetime.now() - join_datetime
-            else:
-                now_entering_diff = datetime.now() - chat_creation_datetime
+    def add_chat_entities(self, entities: ChatsEntities, messages_count: int, history_parser: ChatHistoryParser,
+                          only_changed_users: bool = False):
+        """
+        Adds entities parsed from the downloaded history of the chat to the :entities and updates the sync state
+        :param only_changed_users: see ChatHistoryParser.finish
+        """
+        self._sync_state.set_chat(history_parser.chat.id,
+                                  history_parser.finish(entities, messages_count, only_changed_users))
 
-            days_count = now_entering_diff.days
-            avg_daily_freq = total_msgs_count / days_count if days_count else 0
+    @classmethod
+    def get_cached_chats_entities(cls, session_name: str, chats_names: List[str] = None) -> ChatsEntities:
+        """
+        Parses histories of the chats from the messages cache of the session, without connecting to Telegram.
+        :param chats_names: titles of the chats to parse (all the cached chats by default)
+        """
+        messages_cache = MessagesCache(os.path.join(cls._cache_folder, session_name))
+        chats_entities = ChatsEntities()
 
-            # calculate difference between chat entering and chat creation
-            if join_datetime:
-                creation_entering_diff = join_datetime - chat_creation_datetime
+        for chat_id in messages_cache.get_chats_ids():
+            chat, messages_count = messages_cache.get_chat(chat_id)
 
-            else:
-                creation_entering_diff = timedelta()
+            if chats_names is not None and chat.title not in chats_names:
+                continue
+
+            history_parser = ChatHistoryParser(chat)
+
+            # the pages of an interrupted download are downloaded again by the next run, so ids are tracked
+            msgs_ids = set()
+
+            for history, senders in messages_cache.iter_pages(chat_id):
+                history_parser.add_page([m for m in history if m.id not in msgs_ids], senders)
+                msgs_ids.update(m.id for m in history)
+
+            history_parser.finish(chats_entities, messages_count)
+
+        return chats_entities
+
+    def _iter_dialogs_pages(self) -> Generator[List[Any], None, None]:
+        """
+        Enumerates all the dialogs of the user page by page (from the most recent ones).
+        :return: generator of lists of chats (and channels) of the dialogs of each page
+        """
+        offset_date, offset_id, offset_peer = None, 0, InputPeerEmpty()
+
+        while True:
+            result = self._request(self.invoke, GetDialogsRequest(offset_date=offset_date, offset_id=offset_id,
+                                                           offset_peer=offset_peer, limit=self._dialogs_per_time))
+            if not result.dialogs:
+                break
+
+            yield result.chats
+
+            # the last page is not full
+            if len(result.dialogs) < self._dialogs_per_time:
+                break
 
-            users_in_chat.append(UserInChat(chat.id, u_id,
-                                            creation_entering_diff.total_seconds(),
-                                            avg_daily_freq, avg_msg_len))
+            # the next page starts after the top message of the last dialog
+            last_dialog = result.dialogs[-1]
+            last_message = next((m for m in result.messages if m.id == last_dialog.top_message), None)
 
-        return users_in_chat, new_users, chat_creation_datetime
+            if isinstance(last_dialog.peer, PeerUser):
+                last_entity = next((u for u in result.users if u.id == last_dialog.peer.user_id), None)
+            else:
+                peer_id = getattr(last_dialog.peer, 'channel_id', None) or last_dialog.peer.chat_id
+                last_entity = next((c for c in result.chats if c.id == peer_id), None)
+
+            # the offset of the next page is unknown (e.g. the top message of the dialog is deleted)
+            if last_message is None or last_entity is None:
+                break
 
-    def get_chats_entities(self, chats_names: List[str]) -> ChatsEntities:
-        _, entities = self.get_dialogs(100)
+            offset_date, offset_id, offset_peer = last_message.date, last_message.id, get_input_peer(last_entity)
 
+    def find_chats(self, chats_names: List[str]) -> Dict[str, Channel]:
+        """
+        Chats are looked up in the dialogs index of the session. If some of them are missed - the index is refreshed
+        by enumerating the dialogs of the user, until all of them are found.
+        :return: Dict[title, chat] of the dialogs of the user with the given titles (only found ones)
+        """
         # it's expected that title is a unique identifier of a chat
-        channels = {e.title: e for e in entities if isinstance(e, Channel) and e.title in chats_names}
+        channels = {title: self._dialogs_index.get(title) for title in chats_names if title in self._dialogs_index}
+        missed = set(chats_names).difference(channels.keys())
 
-        # if some chats not found
-        not_found = set(chats_names).difference(channels.keys())
-        if not_found:
-            raise ValueError('Chats %s not found, exiting.' % str(not_found))
-        else:
-            print('Found all the %d chats.\nMessages and users gathering started.' % len(channels))
+        if missed:
+            self._debug('Chats %s are not indexed, enumerating dialogs...' % str(missed))
 
-        total_chats, total_users, total_messages = set(), set(), set()
-        total_users_in_chats = set()
+            for chats in self._iter_dialogs_pages():
+                for e in chats:
+                    if isinstance(e, Channel):
+                        self._dialogs_index.set(e.title, e)
 
-        chat_users, chat_messages = set(), set()
+                        if e.title in missed:
+                            channels[e.title] = e
+                            missed.discard(e.title)
 
-        for chat in channels.values():
-            chat_users.clear()
-            chat_messages.clear()
+                if not missed:
+                    break
 
-            # get total messages counts
-            messages_count, _, _ = self.get_message_history(chat, 1)
+            self._dialogs_index.save()
 
-            # calculate iterations number needed to get download all the messages
-            offset, iterations_number = 0, int(messages_count / self._messages_per_time) + 1
+        return channels
+
+    def start_sync(self, incremental: bool = True):
+        """
+        Should be called before downloading the chats.
+        :param incremental: if False - high-water marks and checkpoints of the previous runs are forgotten
+        """
+        if not incremental:
+            self._sync_state.reset()
+            self._checkpoints.clear()
+
+    def complete_sync(self, chats: Iterable[Channel]):
+        """
+        Should be called after all the chats are downloaded and added to the entities
+        """
+        # remember high-water marks of the chats for the next run
+        self._sync_state.save()
 
-            # download chat information (by iterations)
-            for i in range(0, iterations_number):
-                _, history, senders = self.get_message_history(chat,
-                                                               self._messages_per_time,
-                                                               add_offset=offset)
-                chat_users.update([s for s in senders if s])
-                chat_messages.update([m for m in history if m])
+        # the downloads are completed, so the next run starts from the new high-water marks
+        for chat in chats:
+            self._checkpoints.remove(chat.id)
 
-                # wait before next iteration
-                sleep(0.75)
+    def get_chats_entities(self, chats_names: List[str], concurrent_chats: int = 1,
+                           incremental: bool = True) -> ChatsEntities:
+        """
+        Downloads and parses histories of the chats with the given titles.
+        :param concurrent_chats: how many chats can be downloaded at the same time
+        :param incremental: if True - only messages newer than the ones of the previous run are downloaded
+        (the returned entities are marked as incremental then); otherwise - whole histories are downloaded
+        """
+        self.start_sync(incremental)
 
-                offset += self._messages_per_time
+        channels = self.find_chats(chats_names)
 
-            # TODO: save to cache before parsing
-            # add users_in_chat entities for the chat, and get extra users
-            users_in_chat, extra_chat_users, chat_creation_datetime = self._parse_users_in_chat(chat, chat_users, chat_messages)
-            total_users_in_chats.update(users_in_chat)
+        # if some chats not found
+        not_found = set(chats_names).difference(channels.keys())
+        if not_found:
+            raise ValueError('Chats %s not found, exiting.' % str(not_found))
+        else:
+            print('Found all the %d chats.\nMessages and users gathering started.' % len(channels))
 
-            # add users from the chat
-            curr_chat_users = {self._parse_user(user) for user in chat_users}.union(extra_chat_users)
-            total_users.update(curr_chat_users)
+        chats_entities = ChatsEntities()
 
-            # add messages from the chat
-            for msg in chat_messages:
-                message = self._parse_message(msg, chat.id)
+        if concurrent_chats > 1:
+            loop = asyncio.new_event_loop()
 
-                if message:
-                    total_messages.add(message)
+            try:
+                loop.run_until_complete(self._download_chats_concurrently(list(channels.values()),
+                                                                           concurrent_chats,
+                                                                           chats_entities))
+            finally:
+                loop.close()
 
-            # the same thing in different way
-            # messages.update(filter(lambda m: m, [self._parse_message(msg, chat.id) for msg in chat_messages]))
+        else:
+            for chat in channels.values():
+                self.add_chat_entities(chats_entities, *self.download_chat(chat))
 
-            # finally - add chat entity
-            total_chats.add(self._parse_chat(chat, len(curr_chat_users), messages_count, chat_creation_datetime))
+        self.complete_sync(channels.values())
 
-        return ChatsEntities(total_chats, total_users, total_messages, total_users_in_chats)
+        return chats_entities
 
 
 if __name__ == '__main__':
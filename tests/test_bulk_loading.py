@@ -0,0 +1,138 @@
+"""
+Tests of the bulk loading against a database: they are skipped, unless the address of an empty database is given
+by the TEST_POSTGRES_ADDRESS environment variable (e.g. 'pq://postgres:postgres@localhost:5432/test').
+Tables are created in a separate schema, which is dropped afterwards.
+
+    TEST_POSTGRES_ADDRESS=... python -m unittest discover tests
+"""
+import os
+import unittest
+from datetime import datetime
+
+postgres_db_address = os.environ.get('TEST_POSTGRES_ADDRESS')
+
+# the driver of the database may be not installed, if the tests are skipped
+if postgres_db_address:
+    from data.transferring.bulk_loading import BulkLoader
+    from data.transferring.users_ids import UsersIdsCache
+    from models import User, Chat, Message, FoodOrder
+
+tables_file_path = os.path.join(os.path.dirname(__file__), os.pardir, 'sql', 'tables.sql')
+
+
+class BulkLoadingTest(unittest.TestCase):
+    _schema = 'bulk_loading_test'
+
+    def setUp(self):
+        import postgresql
+
+        self.db = postgresql.open(postgres_db_address)
+
+        self.db.execute('DROP SCHEMA IF EXISTS %s CASCADE' % self._schema)
+        self.db.execute('CREATE SCHEMA %s' % self._schema)
+        self.db.execute('SET search_path TO %s' % self._schema)
+
+        with open(tables_file_path, encoding='utf-8') as f:
+            self.db.execute(f.read())
+
+        # an index, which doesn't belong to a constraint
+        self.db.execute('CREATE INDEX messages_date_idx ON messages (date)')
+
+        self.loader = BulkLoader(self.db, UsersIdsCache())
+
+        # all the rows are loaded by COPY (the set-based functions are not created)
+        self.loader._copy_min_rows = 0
+
+        self.date = datetime(2017, 1, 1)
+
+        self.loader.load_rows(User, [(tg_id, 'user%d' % tg_id, None, None) for tg_id in range(10)])
+        self.loader.load_rows(Chat, [(1, 'chat', 10, 100, self.date)])
+
+    def tearDown(self):
+        self.db.execute('DROP SCHEMA IF EXISTS %s CASCADE' % self._schema)
+        self.db.close()
+
+    def _get_users_tg_ids(self):
+        return sorted(tg_id for tg_id, in self.db.prepare('SELECT tg_id FROM users')())
+
+
+@unittest.skipUnless(postgres_db_address, 'TEST_POSTGRES_ADDRESS is not set')
+class MissingUsersTest(BulkLoadingTest):
+    def test_missing_users_are_inserted_and_cached(self):
+        self.loader.load_rows(Message, [(msg_id, 'text', self.date, 1, 100 + msg_id % 3) for msg_id in range(10)])
+
+        self.assertEqual(list(range(10)) + [100, 101, 102], self._get_users_tg_ids())
+
+        local_ids = dict(self.db.prepare('SELECT tg_id, local_id FROM users')())
+        self.assertEqual({tg_id: local_ids[tg_id] for tg_id in (100, 101, 102)},
+                         self.loader._users_ids.get(self.db, (100, 101, 102)))
+
+        authors = {user_id for user_id, in self.db.prepare('SELECT DISTINCT user_id FROM messages')()}
+        self.assertEqual({local_ids[tg_id] for tg_id in (100, 101, 102)}, authors)
+
+    def test_missing_users_are_committed_before_load(self):
+        # messages of the chat, which doesn't exist, are not loaded
+        with self.assertRaises(Exception):
+            self.loader.load_rows(Message, [(1, 'text', self.date, 2, 100)])
+
+        self.assertEqual(list(range(10)) + [100], self._get_users_tg_ids())
+        self.assertEqual(0, self.db.prepare('SELECT count(*) FROM messages').first())
+
+
+@unittest.skipUnless(postgres_db_address, 'TEST_POSTGRES_ADDRESS is not set')
+class ShadowTablesTest(BulkLoadingTest):
+    def _get_names(self, query: str, table_title: str):
+        return sorted(name for name, in self.db.prepare(query)(table_title))
+
+    def _get_constraints_names(self, table_title: str):
+        return self._get_names('SELECT conname FROM pg_constraint WHERE conrelid = $1::text::regclass', table_title)
+
+    def _get_indexes_names(self, table_title: str):
+        return self._get_names('SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                               'WHERE i.indrelid = $1::text::regclass', table_title)
+
+    def _reload(self, entity_type: type, *batches):
+        self.loader.create_shadow_table(entity_type)
+
+        for rows in batches:
+            self.loader.load_rows(entity_type, rows, shadow=True)
+
+        self.loader.build_shadow_indexes(entity_type)
+        self.loader.swap_shadow_tables([entity_type])
+
+    def test_reload_keeps_constraints_and_indexes(self):
+        self.loader.load_rows(Message, [(msg_id, 'old', self.date, 1, 0) for msg_id in range(100)])
+
+        constraints_names = self._get_constraints_names('messages')
+        indexes_names = self._get_indexes_names('messages')
+
+        # the batches overlap, the last loaded rows are kept
+        self._reload(Message,
+                     [(msg_id, 'first', self.date, 1, msg_id % 10) for msg_id in range(50)],
+                     [(msg_id, 'second', self.date, 1, msg_id % 10) for msg_id in range(40, 60)])
+
+        self.assertEqual(constraints_names, self._get_constraints_names('messages'))
+        self.assertEqual(indexes_names, self._get_indexes_names('messages'))
+        self.assertIsNone(self.db.prepare('SELECT to_regclass(\'messages_new\')').first())
+
+        texts = dict(self.db.prepare('SELECT msg_id, text FROM messages')())
+        self.assertEqual(60, len(texts))
+        self.assertEqual('first', texts[0])
+        self.assertEqual('second', texts[45])
+
+    def test_reload_keeps_sequence_and_duplicates(self):
+        order = (1, 'pizza', None, 1, self.date)
+
+        self.loader.load_rows(FoodOrder, [order] * 5)
+        self._reload(FoodOrder, [order] * 3, [order])
+
+        self.assertEqual(4, self.db.prepare('SELECT count(*) FROM food_orders').first())
+
+        # the ids of the reloaded and the new orders continue the old sequence (1-5 are the ids of the old ones)
+        self.loader.load_rows(FoodOrder, [order])
+        self.assertEqual(list(range(6, 11)), [order_id for order_id, in
+                                              self.db.prepare('SELECT order_id FROM food_orders ORDER BY 1')()])
+
+
+if __name__ == '__main__':
+    unittest.main()